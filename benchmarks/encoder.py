@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Compare the encoding of datastore_create request bodies with the
+DatastoreEncoder against encode_record and datastore_create_body.
+
+Usage: python benchmarks/encoder.py [FILE ...]
+
+FILE defaults to tests/static/long.csv.
+'''
+import os
+import sys
+import json
+import timeit
+
+import messytables
+
+import datapusher.jobs as jobs
+
+
+def static_path(filename):
+    return os.path.join(os.path.dirname(__file__), '..', 'tests', 'static',
+                        filename)
+
+
+def parse(path):
+    '''Parse a file into the records and fields push_to_datastore sends'''
+    with open(path, 'rb') as f:
+        table_set = messytables.any_tableset(f, extension=path)
+        row_set = table_set.tables.pop()
+        offset, headers = messytables.headers_guess(row_set.sample)
+        headers = [str(header) for header in headers]
+        row_set.register_processor(messytables.headers_processor(headers))
+        row_set.register_processor(messytables.offset_processor(offset + 1))
+        types = messytables.type_guess(row_set.sample, types=jobs.TYPES,
+                                       strict=True)
+        row_set.register_processor(messytables.types_processor(types))
+        records = [dict((cell.column, cell.value) for cell in row)
+                   for row in row_set]
+    fields = [dict(id=h, type=jobs.TYPE_MAPPING[str(t)])
+              for h, t in zip(headers, types)]
+    return fields, records
+
+
+def chunks(records):
+    return [records[i:i + jobs.CHUNK_INSERT_ROWS]
+            for i in range(0, len(records), jobs.CHUNK_INSERT_ROWS)]
+
+
+def encoder_body(fields, chunk):
+    request = {'resource_id': 'benchmark', 'fields': fields, 'force': True,
+               'records': chunk, 'calculate_record_count': False}
+    return json.dumps(request, cls=jobs.DatastoreEncoder)
+
+
+def measured_encoder_body(fields, chunk):
+    # Adaptive chunking needs the size of every record on top of the body
+    [len(json.dumps(record, cls=jobs.DatastoreEncoder)) for record in chunk]
+    return encoder_body(fields, chunk)
+
+
+def joined_body(fields, chunk):
+    request = {'resource_id': 'benchmark', 'fields': fields, 'force': True,
+               'calculate_record_count': False}
+    records = [jobs.encode_record(record) for record in chunk]
+    return b''.join(jobs.datastore_create_body(request, records))
+
+
+def streamed_body(fields, chunk):
+    request = {'resource_id': 'benchmark', 'fields': fields, 'force': True,
+               'calculate_record_count': False}
+    records = [jobs.encode_record(record) for record in chunk]
+    for piece in jobs.datastore_create_body(request, records):
+        pass
+
+
+def peak_memory(func, fields, chunk):
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    tracemalloc.start()
+    func(fields, chunk)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main(filenames):
+    for filename in filenames:
+        fields, records = parse(filename)
+        print('{0}: {1} records, {2} columns'.format(
+            os.path.basename(filename), len(records), len(fields)))
+        for name, func in (('DatastoreEncoder', encoder_body),
+                           ('DatastoreEncoder, measured',
+                            measured_encoder_body),
+                           ('encode_record', joined_body),
+                           ('encode_record, streamed', streamed_body)):
+            seconds = min(timeit.repeat(
+                lambda: [func(fields, chunk) for chunk in chunks(records)],
+                number=5, repeat=3)) / 5
+            peak = peak_memory(func, fields, records)
+            print('  {0:<28} {1:8.2f} ms/file   peak {2} bytes/body'.format(
+                name, seconds * 1000,
+                'n/a' if peak is None else peak))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or [static_path('long.csv')])
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+'''
+Compare building the records of a file with the original per-cell loop
+against the column-oriented row_iterator of push_to_datastore, repairing
+mojibake in every column or only in the ones detect_mojibake picks.
+
+Usage: python benchmarks/rows.py [FILE ...]
+
+FILE defaults to tests/static/long.csv and tests/static/bus-stops.csv.
+'''
+import os
+import sys
+import time
+
+import messytables
+from messytables.core import Cell, RowSet
+from messytables.commas import CSVRowSet
+
+import datapusher.jobs as jobs
+
+
+def static_path(filename):
+    return os.path.join(os.path.dirname(__file__), '..', 'tests', 'static',
+                        filename)
+
+
+class MemoryRowSet(CSVRowSet):
+    '''A row set of already parsed rows, to leave parsing out of timings'''
+
+    def __init__(self, rows):
+        RowSet.__init__(self)
+        self.rows = rows
+
+    def raw(self, sample=False):
+        rows = self.rows[:1000] if sample else self.rows
+        for row in rows:
+            yield [Cell(value) for value in row]
+
+
+def parse(path):
+    '''The cell values, headers, offset and types of a file'''
+    with open(path, 'rb') as f:
+        table_set = messytables.any_tableset(f, extension=path)
+        row_set = table_set.tables.pop()
+        offset, headers = messytables.headers_guess(row_set.sample)
+        headers = [str(header) for header in headers]
+        row_set.register_processor(messytables.headers_processor(headers))
+        row_set.register_processor(messytables.offset_processor(offset + 1))
+        types = messytables.type_guess(row_set.sample, types=jobs.TYPES,
+                                       strict=True)
+        rows = [[cell.value for cell in row] for row in row_set.raw()]
+    return rows, headers, offset, types
+
+
+def row_set_for(parsed):
+    '''A row set set up like the one push_to_datastore works with'''
+    rows, headers, offset, types = parsed
+    row_set = MemoryRowSet(rows)
+    row_set.register_processor(messytables.headers_processor(headers))
+    row_set.register_processor(messytables.offset_processor(offset + 1))
+    return row_set, headers, offset, types
+
+
+def cell_records(row_set, headers, offset, types):
+    '''The records, built cell by cell like push_to_datastore used to'''
+    row_set.register_processor(messytables.types_processor(types))
+    headers_set = set(h.strip() for h in headers if h.strip())
+    for row in row_set:
+        data_row = {}
+        for index, cell in enumerate(row):
+            column_name = cell.column.strip()
+            if column_name not in headers_set:
+                continue
+            if isinstance(cell.value, str):
+                try:
+                    data_row[column_name] = \
+                        cell.value.encode('latin-1').decode('utf-8')
+                except (UnicodeDecodeError, UnicodeEncodeError):
+                    data_row[column_name] = cell.value
+            else:
+                data_row[column_name] = cell.value
+        yield data_row
+
+
+def column_records(row_set, headers, offset, types):
+    return jobs.row_iterator(row_set, headers, types, offset)
+
+
+def detected_records(row_set, headers, offset, types):
+    repair = jobs.detect_mojibake(row_set.sample, len(headers))
+    return jobs.row_iterator(row_set, headers, types, offset, repair)
+
+
+def timed(func, parsed, repeat=5):
+    '''Best time to build the records'''
+    times = []
+    for _ in range(repeat):
+        row_set, headers, offset, types = row_set_for(parsed)
+        start = time.time()
+        records = list(func(row_set, headers, offset, types))
+        times.append(time.time() - start)
+    return min(times), records
+
+
+def main(filenames):
+    for filename in filenames:
+        print(os.path.basename(filename))
+        parsed = parse(filename)
+        results = []
+        for name, func in (('per cell', cell_records),
+                           ('row_iterator', column_records),
+                           ('row_iterator, repair detected',
+                            detected_records)):
+            seconds, records = timed(func, parsed)
+            results.append(records)
+            print('  {0:<30} {1:8.2f} ms/file'.format(name, seconds * 1000))
+        assert results[0] == results[1]
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or [static_path('long.csv'),
+                          static_path('bus-stops.csv')])
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of the downloaded files, shared by all the jobs.
+
+Files are stored once per content, named after their md5, and the URLs they
+were downloaded from point at them, with the validators (ETag and
+Last-Modified headers) and content type of the response. A URL fetched less
+than ``ttl`` seconds ago is served from the cache without a request,
+otherwise its validators are sent to only download it again if it changed.
+
+The records a file was converted to can be cached as well, under a key made
+from its md5 and how it was parsed, so the same file pushed to another
+resource isn't parsed again.
+
+The least recently used files are removed once the cache is over its size.
+Several processes can share a cache directory: files are written to
+temporary files and renamed into place.
+
+"""
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class DownloadCache(object):
+    """
+    Cache of downloaded files in a directory
+
+    :param directory: Directory of the cache, created if needed
+    :type directory: string
+    :param max_size: Size of the files kept, in bytes
+    :type max_size: int
+    :param ttl: Seconds during which a URL is served from the cache without
+        asking the server whether it changed
+    :type ttl: int
+    """
+
+    def __init__(self, directory, max_size, ttl):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        _makedirs(os.path.join(directory, 'urls'))
+
+    def _url_path(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'urls', name + '.json')
+
+    def _file_path(self, md5):
+        return os.path.join(self.directory, md5 + '.data')
+
+    def _records_path(self, key):
+        return os.path.join(self.directory, key + '.records')
+
+    def _write(self, path, fileobj):
+        # Copy to a temporary file first, so nobody reads half a file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                shutil.copyfileobj(fileobj, tmp)
+            os.rename(tmp_path, path)
+        except Exception:
+            _remove(tmp_path)
+            raise
+
+    def _write_entry(self, url, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(entry, tmp)
+        os.rename(tmp_path, self._url_path(url))
+
+    def lookup(self, url):
+        """
+        Returns the entry of a URL, or None if it isn't cached
+
+        The entry is a dict with the ``md5``, ``length``, ``content_type``,
+        ``etag`` and ``last_modified`` of the file, and whether it's
+        ``fresh``, i.e. fetched less than ``ttl`` seconds ago.
+
+        :rtype: dict
+        """
+        try:
+            with open(self._url_path(url)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not os.path.exists(self._file_path(entry['md5'])):
+            return None
+        entry['fresh'] = time.time() - entry['fetched'] < self.ttl
+        return entry
+
+    def open(self, entry):
+        """
+        Opens the file of an entry given by ``lookup``
+
+        :returns: The file, or None if it has been removed in the meantime
+        """
+        path = self._file_path(entry['md5'])
+        try:
+            fileobj = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        self._touch(path)
+        return fileobj
+
+    def refresh(self, url, entry):
+        """
+        Records that the file of an entry is still the one at its URL
+        """
+        entry = dict(entry, fetched=time.time())
+        entry.pop('fresh', None)
+        self._write_entry(url, entry)
+
+    def add(self, url, fileobj, md5, length, headers):
+        """
+        Adds a file downloaded from a URL to the cache
+
+        :param fileobj: The downloaded file, read from the start and left at
+            the start
+        :param md5: The md5 hex digest of the file
+        :type md5: string
+        :param length: The size of the file
+        :type length: int
+        :param headers: The headers of the response
+        :type headers: dict-like
+        """
+        path = self._file_path(md5)
+        if os.path.exists(path):
+            self._touch(path)
+        else:
+            fileobj.seek(0)
+            self._write(path, fileobj)
+            fileobj.seek(0)
+        self._write_entry(url, {
+            'md5': md5,
+            'length': length,
+            'content_type': headers.get('content-type'),
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'fetched': time.time(),
+        })
+        self.evict()
+
+    def records(self, key):
+        """
+        Yields the encoded records cached under a key, one per line
+
+        :returns: A generator of strings, or None if they aren't cached
+        """
+        path = self._records_path(key)
+        try:
+            fileobj = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        self._touch(path)
+
+        def lines():
+            with fileobj:
+                for line in fileobj:
+                    yield line[:-1].decode('ascii')
+        return lines()
+
+    def store_records(self, key, records):
+        """
+        Yields encoded records as they are, writing them to the cache under
+        a key
+
+        They are only cached if all of them are read.
+
+        :param records: Records encoded in ASCII, without newlines
+        :type records: iterable of strings
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for record in records:
+                    tmp.write((record + '\n').encode('ascii'))
+                    yield record
+            os.rename(tmp_path, self._records_path(key))
+        finally:
+            _remove(tmp_path)
+        self.evict()
+
+    def _touch(self, path):
+        # The modification time tells which files were used last
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Removes the least recently used files until the cache fits in its
+        size
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(('.data', '.records')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.max_size:
+                break
+            _remove(path)
+            size -= file_size
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Decompression of the gzip, bzip2 and zip files pushed to the DataStore.
+
+Compressed files are told by their first bytes rather than by the content
+type or extension they were served with, which are often wrong. They are
+decompressed chunk by chunk into a temporary file, which is what gets
+parsed, and the decompression stops as soon as the file gets larger than
+allowed, so a small file can't decompress into one that fills the disk.
+
+XLSX and ODS files are zip files too, they are left as they are.
+
+"""
+import bz2
+import os
+import posixpath
+import tempfile
+import zipfile
+import zlib
+
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+ZIP = 'zip'
+
+_MAGIC = [
+    (b'\x1f\x8b', GZIP),
+    (b'BZh', BZIP2),
+    (b'PK\x03\x04', ZIP),
+]
+
+# Extensions of the compressed files, removed to get the name of the file
+# they contain
+EXTENSIONS = {
+    GZIP: ('.gz', '.gzip'),
+    BZIP2: ('.bz2', '.bzip2'),
+    ZIP: ('.zip',),
+}
+
+# Extensions of the files looked for first in a zip file
+DATA_EXTENSIONS = ('.csv', '.tsv', '.txt', '.xls', '.xlsx', '.ods')
+
+
+class DecompressionError(Exception):
+    pass
+
+
+def detect(fileobj):
+    """
+    Returns how a file is compressed, ``GZIP``, ``BZIP2`` or ``ZIP``, or
+    None if it isn't
+
+    The position of ``fileobj`` is left at the start.
+    """
+    fileobj.seek(0)
+    start = fileobj.read(4)
+    fileobj.seek(0)
+    for magic, compression in _MAGIC:
+        if start.startswith(magic):
+            break
+    else:
+        return None
+    if compression == ZIP:
+        try:
+            names = zipfile.ZipFile(fileobj).namelist()
+        except (zipfile.BadZipfile, EnvironmentError):
+            return None
+        finally:
+            fileobj.seek(0)
+        # Office documents are zip files as well
+        if '[Content_Types].xml' in names or 'mimetype' in names:
+            return None
+    return compression
+
+
+def decompress(fileobj, compression, name, max_length, chunk_size=16384):
+    """
+    Decompresses a file into a temporary file
+
+    :param compression: How the file is compressed, as given by ``detect``
+    :type compression: string
+    :param name: The name of the file, e.g. the path of its URL
+    :type name: string
+    :param max_length: Size the file can decompress to, in bytes
+    :type max_length: int
+
+    :returns: The decompressed file, at its start, and its name
+    :rtype: tuple
+    """
+    name = posixpath.basename(name or '')
+    try:
+        if compression == ZIP:
+            archive = zipfile.ZipFile(fileobj)
+            name = _zip_member(archive)
+            chunks = _read_chunks(archive.open(name), chunk_size)
+        elif compression == GZIP:
+            chunks = _gunzip(fileobj, chunk_size)
+        else:
+            chunks = _bunzip2(fileobj, chunk_size)
+        tmp = _write_chunks(chunks, max_length)
+    except (zipfile.BadZipfile, zlib.error, IOError, EOFError,
+            ValueError) as e:
+        raise DecompressionError(
+            'Could not decompress the {compression} file: {error}'.format(
+                compression=compression, error=e))
+    if compression != ZIP:
+        root, ext = os.path.splitext(name)
+        if ext.lower() in EXTENSIONS[compression]:
+            name = root
+    return tmp, name
+
+
+def _write_chunks(chunks, max_length):
+    # The temporary file is removed if the decompression fails
+    tmp = tempfile.TemporaryFile()
+    try:
+        length = 0
+        for chunk in chunks:
+            length += len(chunk)
+            if length > max_length:
+                raise DecompressionError(
+                    'Resource too large to process: decompressed size {cl} '
+                    '> max ({max_cl}).'.format(cl=length, max_cl=max_length))
+            tmp.write(chunk)
+    except BaseException:
+        tmp.close()
+        raise
+    tmp.seek(0)
+    return tmp
+
+
+def _zip_member(archive):
+    # The first data file, or the first file if none has a known extension
+    names = [info.filename for info in archive.infolist()
+             if not info.filename.endswith('/') and
+             not info.filename.startswith('__MACOSX/') and
+             not posixpath.basename(info.filename).startswith('.')]
+    if not names:
+        raise DecompressionError('The zip file is empty.')
+    for name in names:
+        if os.path.splitext(name)[1].lower() in DATA_EXTENSIONS:
+            return name
+    return names[0]
+
+
+def _read_chunks(fileobj, chunk_size):
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _gunzip(fileobj, chunk_size):
+    decompressor = None
+    for data in _read_chunks(fileobj, chunk_size):
+        while data:
+            if decompressor is None:
+                if not b'\x1f\x8b'.startswith(data[:2]):
+                    # Trailing garbage, ignored like gunzip does
+                    return
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            # Bounded, so a small chunk can't decompress into a huge one
+            chunk = decompressor.decompress(data, chunk_size)
+            if chunk:
+                yield chunk
+            if decompressor.unused_data or getattr(decompressor, 'eof',
+                                                   False):
+                # The end of a member, others may follow
+                data = decompressor.unused_data
+                decompressor = None
+            else:
+                data = decompressor.unconsumed_tail
+    if decompressor is not None:
+        yield decompressor.flush()
+        if not getattr(decompressor, 'eof', True):
+            raise EOFError('The file is truncated.')
+
+
+def _bunzip2(fileobj, chunk_size):
+    decompressor = None
+    for data in _read_chunks(fileobj, chunk_size):
+        while data or decompressor is not None:
+            if decompressor is None:
+                if not b'BZh'.startswith(data[:3]):
+                    return
+                decompressor = bz2.BZ2Decompressor()
+            if hasattr(decompressor, 'needs_input'):
+                chunk = decompressor.decompress(data, chunk_size)
+            else:
+                # Only Python 3 can bound what is decompressed at once
+                chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+            if decompressor.unused_data or getattr(decompressor, 'eof',
+                                                   False):
+                # The end of a stream, others may follow
+                data = decompressor.unused_data
+                decompressor = None
+            elif getattr(decompressor, 'needs_input', True):
+                break
+            else:
+                data = b''
+    if decompressor is not None and not getattr(decompressor, 'eof', True):
+        raise EOFError('The file is truncated.')
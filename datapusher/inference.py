@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""Type guessing for the columns of a sample of rows.
+
+Gives the same types as ``messytables.type_guess(rows, types, strict=True)``,
+but works on one column at a time instead of one cell at a time. Each
+distinct value of a column is only tested once. The candidate types are
+tried from the heaviest to the lightest, and a column stops being tested
+against a type as soon as one of its values fails it. Common values of the
+default types are recognised with compiled regular expressions, and only the
+rest go through the type's own ``test``.
+
+"""
+import datetime
+import re
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # Timestamps aren't cached on Python 2
+    def lru_cache(maxsize):
+        return lambda function: function
+
+import dateutil.parser
+import messytables
+from messytables.dateparser import is_date
+
+_INTEGER = re.compile(r'[-+]?[0-9]{1,15}\Z')
+_DECIMAL = re.compile(
+    r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]{1,4})?\Z')
+_ISO_DATE = re.compile(
+    r'([0-9]{4})-([0-9]{2})-([0-9]{2})'
+    r'(?:[T ]([0-9]{2}):([0-9]{2})(?::([0-9]{2})(?:\.[0-9]{1,6})?)?)?\Z')
+
+
+def _not_strings(values):
+    return [value for value in values if not isinstance(value, str)]
+
+
+def _not_integers(values):
+    match = _INTEGER.match
+    return [value for value in values
+            if not (isinstance(value, str) and match(value))]
+
+
+def _not_decimals(values):
+    match = _DECIMAL.match
+    return [value for value in values
+            if not (isinstance(value, str) and match(value))]
+
+
+def _not_iso_dates(values):
+    match = _ISO_DATE.match
+    rest = []
+    for value in values:
+        if isinstance(value, str):
+            # Strings that don't look like dates are never dates
+            if not is_date(value):
+                return None
+            iso = match(value)
+            if iso:
+                try:
+                    datetime.datetime(*[int(part) for part in iso.groups()
+                                        if part is not None])
+                    continue
+                except ValueError:
+                    pass
+        rest.append(value)
+    return rest
+
+
+# For each type, a function that returns the values it can't tell are of
+# the type without calling its ``test``, or None if some of them are not
+_FAST_TESTS = {
+    messytables.StringType: _not_strings,
+    messytables.IntegerType: _not_integers,
+    messytables.DecimalType: _not_decimals,
+    messytables.DateUtilType: _not_iso_dates,
+}
+
+
+def _distinct(values):
+    try:
+        return list(dict.fromkeys(values))
+    except TypeError:
+        return values
+
+
+def column_is_of_type(values, type_):
+    """
+    Returns whether all the values of a column are of a type
+
+    :param values: The non-empty values of the column
+    :type values: list
+    :param type_: messytables type instance
+    """
+    fast_test = _FAST_TESTS.get(type(type_))
+    if fast_test is not None:
+        values = fast_test(values)
+        if values is None:
+            return False
+    test = type_.test
+    for value in values:
+        if not test(value):
+            return False
+    return True
+
+
+def type_guess(rows, width=0, types=messytables.types.TYPES):
+    """
+    Guesses the type of each column of a sample of rows
+
+    :param rows: The rows of values of the sample, without the header
+    :type rows: list of lists
+    :param width: Minimum number of columns, like the number of headers
+    :type width: int
+    :param types: messytables types to choose from
+
+    :returns: A messytables type instance for each column. Columns without
+        any value are text.
+    :rtype: list
+    """
+    if not rows:
+        return []
+    width = max([width] + [len(row) for row in rows])
+    instances = [instance for type_ in types for instance in type_.instances()]
+    # Ties are won by the first type, like in messytables
+    candidates = sorted(instances, key=lambda type_: -type_.guessing_weight)
+
+    guesses = []
+    for index in range(width):
+        values = _distinct([row[index] for row in rows
+                            if index < len(row) and row[index]])
+        guess = messytables.StringType()
+        if values:
+            for type_ in candidates:
+                if column_is_of_type(values, type_):
+                    guess = type_
+                    break
+        guesses.append(guess)
+    return guesses
+
+
+# Formats tried for timestamp columns. Only formats that dateutil reads the
+# same way are listed, so no day first or two-digit years.
+TIMESTAMP_FORMATS = [
+    '%Y-%m-%d',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y/%m/%d',
+    '%Y/%m/%d %H:%M',
+    '%Y/%m/%d %H:%M:%S',
+    '%m/%d/%Y',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y %H:%M:%S',
+    '%d %b %Y',
+    '%d %B %Y',
+    '%d-%b-%Y',
+]
+
+
+def timestamp_format(values, formats=TIMESTAMP_FORMATS):
+    """
+    Infers the strptime format of the timestamps of a column
+
+    A format is only kept if every value it can read gives the same
+    timestamp as dateutil. The one that reads the most values wins.
+
+    :param values: Values of the column
+    :type values: list
+    :returns: The format, or None if none of them fits
+    """
+    parsed = {}
+    for value in _distinct(values):
+        if isinstance(value, str) and value:
+            try:
+                parsed[value] = dateutil.parser.parse(value)
+            except (ValueError, OverflowError):
+                pass
+
+    strptime = datetime.datetime.strptime
+    best, best_count = None, 0
+    for format in formats:
+        count = 0
+        for value, timestamp in parsed.items():
+            try:
+                if strptime(value, format) != timestamp:
+                    break
+            except ValueError:
+                continue
+            count += 1
+        else:
+            if count > best_count:
+                best, best_count = format, count
+    return best
+
+
+class TimestampType(messytables.DateUtilType):
+    """
+    DateUtil type that casts timestamps with a known format
+
+    Values that don't have the format are parsed with dateutil. The results
+    for the last ``cache_size`` distinct values are cached.
+    """
+
+    def __init__(self, format=None, cache_size=10000):
+        self.format = format
+        self.cache_size = cache_size
+        strptime = datetime.datetime.strptime
+        parse = dateutil.parser.parse
+
+        if format is None:
+            def cast(value):
+                return parse(value)
+        else:
+            def cast(value):
+                try:
+                    return strptime(value, format)
+                except ValueError:
+                    return parse(value)
+        self._cast = lru_cache(maxsize=cache_size)(cast)
+
+    def cast(self, value):
+        if value in ('', None):
+            return None
+        if not isinstance(value, str):
+            return messytables.DateUtilType.cast(self, value)
+        return self._cast(value)
+
+    def __reduce__(self):
+        # Sent to the processes parsing files without its cache
+        return TimestampType, (self.format, self.cache_size)
+
+    def __repr__(self):
+        # Keep the name of the type it stands for, as in TYPE_MAPPING
+        return 'DateUtil'
+
+
+def compile_timestamps(types, rows, cache_size=10000):
+    """
+    Replaces the DateUtil types with TimestampType
+
+    :param types: Types of the columns
+    :type types: list
+    :param rows: The rows of values of the sample, to infer the formats from
+    :type rows: list of lists
+    :param cache_size: Number of cached timestamps per column
+    :type cache_size: int
+
+    :rtype: list
+    """
+    compiled = []
+    for index, type_ in enumerate(types):
+        if type(type_) is messytables.DateUtilType:
+            values = [row[index] for row in rows if index < len(row)]
+            type_ = TimestampType(timestamp_format(values), cache_size)
+        compiled.append(type_)
+    return compiled
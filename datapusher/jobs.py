@@ -2,20 +2,36 @@
 
 
 import json
+import flask
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 try:
     from urllib.parse import urlsplit
 except ImportError:
     from urlparse import urlsplit
 
+import atexit
+import collections
 import itertools
 import datetime
 import locale
 import logging
 import decimal
+import functools
 import hashlib
+import io
+import mimetypes
+import multiprocessing
+import os
+import sqlite3
 import time
 import tempfile
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import messytables
 
@@ -23,6 +39,9 @@ import ckanserviceprovider.job as job
 import ckanserviceprovider.util as util
 from ckanserviceprovider import web
 
+from datapusher import (cache, compression, inference, parsers, scheduler,
+                        state)
+
 if locale.getdefaultlocale()[0]:
     lang, encoding = locale.getdefaultlocale()
     locale.setlocale(locale.LC_ALL, locale=(lang, encoding))
@@ -30,10 +49,38 @@ else:
     locale.setlocale(locale.LC_ALL, '')
 
 MAX_CONTENT_LENGTH = web.app.config.get('MAX_CONTENT_LENGTH') or 10485760
+# Size compressed files can decompress to, MAX_CONTENT_LENGTH applying to
+# the compressed file
+MAX_DECOMPRESSED_LENGTH = (web.app.config.get('MAX_DECOMPRESSED_LENGTH') or
+                           MAX_CONTENT_LENGTH)
 CHUNK_SIZE = web.app.config.get('CHUNK_SIZE') or 16384
 CHUNK_INSERT_ROWS = web.app.config.get('CHUNK_INSERT_ROWS') or 250
+CHUNK_INSERT_WORKERS = web.app.config.get('CHUNK_INSERT_WORKERS') or 1
+CHUNK_INSERT_MIN_ROWS = web.app.config.get('CHUNK_INSERT_MIN_ROWS') or 10
+CHUNK_INSERT_MAX_ROWS = web.app.config.get('CHUNK_INSERT_MAX_ROWS') or 20000
+CHUNK_INSERT_BYTES = web.app.config.get('CHUNK_INSERT_BYTES') or 1000000
+CHUNK_INSERT_SECONDS = web.app.config.get('CHUNK_INSERT_SECONDS') or 5
+CHUNK_INSERT_STREAM = web.app.config.get('CHUNK_INSERT_STREAM', False)
+STAGE_RECORDS = web.app.config.get('STAGE_RECORDS', False)
+INCREMENTAL_PUSH = web.app.config.get('INCREMENTAL_PUSH', False)
+CONTENT_FINGERPRINT = web.app.config.get('CONTENT_FINGERPRINT', False)
 DOWNLOAD_TIMEOUT = web.app.config.get('DOWNLOAD_TIMEOUT') or 30
+STREAM_PARSE = web.app.config.get('STREAM_PARSE', False)
+# Files of at least two ranges of DOWNLOAD_RANGE_SIZE bytes are downloaded by
+# DOWNLOAD_WORKERS connections at the same time, if the server accepts ranges
+DOWNLOAD_WORKERS = web.app.config.get('DOWNLOAD_WORKERS') or 4
+DOWNLOAD_RANGE_SIZE = web.app.config.get('DOWNLOAD_RANGE_SIZE') or 4194304
 USE_PROXY = 'DOWNLOAD_PROXY' in web.app.config
+# Cache of the downloaded files (and the records they were converted to)
+# shared by the jobs, off unless DOWNLOAD_CACHE_DIR is set
+DOWNLOAD_CACHE_DIR = web.app.config.get('DOWNLOAD_CACHE_DIR')
+DOWNLOAD_CACHE_SIZE = web.app.config.get('DOWNLOAD_CACHE_SIZE') or 1073741824
+DOWNLOAD_CACHE_TTL = web.app.config.get('DOWNLOAD_CACHE_TTL') or 3600
+if DOWNLOAD_CACHE_DIR:
+    DOWNLOAD_CACHE = cache.DownloadCache(
+        DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_SIZE, DOWNLOAD_CACHE_TTL)
+else:
+    DOWNLOAD_CACHE = None
 if USE_PROXY:
     DOWNLOAD_PROXY = web.app.config.get('DOWNLOAD_PROXY')
 
@@ -45,6 +92,38 @@ else:
 if not SSL_VERIFY:
     requests.packages.urllib3.disable_warnings()
 
+# Number of push jobs running at the same time, in total and for each CKAN
+# site. The other jobs are queued without holding a thread.
+JOB_WORKERS = web.app.config.get('JOB_WORKERS') or 10
+JOB_HOST_WORKERS = web.app.config.get('JOB_HOST_WORKERS') or JOB_WORKERS
+# Files up to SMALL_FILE_SIZE are in the small lane, those from
+# LARGE_FILE_SIZE in the large one, and the others in the medium one. Each
+# lane can be limited to a number of workers, so that large files don't take
+# them all.
+SMALL_FILE_SIZE = web.app.config.get('SMALL_FILE_SIZE') or 1048576
+LARGE_FILE_SIZE = web.app.config.get('LARGE_FILE_SIZE') or 10485760
+JOB_LANE_WORKERS = {
+    scheduler.SMALL: web.app.config.get('JOB_SMALL_WORKERS') or JOB_WORKERS,
+    scheduler.MEDIUM: web.app.config.get('JOB_MEDIUM_WORKERS') or JOB_WORKERS,
+    scheduler.LARGE: web.app.config.get('JOB_LARGE_WORKERS') or JOB_WORKERS,
+}
+# Find out the size of the files CKAN doesn't know with a HEAD request, which
+# gives up sooner than the download
+SIZE_HEAD_REQUEST = web.app.config.get('SIZE_HEAD_REQUEST', True)
+SIZE_HEAD_TIMEOUT = web.app.config.get('SIZE_HEAD_TIMEOUT') or 5
+
+SCHEDULER = scheduler.JobScheduler(JOB_WORKERS, JOB_HOST_WORKERS,
+                                   JOB_LANE_WORKERS)
+# Merge the jobs submitted for a resource that already has one waiting
+COALESCE_JOBS = web.app.config.get('COALESCE_JOBS', True)
+# Push the other sheets of workbooks to DataStore tables of their own, by
+# default only the one given by GET_ROW_SET is pushed
+PUSH_SHEETS = web.app.config.get('PUSH_SHEETS', False)
+SHEET_WORKERS = web.app.config.get('SHEET_WORKERS') or 4
+
+CKAN_POOL_SIZE = web.app.config.get('CKAN_POOL_SIZE') or 10
+CKAN_MAX_RETRIES = web.app.config.get('CKAN_MAX_RETRIES', 3)
+
 _TYPE_MAPPING = {
     'String': 'text',
     # 'int' may not be big enough,
@@ -60,6 +139,30 @@ _TYPES = [messytables.StringType, messytables.DecimalType,
 TYPE_MAPPING = web.app.config.get('TYPE_MAPPING', _TYPE_MAPPING)
 TYPES = web.app.config.get('TYPES', _TYPES)
 
+_PARSERS = {
+    'messytables': parsers.messytables_tableset,
+    'csv': parsers.any_tableset,
+}
+
+PARSER = web.app.config.get('PARSER') or 'messytables'
+
+# Number of rows whose values are converted together
+ROW_BATCH_SIZE = 1000
+
+# Files read by the csv engine of at least two pieces of PARSE_RANGE_SIZE
+# bytes are parsed by PARSE_WORKERS processes, shared by all the jobs
+PARSE_WORKERS = web.app.config.get('PARSE_WORKERS') or 1
+PARSE_RANGE_SIZE = web.app.config.get('PARSE_RANGE_SIZE') or 4194304
+_PARSE_POOL = None
+_PARSE_POOL_LOCK = threading.Lock()
+
+# Number of rows used to guess the types of the columns, by default those of
+# the sample of the parser (about 1000 lines)
+TYPE_GUESS_ROWS = web.app.config.get('TYPE_GUESS_ROWS')
+
+# Number of distinct timestamps cached for each timestamp column
+TIMESTAMP_CACHE_SIZE = web.app.config.get('TIMESTAMP_CACHE_SIZE') or 10000
+
 DATASTORE_URLS = {
     'datastore_delete': '{ckan_url}/api/action/datastore_delete',
     'resource_update': '{ckan_url}/api/action/resource_update'
@@ -117,15 +220,52 @@ class HTTPError(util.JobError):
             .encode('ascii', 'replace')
 
 
-def get_url(action, ckan_url):
+def get_base_url(ckan_url):
     """
-    Get url for ckan action
+    Get the normalized base url of a ckan site
     """
     if not urlsplit(ckan_url).scheme:
         ckan_url = 'http://' + ckan_url.lstrip('/')
-    ckan_url = ckan_url.rstrip('/')
+    return ckan_url.rstrip('/')
+
+
+def get_url(action, ckan_url):
+    """
+    Get url for ckan action
+    """
     return '{ckan_url}/api/3/action/{action}'.format(
-        ckan_url=ckan_url, action=action)
+        ckan_url=get_base_url(ckan_url), action=action)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(ckan_url):
+    """
+    Get the pooled session used for the API calls to a ckan site
+
+    Sessions are shared by all the jobs run by this worker process, so
+    connections to CKAN are kept alive between requests instead of being
+    opened (and TLS handshaked) for every single one of them.
+    """
+    # Keyed by pid too, connections must not be shared with forked workers
+    key = (os.getpid(), get_base_url(ckan_url))
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            # Only failed connections are retried, a request that reached
+            # CKAN may have had effects already
+            retries = Retry(total=CKAN_MAX_RETRIES, read=False,
+                            backoff_factor=0.5)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=CKAN_POOL_SIZE,
+                                  max_retries=retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+    return session
 
 
 def check_response(response, request_url, who, good_status=(201, 200), ignore_no_success=False):
@@ -187,6 +327,379 @@ def chunky(items, num_items_per_chunk):
         chunk = next_chunk
 
 
+class AdaptiveChunker(object):
+    """
+    Breaks up records into chunks sized for the DataStore.
+
+    Each chunk holds at most ``max_bytes`` of JSON encoded records. Within
+    that budget, the number of records per chunk starts at ``rows`` and is
+    doubled while CKAN stores chunks faster than ``target_seconds``, or
+    halved when it gets slower, staying between ``min_rows`` and
+    ``max_rows``.
+    """
+
+    def __init__(self, rows, min_rows, max_rows, max_bytes, target_seconds):
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.target_seconds = target_seconds
+        self.rows = max(min_rows, min(rows, max_rows))
+        self._lock = threading.Lock()
+
+    def record(self, num_rows, seconds):
+        """
+        Adjusts the size of the next chunks to the time it took CKAN to
+        store a chunk of ``num_rows`` records.
+        """
+        with self._lock:
+            if seconds > self.target_seconds:
+                self.rows = max(self.min_rows, min(self.rows, num_rows // 2))
+            elif seconds < self.target_seconds / 2.0 and num_rows >= self.rows:
+                self.rows = min(self.max_rows, self.rows * 2)
+
+    def chunks(self, items, encoded=False):
+        """
+        Breaks up ``items`` like ``chunky`` does, with adaptive chunk sizes.
+
+        The records in the chunks are encoded with ``encode_record``, as
+        they need to be encoded to be measured anyway.
+
+        :param encoded: Whether the items are already encoded records
+        :type encoded: boolean
+
+        :returns: multiple tuples: (chunk, is_it_the_last_chunk)
+        :rtype: generator of (list, bool)
+        """
+        end = object()
+        encode = (lambda item: item) if encoded else encode_record
+        items_ = iter(items)
+        item = next(items_, end)
+        if item is not end:
+            item = encode(item)
+        while item is not end:
+            limit = self.rows
+            chunk, size = [], 0
+            while True:
+                chunk.append(item)
+                # ensure_ascii is on, so the length in characters is the
+                # size in bytes, plus one for the separator
+                size += len(item) + 1
+                item = next(items_, end)
+                if item is end:
+                    break
+                item = encode(item)
+                if (len(chunk) >= limit or
+                        size + len(item) + 1 > self.max_bytes):
+                    break
+            yield chunk, item is end
+
+
+class Checkpoints(object):
+    """
+    Counts the rows of a file that are stored in the DataStore
+
+    Chunks stored out of order only count once all the chunks before them
+    are stored too. ``save`` is called with the count every time it grows.
+
+    :param rows: The number of rows stored before the first chunk
+    :type rows: int
+    :param save: Called with the number of rows stored
+    :type save: callable
+    """
+
+    def __init__(self, rows, save):
+        self.rows = rows
+        self._save = save
+        self._next = 0
+        self._stored = {}
+
+    def sent(self, index, number):
+        """
+        Records that the chunk ``index`` of ``number`` rows was stored,
+        as reported by ``push_chunks``.
+        """
+        self._stored[index] = number
+        rows = self.rows
+        while self._next in self._stored:
+            self.rows += self._stored.pop(self._next)
+            self._next += 1
+        if self.rows != rows:
+            self._save(self.rows)
+
+
+class RecordSpool(object):
+    """
+    Records encoded into a temporary file, one per line
+
+    Iterating over the spool gives back the encoded records, ready for
+    ``AdaptiveChunker.chunks(spool, encoded=True)``.
+    """
+
+    def __init__(self, records):
+        self.count = 0
+        self._file = tempfile.TemporaryFile()
+        write = self._file.write
+        for record in records:
+            # ensure_ascii is on, so there are no newlines in the records
+            write((encode_record(record) + '\n').encode('ascii'))
+            self.count += 1
+
+    def __iter__(self):
+        self._file.seek(0)
+        for line in self._file:
+            yield line[:-1].decode('ascii')
+
+    def close(self):
+        self._file.close()
+
+
+class FingerprintEncoder(json.JSONEncoder):
+    # Encodes the same values the same way, however they were written
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        if isinstance(obj, decimal.Decimal):
+            return str(obj.normalize())
+        return json.JSONEncoder.default(self, obj)
+
+
+_fingerprint_encoder = FingerprintEncoder(separators=(',', ':'),
+                                          sort_keys=True)
+
+
+class Fingerprint(object):
+    """
+    Hash of the content of a table, as it would be stored in the DataStore
+
+    The hash covers the fields of the table and the records, in order. The
+    fields and the values of each record are hashed in the order of their
+    names, and numbers without their trailing zeros, so files that only
+    differ by their quoting, line endings or column order have the same
+    fingerprint.
+
+    :param headers: The fields of the table, as sent to datastore_create
+    :type headers: list of dicts
+    """
+
+    def __init__(self, headers):
+        self._encode = _fingerprint_encoder.encode
+        self._hash = hashlib.sha1()
+        fields = sorted([h['id'], h['type']] for h in headers)
+        self._hash.update(self._encode(fields).encode('utf-8'))
+
+    def records(self, records):
+        """
+        Yields the records unchanged, adding each one to the hash
+        """
+        update = self._hash.update
+        encode = self._encode
+        for record in records:
+            update((encode(record) + '\n').encode('utf-8'))
+            yield record
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class RowIndex(object):
+    """
+    Records staged into a temporary SQLite database, indexed by a key column
+
+    Each record is stored with its key and a hash of its values, encoded
+    like in ``Fingerprint``. Iterating over the index gives back the encoded
+    records in the order of the file, like ``RecordSpool``. Comparing it
+    with the hashes of the rows pushed last time gives the records to
+    upsert and the keys to delete.
+
+    :param records: The records of the file
+    :type records: iterable of dicts
+    :param key: Name of the key column
+    :type key: string
+    """
+
+    def __init__(self, records, key):
+        self.key = key
+        self.count = 0
+        # A private temporary database, deleted once it's closed
+        self._db = sqlite3.connect('')
+        try:
+            self._db.execute(
+                'CREATE TABLE rows (key TEXT, hash TEXT, record TEXT)')
+            encode = _fingerprint_encoder.encode
+            sha1 = hashlib.sha1
+            records = iter(records)
+            while True:
+                batch = [(encode(record.get(key)),
+                          sha1(encode(record).encode('utf-8')).hexdigest(),
+                          encode_record(record))
+                         for record in itertools.islice(records,
+                                                        ROW_BATCH_SIZE)]
+                if not batch:
+                    break
+                self._db.executemany('INSERT INTO rows VALUES (?, ?, ?)',
+                                     batch)
+                self.count += len(batch)
+            self._db.execute('CREATE INDEX rows_key ON rows (key)')
+            self._db.commit()
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        for record, in self._db.execute(
+                'SELECT record FROM rows ORDER BY rowid'):
+            yield record
+
+    def unique(self):
+        """
+        Returns whether every record has a key, and a different one
+        """
+        if self._db.execute("SELECT 1 FROM rows WHERE key = 'null' "
+                            "LIMIT 1").fetchone():
+            return False
+        return not self._db.execute('SELECT 1 FROM rows GROUP BY key '
+                                    'HAVING count(*) > 1 LIMIT 1').fetchone()
+
+    def hashes(self):
+        """
+        Yields the ``(key, hash)`` of each record, to compare the next
+        version of the file with
+        """
+        for key, hash_ in self._db.execute('SELECT key, hash FROM rows'):
+            yield key, hash_
+
+    def compare(self, previous):
+        """
+        Loads the hashes of the rows pushed last time
+
+        :param previous: ``(key, hash)`` of each row, as given by ``hashes``
+        :type previous: iterable of tuples
+        """
+        self._db.execute('CREATE TABLE previous '
+                         '(key TEXT PRIMARY KEY, hash TEXT)')
+        previous = iter(previous)
+        while True:
+            batch = list(itertools.islice(previous, ROW_BATCH_SIZE))
+            if not batch:
+                break
+            self._db.executemany('INSERT INTO previous VALUES (?, ?)', batch)
+        self._db.commit()
+
+    def changed(self):
+        """
+        Yields the encoded records that are new or changed since the rows
+        given to ``compare``
+        """
+        for record, in self._db.execute(
+                'SELECT rows.record FROM rows '
+                'LEFT JOIN previous ON previous.key = rows.key '
+                'WHERE previous.hash IS NULL OR previous.hash != rows.hash '
+                'ORDER BY rows.rowid'):
+            yield record
+
+    def deleted(self):
+        """
+        Yields the keys of the rows given to ``compare`` that are gone
+        """
+        for key, in self._db.execute(
+                'SELECT key FROM previous WHERE NOT EXISTS '
+                '(SELECT 1 FROM rows WHERE rows.key = previous.key)'):
+            yield json.loads(key)
+
+    def close(self):
+        self._db.close()
+
+
+def push_chunks(chunks, send_chunk, workers, logger, sent=None):
+    """
+    Sends chunks of records to the DataStore, overlapping the parsing of the
+    next chunks with the requests already in flight.
+
+    The first chunk is sent on its own because it creates the DataStore
+    table. The middle chunks are sent by a pool of ``workers`` threads, with
+    at most ``workers`` further chunks parsed ahead of them. The last chunk
+    is only sent once all the others have been stored, so the record count
+    CKAN calculates with it covers the whole table.
+
+    :param chunks: Chunks of records, as yielded by ``chunky``
+    :type chunks: iterable of (list, bool)
+    :param send_chunk: Called with ``(records, is_it_the_last_chunk)`` for
+        each chunk
+    :type send_chunk: callable
+    :param workers: Number of chunks that can be sent concurrently
+    :type workers: int
+    :param sent: Called with ``(index, number_of_records)`` once a chunk has
+        been stored, always from the calling thread. Chunks stored by the
+        workers may be reported out of order.
+    :type sent: callable
+
+    :returns: the number of records sent
+    :rtype: int
+    """
+    pending = queue.Queue(maxsize=workers)
+    stored = queue.Queue()
+    errors = []
+
+    def worker():
+        while True:
+            item = pending.get()
+            try:
+                if item is None:
+                    return
+                # Once a chunk has failed there is no point in sending more
+                if not errors:
+                    i, records, is_it_the_last_chunk = item
+                    send_chunk(records, is_it_the_last_chunk)
+                    stored.put((i, len(records)))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                pending.task_done()
+
+    def report():
+        while sent is not None:
+            try:
+                i, number = stored.get_nowait()
+            except queue.Empty:
+                return
+            sent(i, number)
+
+    threads = []
+    count = 0
+    try:
+        for i, (records, is_it_the_last_chunk) in enumerate(chunks):
+            report()
+            if errors:
+                break
+            count += len(records)
+            logger.info('Saving chunk {number} {is_last}'.format(
+                number=i, is_last='(last)' if is_it_the_last_chunk else ''))
+            if i == 0 or is_it_the_last_chunk:
+                pending.join()
+                if errors:
+                    break
+                send_chunk(records, is_it_the_last_chunk)
+                stored.put((i, len(records)))
+                continue
+            if not threads:
+                for _ in range(workers):
+                    thread = threading.Thread(target=worker)
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+            pending.put((i, records, is_it_the_last_chunk))
+    finally:
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+        report()
+
+    if errors:
+        raise errors[0]
+    return count
+
+
 class DatastoreEncoder(json.JSONEncoder):
     # Custon JSON encoder
     def default(self, obj):
@@ -198,16 +711,76 @@ class DatastoreEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def delete_datastore_resource(resource_id, api_key, ckan_url):
+# Conversions of the cell values json can't encode, looked up by their exact
+# type to save the isinstance checks of DatastoreEncoder on every cell
+_JSON_CONVERTERS = {
+    datetime.datetime: datetime.datetime.isoformat,
+    decimal.Decimal: str,
+}
+
+
+class RecordEncoder(DatastoreEncoder):
+    # Faster encoder for the records of a datastore_create request
+    def default(self, obj):
+        convert = _JSON_CONVERTERS.get(type(obj))
+        if convert is not None:
+            return convert(obj)
+        return DatastoreEncoder.default(self, obj)
+
+
+_record_encoder = RecordEncoder(separators=(',', ':'))
+
+
+def encode_record(record):
+    """
+    Encodes a record to be sent in a datastore_create request
+    """
+    return _record_encoder.encode(record)
+
+
+def datastore_create_body(request, records):
+    """
+    Generates the body of a datastore_create request in pieces of about
+    CHUNK_SIZE bytes, so the whole body is never held in memory.
+
+    :param request: The request parameters, except for the records
+    :type request: dict
+    :param records: The records, encoded with ``encode_record``
+    :type records: iterable of strings
+
+    :rtype: generator of bytes
+    """
+    head = json.dumps(request, cls=DatastoreEncoder)
+    pieces = [head[:-1], ', "records": [']
+    size = 0
+    for i, record in enumerate(records):
+        if i:
+            pieces.append(',')
+        pieces.append(record)
+        size += len(record)
+        if size >= CHUNK_SIZE:
+            yield ''.join(pieces).encode('utf-8')
+            pieces, size = [], 0
+    pieces.append(']}')
+    yield ''.join(pieces).encode('utf-8')
+
+
+def delete_datastore_resource(resource_id, api_key, ckan_url, filters=None):
+    """
+    Deletes a datastore table, or only its records matching ``filters``
+    """
+    request = {'id': resource_id, 'force': True}
+    if filters is not None:
+        request['filters'] = filters
     try:
         delete_url = get_url('datastore_delete', ckan_url)
-        response = requests.post(delete_url,
-                                 verify=SSL_VERIFY,
-                                 data=json.dumps({'id': resource_id,
-                                                  'force': True}),
-                                 headers={'Content-Type': 'application/json',
-                                          'Authorization': api_key}
-                                 )
+        response = get_session(ckan_url).post(
+            delete_url,
+            verify=SSL_VERIFY,
+            data=json.dumps(request, cls=DatastoreEncoder),
+            headers={'Content-Type': 'application/json',
+                     'Authorization': api_key}
+        )
         check_response(response, delete_url, 'CKAN',
                        good_status=(201, 200, 404), ignore_no_success=True)
     except requests.exceptions.RequestException:
@@ -217,13 +790,13 @@ def delete_datastore_resource(resource_id, api_key, ckan_url):
 def datastore_resource_exists(resource_id, api_key, ckan_url):
     try:
         search_url = get_url('datastore_search', ckan_url)
-        response = requests.post(search_url,
-                                 verify=SSL_VERIFY,
-                                 data=json.dumps({'id': resource_id,
-                                         'limit': 0}),
-                                 headers={'Content-Type': 'application/json',
-                                          'Authorization': api_key}
-                                 )
+        response = get_session(ckan_url).post(
+            search_url,
+            verify=SSL_VERIFY,
+            data=json.dumps({'id': resource_id, 'limit': 0}),
+            headers={'Content-Type': 'application/json',
+                     'Authorization': api_key}
+        )
         if response.status_code == 404:
             return False
         elif response.status_code == 200:
@@ -239,23 +812,73 @@ def datastore_resource_exists(resource_id, api_key, ckan_url):
 
 
 def send_resource_to_datastore(resource, headers, records,
-                               is_it_the_last_chunk, api_key, ckan_url):
+                               is_it_the_last_chunk, api_key, ckan_url,
+                               encoded=False, primary_key=None):
     """
     Stores records in CKAN datastore
+
+    :param encoded: Whether the records are already encoded with
+        ``encode_record``
+    :type encoded: boolean
+    :param primary_key: Name of the key column of the table, if any
+    :type primary_key: string
     """
     request = {'resource_id': resource['id'],
                'fields': headers,
                'force': True,
-               'records': records,
                'calculate_record_count': is_it_the_last_chunk}
+    if primary_key:
+        request['primary_key'] = primary_key
+    if not encoded:
+        records = [encode_record(record) for record in records]
+
+    data = datastore_create_body(request, records)
+    if not CHUNK_INSERT_STREAM:
+        data = b''.join(data)
 
     url = get_url('datastore_create', ckan_url)
-    r = requests.post(url,
-                      verify=SSL_VERIFY,
-                      data=json.dumps(request, cls=DatastoreEncoder),
-                      headers={'Content-Type': 'application/json',
-                               'Authorization': api_key}
-                      )
+    r = get_session(ckan_url).post(
+        url,
+        verify=SSL_VERIFY,
+        data=data,
+        headers={'Content-Type': 'application/json',
+                 'Authorization': api_key}
+    )
+    check_response(r, url, 'CKAN DataStore')
+
+
+def upsert_resource_to_datastore(resource, records, is_it_the_last_chunk,
+                                 api_key, ckan_url, method='insert',
+                                 encoded=False):
+    """
+    Adds records to an existing table of the CKAN datastore
+
+    :param method: The ``datastore_upsert`` method, ``insert``, ``update``
+        or ``upsert``
+    :type method: string
+    :param encoded: Whether the records are already encoded with
+        ``encode_record``
+    :type encoded: boolean
+    """
+    request = {'resource_id': resource['id'],
+               'method': method,
+               'force': True,
+               'calculate_record_count': is_it_the_last_chunk}
+    if not encoded:
+        records = [encode_record(record) for record in records]
+
+    data = datastore_create_body(request, records)
+    if not CHUNK_INSERT_STREAM:
+        data = b''.join(data)
+
+    url = get_url('datastore_upsert', ckan_url)
+    r = get_session(ckan_url).post(
+        url,
+        verify=SSL_VERIFY,
+        data=data,
+        headers={'Content-Type': 'application/json',
+                 'Authorization': api_key}
+    )
     check_response(r, url, 'CKAN DataStore')
 
 
@@ -267,7 +890,7 @@ def update_resource(resource, api_key, ckan_url):
     resource['url_type'] = 'datapusher'
 
     url = get_url('resource_update', ckan_url)
-    r = requests.post(
+    r = get_session(ckan_url).post(
         url,
         verify=SSL_VERIFY,
         data=json.dumps(resource),
@@ -278,17 +901,47 @@ def update_resource(resource, api_key, ckan_url):
     check_response(r, url, 'CKAN')
 
 
+def create_sheet_resource(resource, sheet, headers, api_key, ckan_url):
+    """
+    Creates the resource and DataStore table of a sheet of the file of a
+    resource, in the same dataset
+
+    :returns: The id of the new resource
+    :rtype: string
+    """
+    request = {'resource': {
+                   'package_id': resource['package_id'],
+                   'name': u'{name} - {sheet}'.format(
+                       name=resource.get('name') or resource['id'],
+                       sheet=sheet)},
+               'fields': headers,
+               'force': True}
+
+    url = get_url('datastore_create', ckan_url)
+    r = get_session(ckan_url).post(
+        url,
+        verify=SSL_VERIFY,
+        data=json.dumps(request),
+        headers={'Content-Type': 'application/json',
+                 'Authorization': api_key}
+    )
+    check_response(r, url, 'CKAN DataStore')
+
+    return r.json()['result']['resource_id']
+
+
 def get_resource(resource_id, ckan_url, api_key):
     """
     Gets available information about the resource from CKAN
     """
     url = get_url('resource_show', ckan_url)
-    r = requests.post(url,
-                      verify=SSL_VERIFY,
-                      data=json.dumps({'id': resource_id}),
-                      headers={'Content-Type': 'application/json',
-                               'Authorization': api_key}
-                      )
+    r = get_session(ckan_url).post(
+        url,
+        verify=SSL_VERIFY,
+        data=json.dumps({'id': resource_id}),
+        headers={'Content-Type': 'application/json',
+                 'Authorization': api_key}
+    )
     check_response(r, url, 'CKAN')
 
     return r.json()['result']
@@ -301,6 +954,1033 @@ def get_data_response(url, **kwargs):
     return response
 
 
+# Formats that are parsed while they're being downloaded if STREAM_PARSE is on
+STREAM_PARSE_FORMATS = ('csv', 'tsv', 'text/csv', 'application/csv',
+                        'text/comma-separated-values',
+                        'text/tab-separated-values')
+
+
+class DownloadSpool(object):
+    """
+    File-like object for a file that is still being downloaded
+
+    A thread writes the chunks of the response to a temporary file, hashing
+    and counting them on the way, while reads block until the bytes they ask
+    for have arrived. This lets messytables sample and parse the start of the
+    file while the rest of it is being downloaded.
+    """
+
+    def __init__(self, chunks, max_length, url=None):
+        self.url = url
+        self.length = 0
+        self.position = 0
+        self.finished = False
+        self.closed = False
+        self.error = None
+        self._tmp = tempfile.TemporaryFile()
+        self._md5 = hashlib.md5()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._download,
+                                        args=(chunks, max_length))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _download(self, chunks, max_length):
+        try:
+            for chunk in chunks:
+                with self._condition:
+                    if self.closed:
+                        return
+                    if self.length + len(chunk) > max_length:
+                        raise util.JobError(
+                            'Resource too large to process: {cl} > max '
+                            '({max_cl}).'.format(cl=self.length + len(chunk),
+                                                 max_cl=max_length))
+                    self._tmp.seek(self.length)
+                    self._tmp.write(chunk)
+                    self._md5.update(chunk)
+                    self.length += len(chunk)
+                    self._condition.notify_all()
+        except requests.RequestException as e:
+            self.error = HTTPError(message=str(e), status_code=None,
+                                   request_url=self.url, response=None)
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._condition:
+                self.finished = True
+                self._condition.notify_all()
+
+    def _wait_for(self, end):
+        # Called with the condition held
+        while not self.finished and (end is None or self.length < end):
+            self._condition.wait()
+        if self.error is not None:
+            raise self.error
+
+    def read(self, size=-1):
+        with self._condition:
+            if size is None or size < 0:
+                self._wait_for(None)
+            else:
+                self._wait_for(self.position + size)
+            available = self.length - self.position
+            if size is None or size < 0 or size > available:
+                size = available
+            self._tmp.seek(self.position)
+            data = self._tmp.read(size)
+            self.position += len(data)
+            return data
+
+    def seek(self, offset, whence=0):
+        with self._condition:
+            if whence == 1:
+                offset += self.position
+            elif whence == 2:
+                self._wait_for(None)
+                offset += self.length
+            self.position = offset
+            return self.position
+
+    def tell(self):
+        return self.position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def wait(self):
+        """
+        Waits for the download to finish and returns the md5 of the file
+
+        Raises the error that stopped the download, if any.
+        """
+        with self._condition:
+            self._wait_for(None)
+            return self._md5.hexdigest()
+
+    def close(self):
+        """
+        Stops the download and removes the temporary file
+        """
+        with self._condition:
+            self.closed = True
+            self._tmp.close()
+
+
+def _repair_mojibake(value):
+    # Text that was UTF-8 but got decoded as latin-1
+    try:
+        return value.encode('latin-1').decode('utf-8')
+    except (UnicodeDecodeError, UnicodeEncodeError):
+        return value
+
+
+def _is_ascii(value):
+    try:
+        value.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def detect_mojibake(rows, width):
+    """
+    Decides which columns have text that needs its mojibake repaired
+
+    A column needs repair if all the non ASCII text in it, in ``rows``, is
+    UTF-8 that got decoded as latin-1. Columns with no non ASCII text in the
+    sample are repaired if any other column is.
+
+    :param rows: A sample of rows of cells, eg ``row_set.sample``
+    :param width: Number of columns
+    :type width: int
+
+    :returns: whether to repair each column
+    :rtype: list of bools
+    """
+    repairable = [None] * width
+    for row in rows:
+        for index, cell in enumerate(row[:width]):
+            value = cell.value
+            if (repairable[index] is False or not isinstance(value, str) or
+                    _is_ascii(value)):
+                continue
+            try:
+                value.encode('latin-1').decode('utf-8')
+                repairable[index] = True
+            except (UnicodeDecodeError, UnicodeEncodeError):
+                repairable[index] = False
+    in_file = True in repairable
+    return [in_file if r is None else r for r in repairable]
+
+
+def column_converter(type_, repair=True):
+    """
+    Returns a function that converts the values of a column to ``type_``
+
+    Like with messytables' ``types_processor``, values that can't be cast
+    are left as they are.
+
+    :param repair: Whether to repair the mojibake of text values
+    :type repair: boolean
+    """
+    cast = type_.cast
+    fix = _repair_mojibake if repair else lambda value: value
+
+    if isinstance(type_, messytables.StringType):
+        def convert(value):
+            if isinstance(value, str):
+                return fix(value)
+            return cast(value)
+    else:
+        def convert(value):
+            try:
+                return cast(value)
+            except Exception:
+                if isinstance(value, str):
+                    return fix(value)
+                return value
+    return convert
+
+
+def batch_converter(type_, repair=True, text_only=False):
+    """
+    Returns a function that converts a batch of values of a column
+
+    Decimal columns of text-only files are cast with a single list
+    comprehension, falling back to converting the values one at a time if
+    any of them can't be cast. Other columns are converted by
+    ``column_converter``.
+
+    :param text_only: Whether all the values are strings or None
+    :type text_only: boolean
+    """
+    convert = column_converter(type_, repair)
+    if text_only and type(type_) is messytables.DecimalType:
+        Decimal = decimal.Decimal
+
+        def convert_batch(values):
+            try:
+                return [Decimal(value) if value else None
+                        for value in values]
+            except Exception:
+                return [convert(value) for value in values]
+    else:
+        def convert_batch(values):
+            return [convert(value) for value in values]
+    return convert_batch
+
+
+def row_values(row_set, offset):
+    """
+    Yields the values of the rows of a row set that come after the header
+
+    :param row_set: messytables row set, or one of ``datapusher.parsers``
+    :param offset: Index of the header row, as given by
+        ``messytables.headers_guess``
+    :type offset: int
+
+    :rtype: generator of lists
+    """
+    if isinstance(row_set, (parsers.CSVRowSet, parsers.XLSXRowSet,
+                            parsers.XLSRowSet)):
+        rows = row_set.values()
+    else:
+        rows = ([cell.value for cell in row] for row in row_set.raw())
+    return itertools.islice(rows, offset + 1, None)
+
+
+def row_iterator(row_set, headers, types, offset, repair=None, rows=None,
+                 text_only=None):
+    """
+    Yields the rows of a row set as records to send to the DataStore
+
+    The position, name and conversion of each column are worked out once
+    from ``headers`` and ``types``. Rows are then read in batches of
+    ``ROW_BATCH_SIZE`` and converted column by column. Columns without a
+    name are left out.
+
+    :param row_set: messytables row set, or one of the ``csv`` engine
+    :param headers: Names of the columns, in the order of the cells
+    :type headers: list of strings
+    :param types: messytables types of the columns
+    :type types: list
+    :param offset: Index of the header row, as given by
+        ``messytables.headers_guess``
+    :type offset: int
+    :param repair: Whether to repair the mojibake of each column, as given
+        by ``detect_mojibake``. All of them are repaired by default.
+    :type repair: list of bools
+    :param rows: The rows of values to convert, if some of them have
+        already been read from ``row_set``. By default, all the rows after
+        the header.
+    :type rows: iterator of lists
+    :param text_only: Whether all the values are strings or None. By
+        default, whether ``row_set`` is a CSV row set.
+    :type text_only: boolean
+
+    :rtype: generator of dicts
+    """
+    width = len(headers)
+    if repair is None:
+        repair = [True] * width
+    if text_only is None:
+        # Text in CSV files is never anything else than text
+        text_only = isinstance(row_set, (messytables.CSVRowSet,
+                                         parsers.CSVRowSet))
+
+    columns = {}
+    for index, (header, type_) in enumerate(zip(headers, types)):
+        name = header.strip()
+        if not name:
+            continue
+        if (text_only and not repair[index] and
+                isinstance(type_, messytables.StringType)):
+            convert = None
+        else:
+            convert = batch_converter(type_, repair[index], text_only)
+        # For duplicated names, the last column wins
+        columns[name] = (index, convert)
+    columns = sorted(columns.items(), key=lambda item: item[1][0])
+    names = [name for name, (index, convert) in columns]
+
+    if rows is None:
+        rows = row_values(row_set, offset)
+
+    while True:
+        batch = list(itertools.islice(rows, ROW_BATCH_SIZE))
+        if not batch:
+            break
+        if not names:
+            for row in batch:
+                yield {}
+            continue
+        for row in batch:
+            if len(row) < width:
+                row.extend([None] * (width - len(row)))
+        values = list(zip(*batch))
+        values = [values[index] if convert is None
+                  else convert(values[index])
+                  for name, (index, convert) in columns]
+        for record in zip(*values):
+            yield dict(zip(names, record))
+
+
+def parse_pool():
+    """
+    Returns the pool of the processes parsing files, started on first use
+
+    The processes are started by a fork server, or spawned where there is
+    none, rather than forked from this process, whose other threads may be
+    holding locks the processes would never see released.
+    """
+    global _PARSE_POOL
+    with _PARSE_POOL_LOCK:
+        if _PARSE_POOL is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                'forkserver' if 'forkserver' in methods else 'spawn')
+            _PARSE_POOL = context.Pool(PARSE_WORKERS)
+        return _PARSE_POOL
+
+
+@atexit.register
+def close_parse_pool():
+    """
+    Stops the processes parsing files, if they were started
+    """
+    global _PARSE_POOL
+    with _PARSE_POOL_LOCK:
+        if _PARSE_POOL is not None:
+            _PARSE_POOL.terminate()
+            _PARSE_POOL.join()
+            _PARSE_POOL = None
+
+
+def parallel_pieces(fileobj, row_set):
+    """
+    Returns where the pieces of a file parsed by ``parallel_row_iterator``
+    end, or None if it's parsed in the job
+
+    Only complete files read by the ``csv`` engine that are large enough
+    are parsed in pieces, so that the processes have something to do, and
+    only if the ends of their rows can be found (see
+    ``parsers.CSVRowSet.split``).
+
+    :rtype: list of ints
+    """
+    if (PARSE_WORKERS < 2 or isinstance(fileobj, DownloadSpool) or
+            not isinstance(row_set, parsers.CSVRowSet)):
+        return None
+    try:
+        size = os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, EnvironmentError, io.UnsupportedOperation):
+        return None
+    if size < 2 * PARSE_RANGE_SIZE:
+        return None
+    return row_set.split(PARSE_RANGE_SIZE)
+
+
+def convert_piece(data, encoding, options, headers, types, repair):
+    """
+    Parses a piece of a delimited file and converts its rows to records
+
+    Run in the processes of ``parse_pool``.
+
+    :returns: The records of all the rows of the piece
+    :rtype: list of dicts
+    """
+    rows = iter(parsers.read_values(data, encoding, options))
+    return list(row_iterator(None, headers, types, None, repair, rows,
+                             text_only=True))
+
+
+def parallel_row_iterator(row_set, ends, headers, types, offset,
+                          repair=None):
+    """
+    Yields the rows of a row set as records, like ``row_iterator``, but
+    parsed and converted by the processes of ``parse_pool``
+
+    The file is read in pieces that end at the end of rows, each converted
+    by a process with the headers and types guessed from the sample. At
+    most two pieces per process are converted ahead of the records yielded,
+    which come in the order of the file.
+
+    :param row_set: A ``parsers.CSVRowSet``
+    :param ends: Where the pieces end, as given by ``parallel_pieces``
+    :type ends: list of ints
+    :param offset: Index of the header row, as given by
+        ``messytables.headers_guess``
+    :type offset: int
+
+    :rtype: generator of dicts
+    """
+    pool = parse_pool()
+    options = row_set.options()
+    pending = collections.deque()
+
+    def records():
+        for data in row_set.pieces(ends):
+            pending.append(pool.apply_async(convert_piece, (
+                data, row_set.encoding, options, headers, types, repair)))
+            if len(pending) > 2 * PARSE_WORKERS:
+                for record in pending.popleft().get():
+                    yield record
+        while pending:
+            for record in pending.popleft().get():
+                yield record
+
+    # The first piece starts with the rows up to the header
+    return itertools.islice(records(), offset + 1, None)
+
+
+def guess_fields(row_set, existing_info, logger):
+    """
+    Guesses the header row and the column types of a row set, and registers
+    the processors that skip the rows up to the header
+
+    :param existing_info: The data dictionary of the existing DataStore
+        table, by column name, for the types the user requested
+    :type existing_info: dict
+
+    :returns: The headers, their types, the index of the header row, the
+        columns to repair (see ``detect_mojibake``) and the rows of values
+        after the header
+    :rtype: tuple
+    """
+    offset, headers = messytables.headers_guess(row_set.sample)
+
+    # Some headers might have been converted from strings to floats and such.
+    headers = [str(header) for header in headers]
+
+    row_set.register_processor(messytables.headers_processor(headers))
+    row_set.register_processor(messytables.offset_processor(offset + 1))
+    if TYPE_GUESS_ROWS:
+        rows = row_values(row_set, offset)
+        sample = list(itertools.islice(rows, TYPE_GUESS_ROWS))
+        rows = itertools.chain(sample, rows)
+    else:
+        rows = None
+        sample = [[cell.value for cell in row] for row in row_set.sample]
+    types = inference.type_guess(sample, len(headers), types=TYPES)
+
+    # override with types user requested
+    if existing_info:
+        types = [{
+            'text': messytables.StringType(),
+            'numeric': messytables.DecimalType(),
+            'timestamp': messytables.DateUtilType(),
+            }.get(existing_info.get(h, {}).get('type_override'), t)
+            for t, h in zip(types, headers)]
+
+    # Cast timestamps with the format of their column
+    types = inference.compile_timestamps(types, sample, TIMESTAMP_CACHE_SIZE)
+    timestamp_formats = dict(
+        (h, t.format) for t, h in zip(types, headers)
+        if isinstance(t, inference.TimestampType) and t.format)
+    if timestamp_formats:
+        logger.info('Determined timestamp formats: {formats}'.format(
+            formats=timestamp_formats))
+
+    repair = detect_mojibake(row_set.sample, len(headers))
+    if True in repair:
+        logger.info('Repairing mojibake in columns: {columns}'.format(
+            columns=[h for h, r in zip(headers, repair) if r]))
+    if rows is None:
+        rows = row_values(row_set, offset)
+    return headers, types, offset, repair, rows
+
+
+def field_dicts(headers, types, existing_info):
+    """
+    Returns the fields of the DataStore table of the columns of a file
+
+    :param headers: The headers, as given by ``guess_fields``
+    :type headers: list of strings
+    :param existing_info: The data dictionary of the existing DataStore
+        table, by column name
+    :type existing_info: dict
+
+    :rtype: list of dicts
+    """
+    headers = [header.strip() for header in headers if header.strip()]
+    fields = [dict(id=field[0], type=TYPE_MAPPING[str(field[1])])
+              for field in zip(headers, types)]
+
+    # Maintain data dictionaries from matching column names
+    if existing_info:
+        for h in fields:
+            if h['id'] in existing_info:
+                h['info'] = existing_info[h['id']]
+                # create columns with types user requested
+                type_override = existing_info[h['id']].get('type_override')
+                if type_override in list(_TYPE_MAPPING.values()):
+                    h['type'] = type_override
+    return fields
+
+
+def job_sheets(table_set, row_set, data):
+    """
+    Returns the row sets of the sheets to push besides ``row_set``, the one
+    pushed to the resource itself
+
+    :param data: The metadata of the job, whose ``sheets`` is true for all
+        the sheets of the workbook or a list of sheet names, ``PUSH_SHEETS``
+        by default
+    :type data: dict
+
+    :rtype: list
+    """
+    sheets = data.get('sheets', PUSH_SHEETS)
+    if not sheets:
+        return []
+    row_sets = [table for table in table_set.tables if table is not row_set]
+    if sheets is not True:
+        row_sets = [table for table in row_sets if table.name in sheets]
+    return row_sets
+
+
+def push_sheet(row_set, resource, sheet_resource_id, api_key, ckan_url,
+               logger):
+    """
+    Pushes a sheet of a workbook to a DataStore table of its own
+
+    The table is replaced with the rows of the sheet, or created along with
+    its resource if there is none yet.
+
+    :param row_set: The row set of the sheet
+    :param resource: The resource of the workbook
+    :type resource: dict
+    :param sheet_resource_id: The resource the sheet was pushed to last time
+    :type sheet_resource_id: string
+
+    :returns: The id of the resource of the sheet, and the number of records
+        pushed
+    :rtype: tuple
+    """
+    existing = None
+    if sheet_resource_id:
+        existing = datastore_resource_exists(sheet_resource_id, api_key,
+                                             ckan_url)
+    existing_info = None
+    if existing:
+        existing_info = dict((f['id'], f['info'])
+            for f in existing.get('fields', []) if 'info' in f)
+
+    columns, types, offset, repair, rows = guess_fields(row_set,
+                                                        existing_info, logger)
+    headers = field_dicts(columns, types, existing_info)
+    if existing:
+        delete_datastore_resource(sheet_resource_id, api_key, ckan_url)
+    else:
+        sheet_resource_id = create_sheet_resource(
+            resource, row_set.name, headers, api_key, ckan_url)
+    sheet_resource = {'id': sheet_resource_id}
+
+    chunker = AdaptiveChunker(CHUNK_INSERT_ROWS, CHUNK_INSERT_MIN_ROWS,
+                              CHUNK_INSERT_MAX_ROWS, CHUNK_INSERT_BYTES,
+                              CHUNK_INSERT_SECONDS)
+
+    def send_chunk(records, is_it_the_last_chunk):
+        start = time.time()
+        send_resource_to_datastore(sheet_resource, headers, records,
+                                   is_it_the_last_chunk, api_key, ckan_url,
+                                   encoded=True)
+        chunker.record(len(records), time.time() - start)
+
+    logger.info('Pushing sheet "{sheet}" to "{res_id}".'.format(
+        sheet=row_set.name, res_id=sheet_resource_id))
+    records = row_iterator(row_set, columns, types, offset, repair, rows)
+    count = push_chunks(chunker.chunks(records), send_chunk,
+                        CHUNK_INSERT_WORKERS, logger)
+    logger.info('Successfully pushed {n} entries of sheet "{sheet}" to '
+                '"{res_id}".'.format(n=count, sheet=row_set.name,
+                                     res_id=sheet_resource_id))
+    return sheet_resource_id, count
+
+
+class RelayedLogger(object):
+    """
+    Logger for the threads of a job, whose messages are logged to the job's
+    logger by the job's thread when it calls ``relay``
+
+    The log of a job can only be stored from the job's own thread.
+
+    :param logger: The logger of the job
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self._messages = queue.Queue()
+
+    def log(self, level, msg, *args):
+        self._messages.put((level, msg, args))
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
+
+    def relay(self):
+        """
+        Logs the messages logged so far to the job's logger
+        """
+        while True:
+            try:
+                level, msg, args = self._messages.get_nowait()
+            except queue.Empty:
+                return
+            self.logger.log(level, msg, *args)
+
+
+class SheetPushes(object):
+    """
+    Pushes sheets of a workbook at the same time, in threads
+
+    :param push: Called with the row set of each sheet and a logger, a
+        ``RelayedLogger`` of ``logger``
+    :type push: callable
+    :param row_sets: The row sets of the sheets
+    :type row_sets: list
+    :param workers: Number of sheets pushed at the same time
+    :type workers: int
+    :param logger: The logger of the job, which the threads log to as
+        ``wait`` relays their messages
+    """
+
+    def __init__(self, push, row_sets, workers, logger):
+        self.results = {}
+        self._push = push
+        self._logger = RelayedLogger(logger)
+        self._errors = []
+        self._pending = queue.Queue()
+        for row_set in row_sets:
+            self._pending.put(row_set)
+        self._threads = []
+        for _ in range(min(workers, len(row_sets))):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while not self._errors:
+            try:
+                row_set = self._pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.results[row_set.name] = self._push(row_set,
+                                                        self._logger)
+            except Exception as e:
+                self._logger.error('Pushing sheet "{sheet}" failed: '
+                                   '{error}'.format(sheet=row_set.name,
+                                                    error=e))
+                self._errors.append(e)
+
+    def wait(self):
+        """
+        Waits for the sheets to be pushed
+
+        :returns: What ``push`` returned for each sheet, by sheet name. Once
+            the sheets are pushed or have failed, it's in ``results`` too.
+        :rtype: dict
+        """
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(0.1)
+                self._logger.relay()
+        self._logger.relay()
+        if self._errors:
+            raise self._errors[0]
+        return self.results
+
+
+def appended_to(fileobj, length, file_hash):
+    """
+    Returns whether a file starts with a previous version of itself
+
+    That is, whether its first ``length`` bytes have the md5 ``file_hash``,
+    end with a line break and are followed by more bytes. The position of
+    ``fileobj`` is left as it was.
+
+    :param length: The size of the previous version
+    :type length: int
+    :param file_hash: The md5 of the previous version
+    :type file_hash: string
+    """
+    position = fileobj.tell()
+    fileobj.seek(0)
+    m = hashlib.md5()
+    remaining = length
+    last = b''
+    while remaining > 0:
+        chunk = fileobj.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        m.update(chunk)
+        remaining -= len(chunk)
+        last = chunk[-1:]
+    longer = bool(fileobj.read(1))
+    fileobj.seek(position)
+    return (remaining == 0 and longer and last in (b'\n', b'\r') and
+            m.hexdigest() == file_hash)
+
+
+def unconditional_headers(request_kwargs):
+    '''Returns the headers of a request without its validators.'''
+    headers = dict(request_kwargs.get('headers') or {})
+    headers.pop('If-None-Match', None)
+    headers.pop('If-Modified-Since', None)
+    return headers
+
+
+class RangeDownloadError(Exception):
+    '''A range of a file couldn't be downloaded as requested.'''
+    pass
+
+
+def download_ranges(response, length, ranges, request_kwargs):
+    '''Downloads a file in byte ranges at the same time, to a temporary file.
+
+    The first range is read from ``response``, the others are requested
+    with a ``Range`` header by a thread each. ``If-Range`` makes the server
+    send the whole file rather than a range if the file has changed since
+    ``response``, which is then an error.
+
+    :param length: The size of the file
+    :type length: int
+    :param ranges: Number of ranges
+    :type ranges: int
+    :param request_kwargs: The arguments ``response`` was requested with
+    :type request_kwargs: dict
+
+    :raises RangeDownloadError: if a range wasn't sent as requested
+    :returns: The file, at its start
+    '''
+    tmp = tempfile.TemporaryFile()
+    tmp.truncate(length)
+    lock = threading.Lock()
+    errors = []
+    size = -(-length // ranges)
+
+    headers = unconditional_headers(request_kwargs)
+    # The ranges are bytes of the file itself
+    headers['Accept-Encoding'] = 'identity'
+    validator = (response.headers.get('etag') or
+                 response.headers.get('last-modified'))
+    if validator:
+        headers['If-Range'] = validator
+
+    def download_range(start, end):
+        if start == 0:
+            range_response = response
+        else:
+            range_headers = dict(headers)
+            range_headers['Range'] = 'bytes={0}-{1}'.format(start, end - 1)
+            range_response = get_data_response(
+                response.url, **dict(request_kwargs, headers=range_headers))
+        position = start
+        try:
+            if range_response is not response and (
+                    range_response.status_code != 206 or
+                    not range_response.headers.get('content-range', '')
+                    .startswith('bytes {0}-'.format(start))):
+                raise RangeDownloadError(
+                    'Range {0}-{1} not sent: {2}'.format(
+                        start, end - 1, range_response.status_code))
+            for chunk in range_response.iter_content(CHUNK_SIZE):
+                if errors:
+                    # Another range failed, the file is downloaded again
+                    break
+                chunk = chunk[:end - position]
+                with lock:
+                    tmp.seek(position)
+                    tmp.write(chunk)
+                position += len(chunk)
+                if position >= end:
+                    break
+        finally:
+            range_response.close()
+        if position != end:
+            raise RangeDownloadError(
+                'Range {0}-{1} ended at {2}'.format(start, end - 1, position))
+
+    def worker(start, end):
+        try:
+            download_range(start, end)
+        except Exception as e:
+            errors.append(e)
+
+    threads = []
+    for start in range(0, length, size):
+        thread = threading.Thread(target=worker,
+                                  args=(start, min(start + size, length)))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        tmp.close()
+        raise errors[0]
+    tmp.seek(0)
+    return tmp
+
+
+def range_count(response):
+    '''Returns the number of ranges to download the file of a response in.
+
+    That is 1 unless the server accepts ranges and the file is large enough.
+
+    '''
+    if (DOWNLOAD_WORKERS < 2 or
+            response.headers.get('accept-ranges', '').lower() != 'bytes' or
+            response.headers.get('content-encoding', 'identity').lower() !=
+            'identity'):
+        return 1
+    try:
+        length = int(response.headers.get('content-length'))
+    except (TypeError, ValueError):
+        return 1
+    return max(1, min(DOWNLOAD_WORKERS, length // DOWNLOAD_RANGE_SIZE))
+
+
+def download_file(response, format, url, request_kwargs=None):
+    '''Downloads the file of a response to a temporary file.
+
+    Files that can be parsed while they're downloaded (see ``STREAM_PARSE``)
+    are downloaded by a ``DownloadSpool`` in the background instead, and
+    their hash and length are only known once it's done. Large files are
+    downloaded in ranges at the same time if the server accepts it (see
+    ``download_ranges``), or else as a single stream.
+
+    :param format: The format of the resource
+    :type format: string
+    :param request_kwargs: The arguments ``response`` was requested with,
+        for the requests of the ranges
+    :type request_kwargs: dict
+
+    :returns: The file, its md5 hex digest and its length
+    :rtype: tuple
+    '''
+    cl = response.headers.get('content-length')
+    try:
+        if cl and int(cl) > MAX_CONTENT_LENGTH:
+            raise util.JobError(
+                'Resource too large to download: {cl} > max ({max_cl}).'
+                .format(cl=cl, max_cl=MAX_CONTENT_LENGTH))
+    except ValueError:
+        pass
+
+    ct = response.headers.get('content-type', '').split(';', 1)[0]
+
+    if STREAM_PARSE and (
+            ct in STREAM_PARSE_FORMATS or
+            (format or '').lower() in STREAM_PARSE_FORMATS):
+        # Parse the file while it's being downloaded, the hash is only
+        # known once the download is complete
+        tmp = DownloadSpool(response.iter_content(CHUNK_SIZE),
+                            MAX_CONTENT_LENGTH, url)
+        return tmp, None, None
+
+    ranges = range_count(response) if request_kwargs is not None else 1
+    if ranges > 1:
+        length = int(response.headers['content-length'])
+        try:
+            tmp = download_ranges(response, length, ranges, request_kwargs)
+        except (RangeDownloadError, requests.RequestException):
+            # Download it again as a single stream
+            response = get_data_response(url, **dict(
+                request_kwargs, headers=unconditional_headers(request_kwargs)))
+            response.raise_for_status()
+        else:
+            # The md5 of the bytes in order
+            m = hashlib.md5()
+            for chunk in iter(lambda: tmp.read(CHUNK_SIZE), b''):
+                m.update(chunk)
+            tmp.seek(0)
+            return tmp, m.hexdigest(), length
+
+    tmp = tempfile.TemporaryFile()
+    length = 0
+    m = hashlib.md5()
+    for chunk in response.iter_content(CHUNK_SIZE):
+        length += len(chunk)
+        if length > MAX_CONTENT_LENGTH:
+            raise util.JobError(
+                'Resource too large to process: {cl} > max ({max_cl}).'
+                .format(cl=length, max_cl=MAX_CONTENT_LENGTH))
+        tmp.write(chunk)
+        m.update(chunk)
+    tmp.seek(0)
+    return tmp, m.hexdigest(), length
+
+
+def store_validators(ckan_url, resource_id, url, headers):
+    """
+    Stores the validators (ETag and Last-Modified headers) of the resource
+    file that has just been pushed, for the next job to send a conditional
+    request and skip the download if it hasn't changed
+
+    :param headers: The headers of the response the file came with
+    :type headers: dict-like
+    """
+    validators = {'url': url,
+                  'etag': headers.get('etag'),
+                  'last_modified': headers.get('last-modified')}
+    if validators['etag'] or validators['last_modified']:
+        state.set_state(get_base_url(ckan_url), resource_id, 'validators',
+                        validators)
+    else:
+        state.delete_state(get_base_url(ckan_url), resource_id, 'validators')
+
+
+def init_scheduler():
+    '''Sets up the apscheduler executor that ends the jobs once a worker has
+    pushed their resource.
+
+    To be called once ckanserviceprovider has been initialised.
+
+    '''
+    scheduler.init_executor(web.scheduler, JOB_WORKERS)
+
+
+def merge_metadata(waiting, merged):
+    '''Returns the metadata of a waiting job with a newer job merged into it.
+
+    The newer values win, but the job ignores the hash of the file or sets
+    the url type of the resource if either of them did.
+
+    '''
+    metadata = dict(waiting)
+    metadata.update(merged)
+    for flag in ('ignore_hash', 'set_url_type'):
+        if waiting.get(flag) or merged.get(flag):
+            metadata[flag] = True
+    return metadata
+
+
+COALESCER = scheduler.JobCoalescer(merge_metadata)
+
+
+@web.app.route('/scheduler', methods=['GET'])
+def scheduler_status():
+    '''Show the number of push jobs running and waiting for a worker.'''
+    stats = SCHEDULER.stats()
+    stats['resources'] = COALESCER.stats()
+    return flask.jsonify(stats)
+
+
+def file_request(resource, ckan_url, api_key):
+    '''Returns the URL the data file of a resource is fetched from, and the
+    headers of the request.'''
+    url = resource.get('url')
+    headers = {}
+    if resource.get('url_type') == 'upload':
+        # if it's a local upload, check if we need to use an internal host
+        # instead of the public one on the resource url
+        if ckan_url and url[:url.index('/dataset')] != ckan_url.rstrip('/'):
+            url = ckan_url.rstrip('/') + url[url.index('/dataset'):]
+        # If this is an uploaded file to CKAN, authenticate the request,
+        # otherwise we won't get file from private resources
+        headers['Authorization'] = api_key
+    return url, headers
+
+
+def resource_size(resource, ckan_url, api_key):
+    '''Returns the size of the data file of a resource, if it can be known.
+
+    The size stored by CKAN is used if there is one, otherwise the
+    ``Content-Length`` of a HEAD request for the file, made like the request
+    that downloads it (see ``file_request``) but with the shorter
+    ``SIZE_HEAD_TIMEOUT``.
+
+    '''
+    try:
+        return int(resource.get('size'))
+    except (TypeError, ValueError):
+        pass
+    if not SIZE_HEAD_REQUEST:
+        return None
+    kwargs = {'timeout': SIZE_HEAD_TIMEOUT, 'verify': SSL_VERIFY,
+              'allow_redirects': True}
+    if USE_PROXY:
+        kwargs['proxies'] = {'http': DOWNLOAD_PROXY, 'https': DOWNLOAD_PROXY}
+    url, kwargs['headers'] = file_request(resource, ckan_url, api_key)
+    try:
+        response = requests.head(url, **kwargs)
+        response.raise_for_status()
+        return int(response.headers['content-length'])
+    except (requests.RequestException, KeyError, ValueError):
+        # The file will still be downloaded, only its size is unknown
+        return None
+
+
+def job_lane(size):
+    '''Returns the scheduler lane of the job pushing a file of that size.'''
+    if size is None:
+        return scheduler.MEDIUM
+    if size <= SMALL_FILE_SIZE:
+        return scheduler.SMALL
+    if size >= LARGE_FILE_SIZE:
+        return scheduler.LARGE
+    return scheduler.MEDIUM
+
+
 def validate_input(input):
     # Especially validate metdata which is provided by the user
     if 'metadata' not in input:
@@ -314,6 +1994,8 @@ def validate_input(input):
         raise util.JobError('No ckan_url provided.')
     if not input.get('api_key'):
         raise util.JobError('No CKAN API key provided')
+    if not isinstance(data.get('sheets', False), (bool, list)):
+        raise util.JobError('sheets must be true or a list of sheet names.')
 
 
 @job.asynchronous
@@ -338,10 +2020,36 @@ def push_to_datastore(task_id, input, dry_run=False):
     validate_input(input)
 
     data = input['metadata']
+    api_key = input.get('api_key')
+    start = functools.partial(schedule_job, api_key=api_key, logger=logger,
+                              dry_run=dry_run)
+
+    if dry_run or not COALESCE_JOBS:
+        return scheduler.wait(start(data))
+
+    key = (get_base_url(data['ckan_url']), data['resource_id'])
+    merged = functools.partial(
+        logger.info, 'Merged into the job that was waiting to push the same '
+        'resource, which has pushed it.')
+    return scheduler.wait(COALESCER.submit(key, data, start, merged))
 
+
+def schedule_job(data, api_key, logger, dry_run=False):
+    '''Queues a job to get its resource, and then to push it in the lane of
+    the size of its file.
+
+    Getting the resource is quick, so it's queued in the small lane. Returns
+    the future of the job.
+
+    '''
+    return SCHEDULER.submit(get_base_url(data['ckan_url']), scheduler.SMALL,
+                            queue_push, data, api_key, logger, dry_run)
+
+
+def queue_push(data, api_key, logger, dry_run=False):
+    '''Gets the resource of a job and queues its push.'''
     ckan_url = data['ckan_url']
     resource_id = data['resource_id']
-    api_key = input.get('api_key')
 
     try:
         resource = get_resource(resource_id, ckan_url, api_key)
@@ -355,6 +2063,38 @@ def push_to_datastore(task_id, input, dry_run=False):
         logger.info('Dump files are managed with the Datastore API')
         return
 
+    lane = job_lane(resource_size(resource, ckan_url, api_key))
+    return SCHEDULER.submit(get_base_url(ckan_url), lane, push_resource,
+                            resource, data, api_key, logger, dry_run)
+
+
+def push_resource(resource, data, api_key, logger, dry_run=False):
+    '''Downloads the data file of a resource and pushes it to the DataStore.
+
+    The body of ``push_to_datastore``, once the job has a worker. The files
+    it opens are closed once it's done, or has failed, which stops the
+    download of a file that is parsed while it's being downloaded. Those of
+    a dry run are left open for the rows it returns to be read.
+
+    '''
+    opened = []
+    pushed = False
+    try:
+        result = _push_resource(resource, data, api_key, logger, dry_run,
+                                opened)
+        pushed = True
+        return result
+    finally:
+        if not (dry_run and pushed):
+            for fileobj in opened:
+                fileobj.close()
+
+
+def _push_resource(resource, data, api_key, logger, dry_run, opened):
+    # push_resource, adding the files it opens to ``opened``
+    ckan_url = data['ckan_url']
+    resource_id = data['resource_id']
+
     # check scheme
     url = resource.get('url')
     scheme = urlsplit(url).scheme
@@ -363,87 +2103,171 @@ def push_to_datastore(task_id, input, dry_run=False):
             'Only http, https, and ftp resources may be fetched.'
         )
 
-    # if it's a local upload, check if we need to use an internal host instead of
-    # the public one on the resource url
-    if resource.get('url_type') == 'upload':
-
-        if data.get('ckan_url') and url[:url.index('/dataset')] != data['ckan_url'].rstrip('/'):
-            url = data['ckan_url'].rstrip('/') + url[url.index('/dataset'):]
+    url, headers = file_request(resource, data.get('ckan_url'), api_key)
 
     # fetch the resource data
     logger.info('Fetching from: {0}'.format(url))
-    headers = {}
-    if resource.get('url_type') == 'upload':
-        # If this is an uploaded file to CKAN, authenticate the request,
-        # otherwise we won't get file from private resources
-        headers['Authorization'] = api_key
-    try:
-        kwargs = {'headers': headers, 'timeout': DOWNLOAD_TIMEOUT,
-                  'verify': SSL_VERIFY, 'stream': True}
-        if USE_PROXY:
-            kwargs['proxies'] = {'http': DOWNLOAD_PROXY, 'https': DOWNLOAD_PROXY}
-        response = get_data_response(url, **kwargs)
-        response.raise_for_status()
-
-        cl = response.headers.get('content-length')
+    validators = None
+    if not data.get('ignore_hash'):
+        validators = state.get_state(get_base_url(ckan_url), resource_id,
+                                     'validators')
+        if validators and validators['url'] == url:
+            if validators['etag']:
+                headers['If-None-Match'] = validators['etag']
+            if validators['last_modified']:
+                headers['If-Modified-Since'] = validators['last_modified']
+        else:
+            validators = None
+
+    # Files only readable with the API key are never shared through the cache
+    use_cache = DOWNLOAD_CACHE is not None and 'Authorization' not in headers
+    cached = DOWNLOAD_CACHE.lookup(url) if use_cache else None
+    tmp = None
+    file_headers = None
+    if cached and cached['fresh']:
+        tmp = DOWNLOAD_CACHE.open(cached)
+        if tmp is not None:
+            logger.info('Using the cached file, fetched less than {ttl} '
+                        'seconds ago.'.format(ttl=DOWNLOAD_CACHE_TTL))
+    elif cached:
+        # The cached file is at least as recent as the one last pushed
+        headers.pop('If-None-Match', None)
+        headers.pop('If-Modified-Since', None)
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    if tmp is None:
         try:
-            if cl and int(cl) > MAX_CONTENT_LENGTH:
-                raise util.JobError(
-                    'Resource too large to download: {cl} > max ({max_cl}).'
-                    .format(cl=cl, max_cl=MAX_CONTENT_LENGTH))
-        except ValueError:
-            pass
-
-        tmp = tempfile.TemporaryFile()
-        length = 0
-        m = hashlib.md5()
-        for chunk in response.iter_content(CHUNK_SIZE):
-            length += len(chunk)
-            if length > MAX_CONTENT_LENGTH:
-                raise util.JobError(
-                    'Resource too large to process: {cl} > max ({max_cl}).'
-                    .format(cl=length, max_cl=MAX_CONTENT_LENGTH))
-            tmp.write(chunk)
-            m.update(chunk)
-
-        ct = response.headers.get('content-type', '').split(';', 1)[0]
-
-    except requests.HTTPError as e:
-        raise HTTPError(
-            "DataPusher received a bad HTTP response when trying to download "
-            "the data file", status_code=e.response.status_code,
-            request_url=url, response=e.response.content)
-    except requests.RequestException as e:
-        raise HTTPError(
-            message=str(e), status_code=None,
-            request_url=url, response=None)
-
-    file_hash = m.hexdigest()
-    tmp.seek(0)
-
-    if (resource.get('hash') == file_hash
-            and not data.get('ignore_hash')):
-        logger.info("The file hash hasn't changed: {hash}.".format(
-            hash=file_hash))
-        return
+            kwargs = {'headers': headers, 'timeout': DOWNLOAD_TIMEOUT,
+                      'verify': SSL_VERIFY, 'stream': True}
+            if USE_PROXY:
+                kwargs['proxies'] = {'http': DOWNLOAD_PROXY,
+                                     'https': DOWNLOAD_PROXY}
+            response = get_data_response(url, **kwargs)
+            response.raise_for_status()
+
+            if response.status_code == 304:
+                if validators and (cached is None or (
+                        (validators['etag'], validators['last_modified']) ==
+                        (cached['etag'], cached['last_modified']))):
+                    logger.info("The file hasn't changed since it was last "
+                                "pushed.")
+                    if cached:
+                        DOWNLOAD_CACHE.refresh(url, cached)
+                    return
+                tmp = DOWNLOAD_CACHE.open(cached)
+                if tmp is not None:
+                    logger.info("The file hasn't changed since it was "
+                                "cached.")
+                    DOWNLOAD_CACHE.refresh(url, cached)
+                else:
+                    # It was removed from the cache in the meantime
+                    headers.pop('If-None-Match', None)
+                    headers.pop('If-Modified-Since', None)
+                    response = get_data_response(url, **kwargs)
+                    response.raise_for_status()
+
+            if tmp is None:
+                file_headers = response.headers
+                tmp, file_hash, file_length = download_file(
+                    response, resource.get('format'), url, kwargs)
+                if use_cache and file_hash is not None:
+                    DOWNLOAD_CACHE.add(url, tmp, file_hash, file_length,
+                                       file_headers)
+
+        except requests.HTTPError as e:
+            raise HTTPError(
+                "DataPusher received a bad HTTP response when trying to "
+                "download the data file",
+                status_code=e.response.status_code,
+                request_url=url, response=e.response.content)
+        except requests.RequestException as e:
+            raise HTTPError(
+                message=str(e), status_code=None,
+                request_url=url, response=None)
+
+    opened.append(tmp)
+    if file_headers is None:
+        # The file comes from the cache
+        file_hash = cached['md5']
+        file_length = cached['length']
+        file_headers = requests.structures.CaseInsensitiveDict({
+            'content-type': cached['content_type'] or '',
+            'etag': cached['etag'],
+            'last-modified': cached['last_modified'],
+        })
+    ct = file_headers.get('content-type', '').split(';', 1)[0]
+
+    def hash_unchanged(file_hash):
+        if (resource.get('hash') == file_hash
+                and not data.get('ignore_hash')):
+            logger.info("The file hash hasn't changed: {hash}.".format(
+                hash=file_hash))
+            store_validators(ckan_url, resource_id, url, file_headers)
+            return True
+        return False
+
+    if file_hash is not None:
+        if hash_unchanged(file_hash):
+            return
+        resource['hash'] = file_hash
+
+    compressed = compression.detect(tmp)
+    if compressed:
+        if isinstance(tmp, DownloadSpool):
+            # A compressed file can only be parsed once it's complete
+            file_hash = tmp.wait()
+            file_length = tmp.length
+            if hash_unchanged(file_hash):
+                tmp.close()
+                return
+            resource['hash'] = file_hash
+        try:
+            decompressed, name = compression.decompress(
+                tmp, compressed, urlsplit(url).path, MAX_DECOMPRESSED_LENGTH,
+                CHUNK_SIZE)
+        except compression.DecompressionError as e:
+            raise util.JobError(str(e))
+        finally:
+            tmp.close()
+        tmp = decompressed
+        opened.append(tmp)
+        logger.info('Decompressed the {compression} file: {name}.'.format(
+            compression=compressed, name=name))
+        # The format of the file it contains, by its name
+        ct = (mimetypes.guess_type(name)[0] or
+              os.path.splitext(name)[1][1:] or resource.get('format') or '')
+
+    # What was pushed last time, if the file only had rows appended since
+    pushed = None
+    if INCREMENTAL_PUSH and not data.get('ignore_hash') and not compressed:
+        previous = state.get_state(get_base_url(ckan_url), resource_id,
+                                   'pushed_file')
+        if (previous and previous['url'] == url and
+                appended_to(tmp, previous['length'], previous['hash'])):
+            pushed = previous
 
-    resource['hash'] = file_hash
+    try:
+        any_tableset = _PARSERS[PARSER]
+    except KeyError:
+        raise util.JobError('Unknown parser: {0}'.format(PARSER))
 
     try:
-        table_set = messytables.any_tableset(tmp, mimetype=ct, extension=ct)
+        table_set = any_tableset(tmp, mimetype=ct, extension=ct)
     except messytables.ReadError as e:
         # try again with format
         tmp.seek(0)
         try:
             format = resource.get('format')
-            table_set = messytables.any_tableset(tmp, mimetype=format, extension=format)
+            table_set = any_tableset(tmp, mimetype=format, extension=format)
         except:
             raise util.JobError(e)
 
     get_row_set = web.app.config.get('GET_ROW_SET',
                                      lambda table_set: table_set.tables.pop())
     row_set = get_row_set(table_set)
-    offset, headers = messytables.headers_guess(row_set.sample)
 
     existing = datastore_resource_exists(resource_id, api_key, ckan_url)
     existing_info = None
@@ -451,84 +2275,277 @@ def push_to_datastore(task_id, input, dry_run=False):
         existing_info = dict((f['id'], f['info'])
             for f in existing.get('fields', []) if 'info' in f)
 
-    # Some headers might have been converted from strings to floats and such.
-    headers = [str(header) for header in headers]
-
-    row_set.register_processor(messytables.headers_processor(headers))
-    row_set.register_processor(messytables.offset_processor(offset + 1))
-    types = messytables.type_guess(row_set.sample, types=TYPES, strict=True)
-
-    # override with types user requested
-    if existing_info:
-        types = [{
-            'text': messytables.StringType(),
-            'numeric': messytables.DecimalType(),
-            'timestamp': messytables.DateUtilType(),
-            }.get(existing_info.get(h, {}).get('type_override'), t)
-            for t, h in zip(types, headers)]
-
-    row_set.register_processor(messytables.types_processor(types))
+    columns, types, offset, repair, rows = guess_fields(row_set,
+                                                        existing_info, logger)
+
+    def push_other_sheets():
+        # The other sheets to push from the workbook that is already open
+        row_sets = job_sheets(table_set, row_set, data)
+        if not row_sets:
+            return
+        previous = state.get_state(get_base_url(ckan_url), resource_id,
+                                   'sheets') or {}
+        logger.info('Pushing the sheets {names}.'.format(
+            names=[sheet.name for sheet in row_sets]))
+        pushes = SheetPushes(
+            lambda sheet, sheet_logger: push_sheet(
+                sheet, resource, previous.get(sheet.name), api_key, ckan_url,
+                sheet_logger),
+            row_sets, SHEET_WORKERS, logger)
+        try:
+            pushes.wait()
+        finally:
+            # Even if some failed, so their resources aren't created again
+            sheets = dict(previous)
+            for name, (sheet_resource_id, count) in pushes.results.items():
+                sheets[name] = sheet_resource_id
+            state.set_state(get_base_url(ckan_url), resource_id, 'sheets',
+                            sheets)
+
+    if (file_hash is None and resource.get('hash')
+            and not data.get('ignore_hash')):
+        # Nothing has been changed in the datastore yet, so the rest of the
+        # download can still be skipped if it turns out to be the same file
+        file_hash = tmp.wait()
+        if hash_unchanged(file_hash):
+            tmp.close()
+            return
+        resource['hash'] = file_hash
+
+    headers_dicts = field_dicts(columns, types, existing_info)
+    logger.info('Determined headers and types: {headers}'.format(
+        headers=headers_dicts))
 
-    headers = [header.strip() for header in headers if header.strip()]
-    headers_set = set(headers)
-
-    def row_iterator():
-        for row in row_set:
-            data_row = {}
-            for index, cell in enumerate(row):
-                column_name = cell.column.strip()
-                if column_name not in headers_set:
-                    continue
-                if isinstance(cell.value, str):
-                    try:
-                        data_row[column_name] = cell.value.encode('latin-1').decode('utf-8')
-                    except (UnicodeDecodeError, UnicodeEncodeError):
-                        data_row[column_name] = cell.value
-                else:
-                    data_row[column_name] = cell.value
-            yield data_row
-    result = row_iterator()
+    fields = [[h['id'], h['type']] for h in headers_dicts]
+
+    # Column identifying the rows, so only the rows that changed are sent
+    key = data.get('primary_key')
+    if not key and existing_info:
+        key = next((h['id'] for h in headers_dicts
+                    if h.get('info', {}).get('primary_key')), None)
+    if key and key not in [h['id'] for h in headers_dicts]:
+        logger.info('The key column "{key}" is not in the file.'.format(
+            key=key))
+        key = None
+    if key:
+        # The changed rows are found whatever changed in the file
+        pushed = None
+
+    append = bool(pushed and existing and pushed['fields'] == fields)
+    if pushed and not append:
+        logger.info('The columns have changed, pushing the whole file.')
+
+    # Rows stored by a previous attempt at pushing the same file that failed
+    checkpoint = None
+    if existing and not data.get('ignore_hash'):
+        checkpoint = state.get_state(get_base_url(ckan_url), resource_id,
+                                     'checkpoint')
+        if checkpoint and file_hash is None:
+            file_hash = tmp.wait()
+            resource['hash'] = file_hash
+        if (checkpoint and (checkpoint['hash'] != file_hash or
+                            checkpoint['fields'] != fields)):
+            checkpoint = None
+        # A chunk CKAN stored without the job hearing back would be stored
+        # twice
+        if (checkpoint and existing.get('total') is not None and
+                existing['total'] != checkpoint['rows']):
+            logger.info('The DataStore has {total} rows instead of {rows}, '
+                        'pushing the whole file.'.format(
+                            total=existing['total'], rows=checkpoint['rows']))
+            checkpoint = None
 
     '''
     Delete existing datstore resource before proceeding. Otherwise
     'datastore_create' will append to the existing datastore. And if
     the fields have significantly changed, it may also fail.
     '''
-    if existing:
+    keep_table = append or bool(checkpoint)
+    # The fingerprint is only known once all the records have been read, so
+    # they are staged to compare it before touching the existing table
+    fingerprint = None
+    if CONTENT_FINGERPRINT and not keep_table:
+        fingerprint = Fingerprint(headers_dicts)
+    index_rows = bool(key) and not keep_table
+    stage = STAGE_RECORDS or fingerprint is not None or index_rows
+    if existing and not stage and not keep_table:
         logger.info('Deleting "{res_id}" from datastore.'.format(
             res_id=resource_id))
         delete_datastore_resource(resource_id, api_key, ckan_url)
 
-    headers_dicts = [dict(id=field[0], type=TYPE_MAPPING[str(field[1])])
-                     for field in zip(headers, types)]
-
-    # Maintain data dictionaries from matching column names
-    if existing_info:
-        for h in headers_dicts:
-            if h['id'] in existing_info:
-                h['info'] = existing_info[h['id']]
-                # create columns with types user requested
-                type_override = existing_info[h['id']].get('type_override')
-                if type_override in list(_TYPE_MAPPING.values()):
-                    h['type'] = type_override
-
-    logger.info('Determined headers and types: {headers}'.format(
-        headers=headers_dicts))
+    # Rows of the file already in the DataStore
+    skip = 0
+    if checkpoint:
+        skip = checkpoint['rows']
+        logger.info('Resuming the previous push after the first {n} '
+                    'rows.'.format(n=skip))
+    elif append:
+        skip = pushed['rows']
+        logger.info('Rows were only appended, pushing the rows after the '
+                    'first {n}.'.format(n=skip))
+    ends = parallel_pieces(tmp, row_set)
+    if ends:
+        logger.info('Parsing the file in {n} pieces, in {workers} '
+                    'processes.'.format(n=len(ends), workers=PARSE_WORKERS))
+        result = parallel_row_iterator(row_set, ends, columns, types, offset,
+                                       repair)
+        if skip:
+            result = itertools.islice(result, skip, None)
+    else:
+        if skip:
+            rows = itertools.islice(rows, skip, None)
+        result = row_iterator(row_set, columns, types, offset, repair, rows)
 
     if dry_run:
         return headers_dicts, result
 
-    count = 0
-    for i, chunk in enumerate(chunky(result, CHUNK_INSERT_ROWS)):
-        records, is_it_the_last_chunk = chunk
-        count += len(records)
-        logger.info('Saving chunk {number} {is_last}'.format(
-            number=i, is_last='(last)' if is_it_the_last_chunk else ''))
-        send_resource_to_datastore(resource, headers_dicts, records,
-                                   is_it_the_last_chunk, api_key, ckan_url)
+    rows = CHUNK_INSERT_ROWS
+    row_index = None
+    primary_key = None
+    sync = False
+    if stage:
+        # Read the whole file before touching the existing table, so it's
+        # left as it is if the file can't be read
+        if fingerprint is not None:
+            result = fingerprint.records(result)
+        if index_rows:
+            result = staged = row_index = RowIndex(result, key)
+        else:
+            result = staged = RecordSpool(result)
+        logger.info('Staged {n} records.'.format(n=staged.count))
+        if (fingerprint is not None and existing and
+                not data.get('ignore_hash') and
+                fingerprint.hexdigest() == state.get_state(
+                    get_base_url(ckan_url), resource_id, 'fingerprint')):
+            logger.info("The content of the file hasn't changed: "
+                        "{fingerprint}.".format(
+                            fingerprint=fingerprint.hexdigest()))
+            staged.close()
+            push_other_sheets()
+            store_validators(ckan_url, resource_id, url, file_headers)
+            return
+        if row_index is not None:
+            if row_index.unique():
+                primary_key = key
+                previous = state.get_state(get_base_url(ckan_url),
+                                           resource_id, 'row_index')
+                sync = bool(existing and not data.get('ignore_hash') and
+                            previous == {'key': key, 'fields': fields})
+            else:
+                logger.info('The values of the key column "{key}" are not '
+                            'unique, pushing the whole file.'.format(
+                                key=key))
+        # Only the upload can fail now, so start with the largest chunks
+        rows = CHUNK_INSERT_MAX_ROWS
+        if sync:
+            row_index.compare(state.get_row_index(get_base_url(ckan_url),
+                                                  resource_id))
+            deleted = 0
+            for keys, _ in chunky(row_index.deleted(), CHUNK_INSERT_ROWS):
+                delete_datastore_resource(resource_id, api_key, ckan_url,
+                                          filters={key: keys})
+                deleted += len(keys)
+            logger.info('Deleted {n} rows that are gone from the file.'
+                        .format(n=deleted))
+            result = row_index.changed()
+        elif existing and not keep_table:
+            logger.info('Deleting "{res_id}" from datastore.'.format(
+                res_id=resource_id))
+            delete_datastore_resource(resource_id, api_key, ckan_url)
+
+    encoded = stage
+    if (DOWNLOAD_CACHE is not None and not stage and not keep_table and
+            file_hash is not None):
+        # The same file parsed the same way gives the same records
+        records_key = hashlib.sha1(json.dumps(
+            [file_hash, fields, PARSER]).encode('utf-8')).hexdigest()
+        records = DOWNLOAD_CACHE.records(records_key)
+        if records is not None:
+            logger.info('Using the records cached for this file.')
+            result = records
+        else:
+            result = DOWNLOAD_CACHE.store_records(
+                records_key, (encode_record(record) for record in result))
+        encoded = True
+
+    chunker = AdaptiveChunker(rows, CHUNK_INSERT_MIN_ROWS,
+                              CHUNK_INSERT_MAX_ROWS, CHUNK_INSERT_BYTES,
+                              CHUNK_INSERT_SECONDS)
+
+    def send_chunk(records, is_it_the_last_chunk):
+        start = time.time()
+        if sync:
+            upsert_resource_to_datastore(resource, records,
+                                         is_it_the_last_chunk, api_key,
+                                         ckan_url, method='upsert',
+                                         encoded=True)
+        elif keep_table:
+            upsert_resource_to_datastore(resource, records,
+                                         is_it_the_last_chunk, api_key,
+                                         ckan_url, method='insert',
+                                         encoded=True)
+        else:
+            send_resource_to_datastore(resource, headers_dicts, records,
+                                       is_it_the_last_chunk, api_key,
+                                       ckan_url, encoded=True,
+                                       primary_key=primary_key)
+        chunker.record(len(records), time.time() - start)
+
+    def save_checkpoint(rows):
+        # The hash of a file parsed while it's downloaded is only known
+        # once it's complete, and there is no point resuming without it
+        if file_hash is None and not tmp.finished:
+            return
+        state.set_state(get_base_url(ckan_url), resource_id, 'checkpoint', {
+            'hash': file_hash or tmp.wait(),
+            'fields': fields,
+            'rows': rows,
+        })
+
+    # The rows upserted by a sync aren't the first rows of the file
+    checkpoints = Checkpoints(skip, save_checkpoint)
+    count = push_chunks(chunker.chunks(result, encoded=encoded),
+                        send_chunk, CHUNK_INSERT_WORKERS, logger,
+                        sent=None if sync else checkpoints.sent)
+    total = row_index.count if sync else skip + count
+    if primary_key:
+        state.set_row_index(get_base_url(ckan_url), resource_id,
+                            row_index.hashes())
+        state.set_state(get_base_url(ckan_url), resource_id, 'row_index',
+                        {'key': key, 'fields': fields})
+    elif state.get_state(get_base_url(ckan_url), resource_id, 'row_index'):
+        # The rows pushed without a key can't be compared anymore
+        state.delete_state(get_base_url(ckan_url), resource_id, 'row_index')
+        state.delete_row_index(get_base_url(ckan_url), resource_id)
+    if stage:
+        staged.close()
+    if file_hash is None:
+        # All the rows have been read, so the download is complete
+        resource['hash'] = tmp.wait()
+    if isinstance(tmp, DownloadSpool):
+        file_length = tmp.length
+
+    push_other_sheets()
 
     logger.info('Successfully pushed {n} entries to "{res_id}".'.format(
         n=count, res_id=resource_id))
+    store_validators(ckan_url, resource_id, url, file_headers)
+    state.delete_state(get_base_url(ckan_url), resource_id, 'checkpoint')
+    if fingerprint is not None:
+        state.set_state(get_base_url(ckan_url), resource_id, 'fingerprint',
+                        fingerprint.hexdigest())
+    else:
+        # Only part of the file was pushed, so its fingerprint is unknown
+        state.delete_state(get_base_url(ckan_url), resource_id,
+                           'fingerprint')
+    if INCREMENTAL_PUSH:
+        state.set_state(get_base_url(ckan_url), resource_id, 'pushed_file', {
+            'url': url,
+            'length': file_length,
+            'hash': resource['hash'],
+            'rows': total,
+            'fields': fields,
+        })
 
     if data.get('set_url_type', False):
         update_resource(resource, api_key, ckan_url)
@@ -10,11 +10,13 @@ assert(jobs.push_to_datastore)
 
 def serve():
     web.init()
+    jobs.init_scheduler()
     web.app.run(web.app.config.get('HOST'), web.app.config.get('PORT'))
 
 
 def serve_test():
     web.init()
+    jobs.init_scheduler()
     return web.app.test_client()
 
 
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""Parser backends for the files pushed to the DataStore.
+
+messytables is used for every format by default. The ``csv`` engine reads
+CSV/TSV/SSV files with the stdlib's C ``csv`` module instead and leaves the
+rest of the formats to messytables (all of them on Python 2). Its row sets
+are messytables row sets, so the header and type guessing on the sample are
+the same for both engines, but the rows after the sample are plain lists of
+strings rather than lists of ``Cell`` objects. Large files read by the
+``csv`` engine can also be split into pieces at the end of rows, to be
+parsed by several processes.
+
+Spreadsheets are read sheet by sheet for both engines, without loading the
+whole workbook in memory like messytables does: XLSX files with openpyxl in
+read-only mode if it's installed, and XLS files with xlrd loading only the
+sheet being read, from a memory map of the file.
+
+"""
+import codecs
+import csv
+import datetime
+import io
+import itertools
+import mmap
+import sys
+import threading
+import zipfile
+
+import chardet
+import messytables
+import xlrd
+from messytables.any import guess_ext, guess_mime, clean_ext
+from messytables.excel import InvalidDateError, XLSCell
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# Signatures of the XLSX (zip) and XLS (OLE2) files
+XLSX_MAGIC = b'PK\x03\x04'
+XLS_MAGIC = b'\xd0\xcf\x11\xe0'
+
+# Python 2's csv module can't read unicode, so the csv engine needs Python 3
+CSV_ENGINE = sys.version_info[0] >= 3
+
+
+def any_tableset(fileobj, mimetype=None, extension=''):
+    """
+    Reads a table set like ``messytables.any_tableset``
+
+    Delimited files are read by the ``csv`` engine, anything else (or
+    anything that can't be recognised from ``mimetype`` and ``extension``)
+    is left to messytables. So is everything on Python 2.
+    """
+    if not CSV_ENGINE:
+        return messytables_tableset(fileobj, mimetype=mimetype,
+                                    extension=extension)
+    kind = _guess_kind(mimetype, extension)
+    if kind == 'CSV':
+        return CSVTableSet(fileobj)
+    if kind == 'TAB':
+        return CSVTableSet(fileobj, delimiter='\t')
+    return messytables_tableset(fileobj, mimetype=mimetype,
+                                extension=extension)
+
+
+def messytables_tableset(fileobj, mimetype=None, extension=''):
+    """
+    Reads a table set with ``messytables.any_tableset``, except for
+    spreadsheets, which are read by ``spreadsheet_tableset``
+    """
+    if _guess_kind(mimetype, extension) == 'XLS':
+        table_set = spreadsheet_tableset(fileobj)
+        if table_set is not None:
+            return table_set
+    return messytables.any_tableset(fileobj, mimetype=mimetype,
+                                    extension=extension)
+
+
+def spreadsheet_tableset(fileobj):
+    """
+    Reads a table set from an XLS or XLSX file, one sheet at a time
+
+    The format is told by the start of the file, as messytables gives XLSX
+    files the same mimetypes as XLS ones.
+
+    :returns: The table set, or None if the file isn't a spreadsheet that
+        can be streamed (e.g. an XLSX file without openpyxl installed)
+    """
+    magic = fileobj.read(len(XLSX_MAGIC))
+    fileobj.seek(0)
+    if magic == XLSX_MAGIC and openpyxl is not None:
+        return XLSXTableSet(fileobj)
+    if magic == XLS_MAGIC:
+        return XLSTableSet(fileobj)
+    return None
+
+
+def _guess_kind(mimetype, extension):
+    kind = None
+    if mimetype is not None:
+        kind = guess_mime(mimetype)
+    if not kind and extension:
+        kind = guess_ext(clean_ext(extension))
+    return kind
+
+
+class CSVTableSet(messytables.TableSet):
+    """
+    Table set of a delimited file, read with the stdlib ``csv`` module
+    """
+
+    def __init__(self, fileobj, delimiter=None, encoding=None, window=None):
+        self.fileobj = messytables.seekable_stream(fileobj)
+        self.name = 'table'
+        self.delimiter = delimiter
+        self.encoding = encoding
+        self.window = window
+
+    def make_tables(self):
+        return [CSVRowSet(self.name, self.fileobj, delimiter=self.delimiter,
+                          encoding=self.encoding, window=self.window)]
+
+
+class CSVRowSet(messytables.core.RowSet):
+    """
+    Row set of a delimited file, read with the stdlib ``csv`` module
+
+    Like ``messytables.CSVRowSet``, the encoding is guessed from the start of
+    the file and the dialect from the first ``window`` lines, but only once.
+    ``raw()`` yields rows of ``Cell`` objects for the analysis of the sample,
+    and ``values()`` yields the rows as lists of strings.
+    """
+
+    def __init__(self, name, fileobj, delimiter=None, encoding=None,
+                 window=None):
+        self.name = name
+        self.delimiter = delimiter
+        self.window = window or 1000
+
+        if not encoding:
+            encoding = chardet.detect(fileobj.read(2000))['encoding']
+            # Don't break, just try and load the data with a semi-sane
+            # encoding
+            encoding = encoding or 'utf-8'
+        fileobj.seek(0)
+        self.fileobj = fileobj
+        self.encoding = encoding
+        self.lines = io.TextIOWrapper(fileobj, encoding=encoding,
+                                      errors='ignore', newline='')
+        try:
+            self._sample = []
+            for i in range(self.window):
+                line = self.lines.readline()
+                if not line:
+                    break
+                self._sample.append(line)
+            self.dialect = self._sniff()
+        except Exception:
+            # Leave the file open for another attempt at reading it
+            self.lines.detach()
+            raise
+        super(CSVRowSet, self).__init__()
+
+    def _sniff(self):
+        # Same as messytables, so both engines split the lines the same way
+        sample = '\n'.join(self._sample)
+        try:
+            dialect = csv.Sniffer().sniff(sample,
+                                          delimiters=['\t', ',', ';', '|'])
+            dialect.lineterminator = '\n'
+            dialect.doublequote = True
+        except csv.Error:
+            dialect = csv.excel
+        overrides = {}
+        if self.delimiter:
+            overrides['delimiter'] = self.delimiter
+        return dialect, overrides
+
+    def _reader(self, sample=False):
+        if sample:
+            lines = self._sample
+        else:
+            lines = itertools.chain(self._sample, self.lines)
+        dialect, overrides = self.dialect
+        # Fix the maximum field size to something a little larger
+        csv.field_size_limit(256000)
+        return csv.reader(lines, dialect=dialect, **overrides)
+
+    def options(self):
+        """
+        Returns the formatting parameters the file is read with, as keyword
+        arguments of ``csv.reader``
+        """
+        dialect, overrides = self.dialect
+        options = dict((name, getattr(dialect, name)) for name in (
+            'delimiter', 'doublequote', 'escapechar', 'lineterminator',
+            'quotechar', 'quoting', 'skipinitialspace'))
+        options.update(overrides)
+        return options
+
+    def split(self, size):
+        """
+        Returns where the file can be split into pieces of at least ``size``
+        bytes, each ending at the end of a row, to be parsed on their own by
+        ``read_values``
+
+        The whole file is read with ``csv.reader``, line by line, to find
+        where its rows end, so a piece never ends inside a quoted value
+        whatever quotes there are elsewhere. That needs newlines to be the
+        same bytes in its encoding as in ASCII. The position of the file is
+        left as it was, for ``values``.
+
+        :returns: Where the pieces end, or None if the file can't be split
+            (e.g. its rows end with carriage returns only)
+        :rtype: list of ints
+        """
+        try:
+            if 'ab\n'.encode(self.encoding) != b'ab\n':
+                return None
+            decoder = codecs.getincrementaldecoder(self.encoding)('ignore')
+        except (LookupError, UnicodeError):
+            return None
+        read = [0]
+
+        def lines():
+            for line in iter(self.fileobj.readline, b''):
+                read[0] += len(line)
+                yield decoder.decode(line)
+
+        position = self.fileobj.tell()
+        self.fileobj.seek(0)
+        ends = []
+        start = 0
+        csv.field_size_limit(256000)
+        try:
+            # A row is given once the line it ends with has been read
+            for _ in csv.reader(lines(), **self.options()):
+                if read[0] - start >= size:
+                    ends.append(read[0])
+                    start = read[0]
+        except csv.Error:
+            return None
+        finally:
+            self.fileobj.seek(position)
+        if read[0] > start:
+            ends.append(read[0])
+        return ends
+
+    def pieces(self, ends):
+        """
+        Yields the bytes of the pieces of the file that end at ``ends``, as
+        given by ``split``
+        """
+        start = 0
+        for end in ends:
+            self.fileobj.seek(start)
+            yield self.fileobj.read(end - start)
+            start = end
+
+    def values(self):
+        """
+        Yields the rows of the file as lists of strings
+        """
+        try:
+            for row in self._reader():
+                yield row
+        except csv.Error as err:
+            raise messytables.ReadError('Error reading CSV: %r', err)
+
+    def raw(self, sample=False):
+        Cell = messytables.Cell
+        try:
+            for row in self._reader(sample):
+                yield [Cell(value) for value in row]
+        except csv.Error as err:
+            if not (sample and 'newline inside string' in str(err)):
+                raise messytables.ReadError('Error reading CSV: %r', err)
+
+
+def read_values(data, encoding, options):
+    """
+    Returns the rows of a piece of a delimited file as lists of strings
+
+    :param data: A piece, as given by ``CSVRowSet.pieces``
+    :type data: bytes
+    :param options: Keyword arguments of ``csv.reader``, as given by
+        ``CSVRowSet.options``
+    :type options: dict
+
+    :rtype: list of lists
+    """
+    lines = io.TextIOWrapper(io.BytesIO(data), encoding=encoding,
+                             errors='ignore', newline='')
+    csv.field_size_limit(256000)
+    try:
+        return list(csv.reader(lines, **options))
+    except csv.Error as err:
+        raise messytables.ReadError('Error reading CSV: %r', err)
+
+
+class XLSXTableSet(messytables.TableSet):
+    """
+    Table set of an XLSX workbook, read with openpyxl in read-only mode
+
+    Only the list of sheets is read when it's opened, the rows of a sheet
+    are parsed as they are iterated over, so sheets can be read by several
+    threads at the same time.
+    """
+
+    def __init__(self, fileobj, window=None):
+        try:
+            self.workbook = openpyxl.load_workbook(
+                fileobj, read_only=True, data_only=True)
+        except (zipfile.BadZipfile, KeyError, IOError, ValueError) as err:
+            raise messytables.ReadError(
+                "Can't read Excel file: %r" % err)
+        self.window = window
+
+    def make_tables(self):
+        return [XLSXRowSet(sheet.title, sheet, window=self.window)
+                for sheet in self.workbook.worksheets]
+
+
+class XLSXRowSet(messytables.core.RowSet):
+    """
+    Row set of a sheet of an XLSX workbook
+
+    ``raw()`` yields rows of ``Cell`` objects for the analysis of the
+    sample, and ``values()`` yields the rows as lists of values. Each
+    iteration parses the sheet again from its start.
+    """
+
+    def __init__(self, name, sheet, window=None):
+        self.name = name
+        self.sheet = sheet
+        self.window = window or 1000
+        super(XLSXRowSet, self).__init__(typed=True)
+
+    def values(self):
+        """
+        Yields the rows of the sheet as lists of values
+        """
+        for row in self.sheet.iter_rows(values_only=True):
+            yield list(row)
+
+    def raw(self, sample=False):
+        rows = self.values()
+        if sample:
+            rows = itertools.islice(rows, self.window)
+        for row in rows:
+            yield [messytables.Cell(value, type=_cell_type(value))
+                   for value in row]
+
+
+def _cell_type(value):
+    # Same types as messytables gives to the cells of XLS files
+    if isinstance(value, bool):
+        return messytables.IntegerType()
+    if isinstance(value, (int, float)):
+        return messytables.FloatType()
+    if isinstance(value, (datetime.datetime, datetime.date,
+                          datetime.time)):
+        return messytables.DateType(None)
+    return messytables.StringType()
+
+
+class XLSTableSet(messytables.TableSet):
+    """
+    Table set of an XLS workbook, read with xlrd one sheet at a time
+
+    The file is memory mapped rather than read, and a sheet is only loaded
+    while it's being read. Sheets can be read by several threads at the
+    same time. Cells don't have formatting properties.
+    """
+
+    def __init__(self, fileobj, window=None):
+        try:
+            contents = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, io.UnsupportedOperation, ValueError,
+                EnvironmentError):
+            # Not a real file
+            contents = fileobj.read()
+        try:
+            self.workbook = xlrd.open_workbook(
+                file_contents=contents, on_demand=True,
+                formatting_info=False)
+        except xlrd.XLRDError as err:
+            raise messytables.ReadError(
+                "Can't read Excel file: %r" % err)
+        self.window = window
+        # xlrd loads the sheets from the same stream
+        self.lock = threading.Lock()
+
+    def make_tables(self):
+        return [XLSRowSet(name, self.workbook, index, window=self.window,
+                          lock=self.lock)
+                for index, name in enumerate(self.workbook.sheet_names())]
+
+
+class XLSRowSet(messytables.core.RowSet):
+    """
+    Row set of a sheet of an XLS workbook
+
+    Like ``messytables.XLSRowSet``, with the sheet loaded when it's first
+    read and unloaded once all its rows have been.
+    """
+
+    def __init__(self, name, workbook, index, window=None, lock=None):
+        self.name = name
+        self.workbook = workbook
+        self.index = index
+        self.window = window or 1000
+        self.lock = lock or threading.Lock()
+        super(XLSRowSet, self).__init__(typed=True)
+
+    def _cells(self, sample):
+        with self.lock:
+            sheet = self.workbook.sheet_by_index(self.index)
+        nrows = min(self.window, sheet.nrows) if sample else sheet.nrows
+        for rownum in range(nrows):
+            row = []
+            for colnum, cell in enumerate(sheet.row(rownum)):
+                try:
+                    row.append(XLSCell.from_xlrdcell(cell, sheet, colnum,
+                                                     rownum))
+                except InvalidDateError:
+                    raise ValueError("Invalid date at '%s':%d,%d" % (
+                        sheet.name, colnum + 1, rownum + 1))
+            yield row
+        if not sample:
+            with self.lock:
+                self.workbook.unload_sheet(self.index)
+
+    def values(self):
+        """
+        Yields the rows of the sheet as lists of values
+        """
+        for row in self._cells(sample=False):
+            yield [cell.value for cell in row]
+
+    def raw(self, sample=False):
+        return self._cells(sample)
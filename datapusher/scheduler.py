@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""Scheduling of the push jobs.
+
+ckanserviceprovider runs every asynchronous job in a thread of its
+apscheduler executor as soon as it's submitted, and ends it when its function
+returns. The jobs are instead queued here, and a fixed number of worker
+threads run them, so the jobs waiting for a worker don't hold a thread each
+and the number of jobs running at the same time doesn't depend on how many
+threads apscheduler or uwsgi happen to have. Jobs are put in a lane by the
+size of their file, and the waiting jobs are started from the lane of the
+smallest files first, then those of the CKAN sites with the fewest running
+jobs first, then in the order they arrived. Each lane and each CKAN site can
+also be limited to a number of running jobs, so that large files or a bulk
+reindex of one site don't hold up the others.
+
+Jobs for a resource that already has a job waiting are merged into it, so a
+burst of submissions for the same resource only pushes it once or twice. They
+end with the job they were merged into, and fail if it does.
+
+"""
+import itertools
+import sys
+import threading
+import traceback
+
+from apscheduler.events import EVENT_JOB_ERROR
+from apscheduler.executors.base import run_job
+from apscheduler.executors.pool import ThreadPoolExecutor
+from concurrent import futures
+
+# Lanes, the jobs of the lower ones are started first
+SMALL = 0
+MEDIUM = 1
+LARGE = 2
+
+LANE_NAMES = {SMALL: 'small', MEDIUM: 'medium', LARGE: 'large'}
+
+_executor = threading.local()
+
+
+def init_executor(aps_scheduler, threads):
+    """
+    Gives the apscheduler scheduler of ckanserviceprovider an executor that
+    ends the jobs once they have been run by the workers
+
+    It does nothing once the scheduler has been started.
+
+    :param threads: Number of jobs that can be queued at the same time
+    :type threads: int
+    """
+    if aps_scheduler is None or aps_scheduler.running:
+        return
+    aps_scheduler.add_executor(JobExecutor(threads), 'default')
+
+
+def wait(future):
+    """
+    Returns the result of a future, or the future itself in a job run by
+    ``JobExecutor``, which ends the job once the future is done instead of
+    holding a thread until then
+    """
+    if getattr(_executor, 'deferring', False):
+        return future
+    return future.result()
+
+
+def exception_info(future):
+    """
+    Returns the exception a done future failed with and its traceback, or
+    ``(None, None)``
+    """
+    if hasattr(future, 'exception_info'):
+        # The futures backport of Python 2
+        return future.exception_info()
+    exception = future.exception()
+    return exception, getattr(exception, '__traceback__', None)
+
+
+def set_exception(future, exception, tb):
+    """
+    Fails a future with an exception, keeping its traceback on Python 2 too
+    """
+    if hasattr(future, 'set_exception_info'):
+        future.set_exception_info(exception, tb)
+    else:
+        future.set_exception(exception)
+
+
+def chain(source, target, result=None):
+    """
+    Ends a future like another one once that one is done
+
+    :param result: Called with no arguments if the source succeeded, gives
+        the result of the target instead of that of the source
+    :type result: callable
+    """
+    def done(source):
+        exception, tb = exception_info(source)
+        if exception is not None:
+            set_exception(target, exception, tb)
+            return
+        try:
+            value = result() if result else source.result()
+        except Exception:
+            set_exception(target, *sys.exc_info()[1:])
+        else:
+            target.set_result(value)
+    source.add_done_callback(done)
+
+
+def _run_job(job, jobstore_alias, run_times, logger_name):
+    # apscheduler's run_job, letting the job return a future to end with
+    _executor.deferring = True
+    try:
+        return run_job(job, jobstore_alias, run_times, logger_name)
+    finally:
+        _executor.deferring = False
+
+
+class JobExecutor(ThreadPoolExecutor):
+    """
+    apscheduler executor that ends a job whose function returned a future
+    once the future is done
+
+    ckanserviceprovider marks a job as completed, and posts its result to
+    CKAN, when apscheduler reports that its function returned. A job can
+    then queue itself in a ``JobScheduler`` and return the future it gets
+    from ``wait``, without holding a thread while it waits for a worker.
+    """
+
+    def _do_submit_job(self, job, run_times):
+        def callback(f):
+            exception, tb = exception_info(f)
+            if exception:
+                self._run_job_error(job.id, exception, tb)
+            else:
+                self._end_job(job.id, f.result())
+
+        f = self._pool.submit(_run_job, job, job._jobstore_alias, run_times,
+                              self._logger.name)
+        f.add_done_callback(callback)
+
+    def _end_job(self, job_id, events):
+        # Reports the events of a job once the futures it returned are done
+        for event in events:
+            if isinstance(getattr(event, 'retval', None), futures.Future):
+                break
+        else:
+            self._run_job_success(job_id, events)
+            return
+
+        def done(future):
+            exception, tb = exception_info(future)
+            event.retval = None
+            if exception is None:
+                event.retval = future.result()
+            else:
+                event.code = EVENT_JOB_ERROR
+                event.exception = exception
+                event.traceback = ''.join(traceback.format_tb(tb))
+            self._end_job(job_id, events)
+        event.retval.add_done_callback(done)
+
+
+class JobScheduler(object):
+    """
+    Worker threads shared by the jobs of all the CKAN sites
+
+    :param workers: Number of jobs that can run at the same time
+    :type workers: int
+    :param host_workers: Number of jobs of a single CKAN site that can run at
+        the same time, all of them by default
+    :type host_workers: int
+    :param lane_workers: Number of jobs of each lane that can run at the same
+        time, all of them by default
+    :type lane_workers: dict
+    """
+
+    def __init__(self, workers, host_workers=None, lane_workers=None):
+        self.workers = workers
+        self.host_workers = host_workers or workers
+        self.lane_workers = dict((lane, workers) for lane in LANE_NAMES)
+        self.lane_workers.update(lane_workers or {})
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._active = {}
+        self._lanes = dict((lane, 0) for lane in LANE_NAMES)
+        self._sequence = itertools.count()
+        self._threads = []
+
+    def _next(self):
+        # The waiting job to start next, if there is a free worker for it
+        if sum(self._active.values()) >= self.workers:
+            return None
+        candidates = [
+            ticket for ticket in self._waiting
+            if self._active.get(ticket[2], 0) < self.host_workers and
+            self._lanes[ticket[0]] < self.lane_workers[ticket[0]]]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda ticket: (
+            ticket[0], self._active.get(ticket[2], 0), ticket[1]))
+
+    def submit(self, host, lane, func, *args, **kwargs):
+        """
+        Queues a job for a worker
+
+        Returns a future of what ``func`` returns. If it returns a future
+        itself, like that of the job queued again in another lane, the
+        future ends with that one.
+
+        :param host: The CKAN site of the job
+        :type host: string
+        :param lane: The lane of the job, ``SMALL``, ``MEDIUM`` or ``LARGE``
+        :type lane: int
+        :param func: Called with the other arguments by the worker
+        :type func: callable
+        """
+        future = futures.Future()
+        ticket = (lane, next(self._sequence), host,
+                  (future, func, args, kwargs))
+        with self._condition:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._waiting.append(ticket)
+            self._condition.notify_all()
+        return future
+
+    def _work(self):
+        while True:
+            with self._condition:
+                ticket = self._next()
+                while ticket is None:
+                    self._condition.wait()
+                    ticket = self._next()
+                self._waiting.remove(ticket)
+                lane, _, host, (future, func, args, kwargs) = ticket
+                self._active[host] = self._active.get(host, 0) + 1
+                self._lanes[lane] += 1
+                # There may be free workers for other jobs too
+                self._condition.notify_all()
+            result = error = None
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                error = sys.exc_info()[1:]
+            finally:
+                with self._condition:
+                    self._active[host] -= 1
+                    if not self._active[host]:
+                        del self._active[host]
+                    self._lanes[lane] -= 1
+                    self._condition.notify_all()
+            if error is not None:
+                set_exception(future, *error)
+            elif isinstance(result, futures.Future):
+                chain(result, future)
+            else:
+                future.set_result(result)
+            del result, error, future, func, args, kwargs, ticket
+
+    def stats(self):
+        """
+        Returns the number of running and waiting jobs, in total and for
+        each CKAN site and lane
+
+        :rtype: dict
+        """
+        with self._condition:
+            hosts = {}
+            for host, active in self._active.items():
+                hosts[host] = {'active': active, 'queued': 0}
+            lanes = {}
+            for lane, name in LANE_NAMES.items():
+                lanes[name] = {'workers': self.lane_workers[lane],
+                               'active': self._lanes[lane], 'queued': 0}
+            for lane, _, host, _ in self._waiting:
+                hosts.setdefault(host, {'active': 0, 'queued': 0})
+                hosts[host]['queued'] += 1
+                lanes[LANE_NAMES[lane]]['queued'] += 1
+            return {
+                'workers': self.workers,
+                'host_workers': self.host_workers,
+                'active': sum(self._active.values()),
+                'queued': len(self._waiting),
+                'lanes': lanes,
+                'hosts': hosts,
+            }
+
+
+class JobCoalescer(object):
+    """
+    Merges the jobs submitted for a resource while another one is pending
+
+    A resource has at most one running job and one waiting job. A job for a
+    resource with a running job is started once it has finished, unless
+    another job is already waiting, in which case it's merged into that one
+    and ends with that one instead.
+
+    :param merge: Called with the metadata of the waiting job and of a job
+        merged into it, returns the metadata to run the waiting job with
+    :type merge: callable
+    """
+
+    def __init__(self, merge):
+        self._merge = merge
+        self._lock = threading.Lock()
+        self._resources = {}
+
+    def submit(self, key, metadata, start, merged=None):
+        """
+        Starts a job once the running job of its resource has finished
+
+        Returns a future of the result of the job. That of a job merged into
+        a waiting one ends once that job has pushed the resource, with the
+        result of ``merged``, and fails with the error of that job if it
+        failed.
+
+        :param key: The resource of the job, like ``(ckan_url, resource_id)``
+        :type key: tuple
+        :param metadata: The metadata of the job
+        :type metadata: dict
+        :param start: Called with the metadata the job must run with, with
+            that of the jobs merged into it, starts the job and returns its
+            future
+        :type start: callable
+        :param merged: Called with no arguments when a job merged into
+            another one ends
+        :type merged: callable
+        """
+        with self._lock:
+            resource = self._resources.get(key)
+            if resource is None:
+                self._resources[key] = {'waiting': None}
+            elif resource['waiting'] is None:
+                resource['waiting'] = metadata
+                resource['start'] = start
+                resource['future'] = future = futures.Future()
+                return future
+            else:
+                resource['waiting'] = self._merge(resource['waiting'],
+                                                  metadata)
+                future = futures.Future()
+                chain(resource['future'], future, merged or (lambda: None))
+                return future
+        return self._start(key, metadata, start)
+
+    def _start(self, key, metadata, start):
+        try:
+            future = start(metadata)
+        except Exception:
+            future = futures.Future()
+            set_exception(future, *sys.exc_info()[1:])
+        future.add_done_callback(lambda future: self._finish(key))
+        return future
+
+    def _finish(self, key):
+        # Starts the waiting job of a resource once its running job is done
+        with self._lock:
+            resource = self._resources[key]
+            if resource['waiting'] is None:
+                del self._resources[key]
+                return
+            metadata = resource['waiting']
+            start = resource.pop('start')
+            future = resource.pop('future')
+            resource['waiting'] = None
+        chain(self._start(key, metadata, start), future)
+
+    def stats(self):
+        """
+        Returns the number of resources with a running job, and with a
+        waiting one
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'running': len(self._resources),
+                'waiting': sum(1 for resource in self._resources.values()
+                               if resource['waiting'] is not None),
+            }
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""State the DataPusher keeps about resources between jobs.
+
+Things like the validators of the last downloaded file are stored as JSON
+values, per CKAN site, resource and key, in a table of the jobs database set
+up by ckanserviceprovider (``SQLALCHEMY_DATABASE_URI``). The hashes of the
+rows last pushed for resources with a key column are kept in another table.
+
+"""
+import itertools
+import json
+import threading
+
+import sqlalchemy
+from ckanserviceprovider import db
+
+_tables = None
+_tables_engine = None
+_tables_lock = threading.Lock()
+
+
+def _get_tables():
+    """Return the state tables, creating them in the jobs database if needed.
+
+    ckanserviceprovider (re)creates the engine when the app is initialised,
+    so the tables are bound to whatever engine is current.
+
+    """
+    global _tables, _tables_engine
+    with _tables_lock:
+        if _tables_engine is not db.ENGINE:
+            metadata = sqlalchemy.MetaData()
+            state = sqlalchemy.Table(
+                'datapusher_resource_state',
+                metadata,
+                sqlalchemy.Column('ckan_url', sqlalchemy.UnicodeText,
+                                  primary_key=True),
+                sqlalchemy.Column('resource_id', sqlalchemy.UnicodeText,
+                                  primary_key=True),
+                sqlalchemy.Column('key', sqlalchemy.UnicodeText,
+                                  primary_key=True),
+                sqlalchemy.Column('value', sqlalchemy.UnicodeText),
+            )
+            row_index = sqlalchemy.Table(
+                'datapusher_row_index',
+                metadata,
+                sqlalchemy.Column('ckan_url', sqlalchemy.UnicodeText,
+                                  primary_key=True),
+                sqlalchemy.Column('resource_id', sqlalchemy.UnicodeText,
+                                  primary_key=True),
+                sqlalchemy.Column('row_key', sqlalchemy.UnicodeText,
+                                  primary_key=True),
+                sqlalchemy.Column('row_hash', sqlalchemy.UnicodeText),
+            )
+            metadata.create_all(db.ENGINE)
+            _tables = state, row_index
+            _tables_engine = db.ENGINE
+        return _tables
+
+
+def _get_table():
+    return _get_tables()[0]
+
+
+def _where(table, ckan_url, resource_id, key):
+    return sqlalchemy.and_(table.c.ckan_url == str(ckan_url),
+                           table.c.resource_id == str(resource_id),
+                           table.c.key == str(key))
+
+
+def get_state(ckan_url, resource_id, key, default=None):
+    """Return the value stored for a resource under the given key.
+
+    :param ckan_url: base URL of the CKAN site of the resource
+    :type ckan_url: string
+
+    :param default: value returned if nothing is stored
+    """
+    table = _get_table()
+    row = db.ENGINE.execute(
+        sqlalchemy.select([table.c.value]).where(
+            _where(table, ckan_url, resource_id, key))).first()
+    if row is None:
+        return default
+    return json.loads(row[0])
+
+
+def set_state(ckan_url, resource_id, key, value):
+    """Store a JSON-serializable value for a resource under the given key."""
+    table = _get_table()
+    value = str(json.dumps(value))
+    where = _where(table, ckan_url, resource_id, key)
+    result = db.ENGINE.execute(table.update().where(where).values(value=value))
+    if result.rowcount:
+        return
+    try:
+        db.ENGINE.execute(table.insert().values(
+            ckan_url=str(ckan_url), resource_id=str(resource_id),
+            key=str(key), value=value))
+    except sqlalchemy.exc.IntegrityError:
+        # Another job inserted it in the meantime
+        db.ENGINE.execute(table.update().where(where).values(value=value))
+
+
+def delete_state(ckan_url, resource_id, key):
+    """Delete the value stored for a resource under the given key."""
+    table = _get_table()
+    db.ENGINE.execute(
+        table.delete().where(_where(table, ckan_url, resource_id, key)))
+
+
+def get_row_index(ckan_url, resource_id):
+    """Yield the ``(key, hash)`` of each row last pushed for a resource.
+
+    The rows are read from the database as they are yielded.
+
+    """
+    table = _get_tables()[1]
+    result = db.ENGINE.execute(
+        sqlalchemy.select([table.c.row_key, table.c.row_hash]).where(
+            sqlalchemy.and_(table.c.ckan_url == str(ckan_url),
+                            table.c.resource_id == str(resource_id))))
+    try:
+        for row in result:
+            yield row[0], row[1]
+    finally:
+        result.close()
+
+
+def set_row_index(ckan_url, resource_id, rows, batch_size=1000):
+    """Replace the index of the rows pushed for a resource.
+
+    :param rows: the ``(key, hash)`` of each row, with unique keys
+    :type rows: iterable of tuples
+
+    """
+    table = _get_tables()[1]
+    rows = iter(rows)
+    with db.ENGINE.begin() as connection:
+        _delete_row_index(connection, table, ckan_url, resource_id)
+        while True:
+            batch = [{'ckan_url': str(ckan_url),
+                      'resource_id': str(resource_id),
+                      'row_key': key, 'row_hash': hash_}
+                     for key, hash_ in itertools.islice(rows, batch_size)]
+            if not batch:
+                break
+            connection.execute(table.insert(), batch)
+
+
+def delete_row_index(ckan_url, resource_id):
+    """Delete the index of the rows pushed for a resource."""
+    table = _get_tables()[1]
+    _delete_row_index(db.ENGINE, table, ckan_url, resource_id)
+
+
+def _delete_row_index(connection, table, ckan_url, resource_id):
+    connection.execute(table.delete().where(
+        sqlalchemy.and_(table.c.ckan_url == str(ckan_url),
+                        table.c.resource_id == str(resource_id))))
@@ -21,13 +21,59 @@ SQLALCHEMY_DATABASE_URI = os.environ.get('DATAPUSHER_SQLALCHEMY_DATABASE_URI', '
 # Download and streaming settings
 
 MAX_CONTENT_LENGTH = int(os.environ.get('DATAPUSHER_MAX_CONTENT_LENGTH', '1024000'))
+MAX_DECOMPRESSED_LENGTH = int(os.environ.get('DATAPUSHER_MAX_DECOMPRESSED_LENGTH', MAX_CONTENT_LENGTH))
 CHUNK_SIZE = int(os.environ.get('DATAPUSHER_CHUNK_SIZE', '16384'))
 CHUNK_INSERT_ROWS = int(os.environ.get('DATAPUSHER_CHUNK_INSERT_ROWS', '250'))
+CHUNK_INSERT_WORKERS = int(os.environ.get('DATAPUSHER_CHUNK_INSERT_WORKERS', '1'))
+CHUNK_INSERT_MIN_ROWS = int(os.environ.get('DATAPUSHER_CHUNK_INSERT_MIN_ROWS', '10'))
+CHUNK_INSERT_MAX_ROWS = int(os.environ.get('DATAPUSHER_CHUNK_INSERT_MAX_ROWS', '20000'))
+CHUNK_INSERT_BYTES = int(os.environ.get('DATAPUSHER_CHUNK_INSERT_BYTES', '1000000'))
+CHUNK_INSERT_SECONDS = float(os.environ.get('DATAPUSHER_CHUNK_INSERT_SECONDS', '5'))
+CHUNK_INSERT_STREAM = bool(int(os.environ.get('DATAPUSHER_CHUNK_INSERT_STREAM', '0')))
+STAGE_RECORDS = bool(int(os.environ.get('DATAPUSHER_STAGE_RECORDS', '0')))
+INCREMENTAL_PUSH = bool(int(os.environ.get('DATAPUSHER_INCREMENTAL_PUSH', '0')))
+CONTENT_FINGERPRINT = bool(int(os.environ.get('DATAPUSHER_CONTENT_FINGERPRINT', '0')))
 DOWNLOAD_TIMEOUT = int(os.environ.get('DATAPUSHER_DOWNLOAD_TIMEOUT', '30'))
+DOWNLOAD_WORKERS = int(os.environ.get('DATAPUSHER_DOWNLOAD_WORKERS', '4'))
+DOWNLOAD_RANGE_SIZE = int(os.environ.get('DATAPUSHER_DOWNLOAD_RANGE_SIZE', '4194304'))
+DOWNLOAD_CACHE_DIR = os.environ.get('DATAPUSHER_DOWNLOAD_CACHE_DIR')
+DOWNLOAD_CACHE_SIZE = int(os.environ.get('DATAPUSHER_DOWNLOAD_CACHE_SIZE', '1073741824'))
+DOWNLOAD_CACHE_TTL = int(os.environ.get('DATAPUSHER_DOWNLOAD_CACHE_TTL', '3600'))
+STREAM_PARSE = bool(int(os.environ.get('DATAPUSHER_STREAM_PARSE', '0')))
+
+# Parser engine: 'messytables' or 'csv'
+PARSER = os.environ.get('DATAPUSHER_PARSER', 'messytables')
+# Rows used to guess the column types, 0 for the parser's sample
+TYPE_GUESS_ROWS = int(os.environ.get('DATAPUSHER_TYPE_GUESS_ROWS', '0'))
+TIMESTAMP_CACHE_SIZE = int(os.environ.get('DATAPUSHER_TIMESTAMP_CACHE_SIZE', '10000'))
+# Processes parsing large files read by the csv engine (1 to parse them in the job)
+PARSE_WORKERS = int(os.environ.get('DATAPUSHER_PARSE_WORKERS', '1'))
+PARSE_RANGE_SIZE = int(os.environ.get('DATAPUSHER_PARSE_RANGE_SIZE', '4194304'))
+
+# Push jobs run at the same time, in total and per CKAN site (0 for no limit)
+JOB_WORKERS = int(os.environ.get('DATAPUSHER_JOB_WORKERS', '10'))
+JOB_HOST_WORKERS = int(os.environ.get('DATAPUSHER_JOB_HOST_WORKERS', '0'))
+# Lanes by file size, each with its own number of workers (0 for JOB_WORKERS)
+SMALL_FILE_SIZE = int(os.environ.get('DATAPUSHER_SMALL_FILE_SIZE', '1048576'))
+LARGE_FILE_SIZE = int(os.environ.get('DATAPUSHER_LARGE_FILE_SIZE', '10485760'))
+JOB_SMALL_WORKERS = int(os.environ.get('DATAPUSHER_JOB_SMALL_WORKERS', '0'))
+JOB_MEDIUM_WORKERS = int(os.environ.get('DATAPUSHER_JOB_MEDIUM_WORKERS', '0'))
+JOB_LARGE_WORKERS = int(os.environ.get('DATAPUSHER_JOB_LARGE_WORKERS', '0'))
+SIZE_HEAD_REQUEST = bool(int(os.environ.get('DATAPUSHER_SIZE_HEAD_REQUEST', '1')))
+SIZE_HEAD_TIMEOUT = int(os.environ.get('DATAPUSHER_SIZE_HEAD_TIMEOUT', '5'))
+COALESCE_JOBS = bool(int(os.environ.get('DATAPUSHER_COALESCE_JOBS', '1')))
+
+# Push the other sheets of workbooks to tables of their own
+PUSH_SHEETS = bool(int(os.environ.get('DATAPUSHER_PUSH_SHEETS', '0')))
+SHEET_WORKERS = int(os.environ.get('DATAPUSHER_SHEET_WORKERS', '4'))
 
 # Verify SSL
 SSL_VERIFY = os.environ.get('DATAPUSHER_SSL_VERIFY', True)
 
+# Connection pool for the CKAN API calls
+CKAN_POOL_SIZE = int(os.environ.get('DATAPUSHER_CKAN_POOL_SIZE', '10'))
+CKAN_MAX_RETRIES = int(os.environ.get('DATAPUSHER_CKAN_MAX_RETRIES', '3'))
+
 # logging
 LOG_FILE = os.environ.get('DATAPUSHER_LOG_FILE', '/tmp/ckan_service.log')
 STDERR = bool(int(os.environ.get('DATAPUSHER_STDERR', '1')))
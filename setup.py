@@ -62,6 +62,16 @@ setup(
     # https://packaging.python.org/en/latest/technical.html#install-requires-vs-requirements-files
     install_requires=[],
 
+    # Optional dependencies, installed with e.g. ``pip install -e .[xlsx]``.
+    # openpyxl reads XLSX files one sheet at a time, 2.6 is the last version
+    # supporting Python 2.
+    extras_require={
+        'xlsx': [
+            'openpyxl>=2.6,<2.7; python_version < "3"',
+            'openpyxl>=2.6; python_version >= "3"',
+        ],
+    },
+
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
     # have to be included in MANIFEST.in as well.
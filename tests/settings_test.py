@@ -1,6 +1,11 @@
+import os
+import tempfile
+
 DEBUG = True
 TESTING = True
 
-SQLALCHEMY_DATABASE_URI = 'sqlite://'
+# A file, so that the worker threads of the jobs share it
+SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(),
+                                                      'datapusher.db')
 
 NAME = 'datapusher'
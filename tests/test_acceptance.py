@@ -13,6 +13,8 @@ that the right values were pushed?
 import os
 import json
 import datetime
+import gzip
+import io
 
 import httpretty
 import pytest
@@ -23,6 +25,7 @@ except ImportError:
 
 import datapusher.main as main
 import datapusher.jobs as jobs
+import datapusher.parsers as parsers
 import ckanserviceprovider.util as util
 
 os.environ['JOB_CONFIG'] = os.path.join(os.path.dirname(__file__),
@@ -39,7 +42,23 @@ def get_static_file(filename):
     return open(join_static_path(filename), 'rb').read()
 
 
+def gzipped(data):
+    # gzip.compress is Python 3 only
+    body = io.BytesIO()
+    with gzip.GzipFile(fileobj=body, mode='wb') as f:
+        f.write(data)
+    return body.getvalue()
+
+
 class TestImport():
+    @pytest.fixture(autouse=True, params=['messytables', 'csv'])
+    def parser(self, request, monkeypatch):
+        '''Run every test against both parser engines.'''
+        if request.param == 'csv' and not parsers.CSV_ENGINE:
+            pytest.skip('The csv engine needs Python 3')
+        monkeypatch.setattr(jobs, 'PARSER', request.param)
+        return request.param
+
     @classmethod
     def setup_class(cls):
         cls.host = 'www.ckan.org'
@@ -174,6 +193,53 @@ class TestImport():
         with pytest.raises(util.JobError):
             jobs.push_to_datastore('fake_id', data, True)
 
+    @httpretty.activate
+    def test_gzipped_csv(self):
+        """Compressed files are decompressed before being parsed.
+
+        The format of the file they contain is told by its name.
+
+        """
+        source_url = 'http://www.source.org/static/simple.csv.gz'
+        self.register_urls(format='', source_url=source_url)
+        httpretty.register_uri(
+            httpretty.GET, source_url,
+            body=gzipped(get_static_file('simple.csv')),
+            content_type='application/gzip')
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': self.resource_id
+            }
+        }
+
+        headers, results = jobs.push_to_datastore('fake_id', data, True)
+        assert [h['id'] for h in headers] == ['date', 'temperature', 'place']
+        assert len(list(results)) == 6
+
+    @httpretty.activate
+    def test_too_large_decompressed_file(self):
+        """It should raise JobError if a file decompresses to too much."""
+        source_url = 'http://www.source.org/static/file.csv.gz'
+        self.register_urls(source_url=source_url)
+        httpretty.register_uri(
+            httpretty.GET, source_url,
+            body=gzipped(b'a' * (jobs.MAX_DECOMPRESSED_LENGTH + 1)),
+            content_type='application/gzip')
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': self.resource_id
+            }
+        }
+
+        with pytest.raises(util.JobError):
+            jobs.push_to_datastore('fake_id', data, True)
+
     @httpretty.activate
     def test_content_length_string(self):
         """If the Content-Length header value is a string, just ignore it.
@@ -255,6 +321,31 @@ class TestImport():
             {'date': datetime.datetime(2011, 1, 1, 0, 0), 'place': 'Galway',
              'temperature': 1})
 
+    @httpretty.activate
+    def test_simple_csv_stream_parse(self, monkeypatch):
+        """A CSV file parsed while it's downloaded gives the same results."""
+        monkeypatch.setattr(jobs, 'STREAM_PARSE', True)
+        self.register_urls()
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': self.resource_id
+            }
+        }
+
+        headers, results = jobs.push_to_datastore('fake_id', data, True)
+        results = list(results)
+        assert (headers == [{'type': 'timestamp', 'id': 'date'},
+                            {'type': 'numeric', 'id': 'temperature'},
+                            {'type': 'text', 'id': 'place'}])
+        assert len(results) == 6
+        assert (
+            results[0] ==
+            {'date': datetime.datetime(2011, 1, 1, 0, 0), 'place': 'Galway',
+             'temperature': 1})
+
     @httpretty.activate
     def test_simple_tsv(self):
         """Test successfully fetching and parsing a simple TSV file.
@@ -344,6 +435,37 @@ class TestImport():
                      {'date': datetime.datetime(2011, 1, 1, 0, 0),
                       'place': 'Galway', 'temperature': 1})
 
+    @httpretty.activate
+    def test_simple_xlsx(self):
+        """Test successfully fetching and parsing a simple XLSX file.
+
+        The file is read by openpyxl in read-only mode, and gives the same
+        headers and rows as the XLS one.
+
+        """
+        pytest.importorskip('openpyxl')
+        self.register_urls(
+            'simple.xlsx', 'xlsx', 'application/vnd.openxmlformats-'
+            'officedocument.spreadsheetml.sheet')
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': self.resource_id
+            }
+        }
+
+        headers, results = jobs.push_to_datastore('fake_id', data, True)
+        results = list(results)
+        assert (headers == [{'type': 'timestamp', 'id': 'date'},
+                               {'type': 'numeric', 'id': 'temperature'},
+                               {'type': 'text', 'id': 'place'}])
+        assert len(results) == 6
+        assert (results[0] ==
+                     {'date': datetime.datetime(2011, 1, 1, 0, 0),
+                      'place': 'Galway', 'temperature': 1})
+
     @httpretty.activate
     def test_real_csv(self):
         """Test fetching and parsing a more realistic CSV file.
@@ -484,6 +606,35 @@ class TestImport():
         assert len(headers) == 19
         assert len(results) == 133
 
+    @httpretty.activate
+    def test_type_guess_rows(self, monkeypatch):
+        """The number of rows used to guess the types can be set.
+
+        The rows read to guess the types are pushed like the others.
+
+        """
+        monkeypatch.setattr(jobs, 'TYPE_GUESS_ROWS', 2)
+        self.register_urls()
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': self.resource_id
+            }
+        }
+
+        headers, results = jobs.push_to_datastore('fake_id', data, True)
+        results = list(results)
+        assert (headers == [{'type': 'timestamp', 'id': 'date'},
+                            {'type': 'numeric', 'id': 'temperature'},
+                            {'type': 'text', 'id': 'place'}])
+        assert len(results) == 6
+        assert (
+            results[0] ==
+            {'date': datetime.datetime(2011, 1, 1, 0, 0), 'place': 'Galway',
+             'temperature': 1})
+
     @httpretty.activate
     def test_long_file(self):
         """Test fetching and parsing a long CSV file.
@@ -551,6 +702,43 @@ class TestImport():
         # returns something
         assert not res, res
 
+    @httpretty.activate
+    def test_do_not_push_when_same_hash_stream_parse(self, monkeypatch):
+        """An unchanged file isn't pushed when it's parsed as it downloads.
+
+        The hash is only known once the download is complete, so the job
+        waits for it before touching the datastore.
+
+        """
+        monkeypatch.setattr(jobs, 'STREAM_PARSE', True)
+        source_url, res_url = self.register_urls()
+        httpretty.register_uri(
+            httpretty.POST, res_url,
+            body=json.dumps({
+                'success': True,
+                'result': {
+                    'id': '32h4345k34h5l345',
+                    'name': 'short name',
+                    'url': source_url,
+                    'format': 'csv',
+                    'hash': '0ccb75d277ec2da41faae58642e3fb11'
+                }
+            }),
+            content_type='application/json')
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': self.resource_id
+            }
+        }
+
+        res = jobs.push_to_datastore('fake_id', data, True)
+        assert not res, res
+        assert httpretty.last_request().path != \
+            '/api/3/action/datastore_delete'
+
     @httpretty.activate
     def test_download_resource_with_callbach_url_base_on_uploads(self):
         """
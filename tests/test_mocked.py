@@ -4,12 +4,16 @@ Test the whole datapusher but mock the CKAN datastore.
 '''
 
 import os
+import io
 import json
+import re
 
 import pytest
 import httpretty
+import messytables
 
 import datapusher.main as main
+import datapusher.cache as cache
 import datapusher.jobs as jobs
 import ckanserviceprovider.util as util
 
@@ -112,3 +116,532 @@ class TestImport():
 
         with pytest.raises(util.JobError):
             jobs.push_to_datastore('fake_id', data)
+
+    @httpretty.activate
+    def test_conditional_download(self):
+        """A file is not downloaded again if the source says it's unchanged.
+
+        The validators of a pushed file are sent with the next request for
+        it, and a 304 Not Modified response ends the job.
+
+        """
+        self.register_urls()
+        source_url = 'http://www.source.org/static/simple.csv'
+        httpretty.register_uri(httpretty.GET, source_url,
+                               body=get_static_file('simple.csv'),
+                               content_type="application/csv",
+                               adding_headers={
+                                   'ETag': '"abc"',
+                                   'Last-Modified':
+                                       'Wed, 21 Oct 2015 07:28:00 GMT'})
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': 'conditional-download'
+            }
+        }
+
+        jobs.push_to_datastore('fake_id', data)
+
+        httpretty.register_uri(httpretty.GET, source_url, status=304, body='')
+        jobs.push_to_datastore('fake_id', data)
+
+        download = [r for r in httpretty.latest_requests()
+                    if r.path == '/static/simple.csv'][-1]
+        assert download.headers['If-None-Match'] == '"abc"'
+        assert (download.headers['If-Modified-Since'] ==
+                'Wed, 21 Oct 2015 07:28:00 GMT')
+        assert httpretty.last_request().path == '/static/simple.csv'
+
+    @httpretty.activate
+    def test_download_cache(self, monkeypatch, tmpdir):
+        """Resources with the same URL share the downloaded file."""
+        monkeypatch.setattr(jobs, 'DOWNLOAD_CACHE', cache.DownloadCache(
+            str(tmpdir), 1000000, 3600))
+        self.register_urls()
+        source_url = 'http://www.source.org/static/simple.csv'
+        httpretty.register_uri(httpretty.GET, source_url,
+                               body=get_static_file('simple.csv'),
+                               content_type="application/csv",
+                               adding_headers={'ETag': '"abc"'})
+
+        def push(resource_id):
+            jobs.push_to_datastore('fake_id', {
+                'api_key': self.api_key,
+                'job_type': 'push_to_datastore',
+                'metadata': {
+                    'ckan_url': 'http://%s/' % self.host,
+                    'resource_id': resource_id
+                }
+            })
+            create = json.loads(httpretty.last_request().body)
+            assert len(create['records']) == 6
+
+        push('download-cache-1')
+        # It would fail if it was downloaded again
+        httpretty.register_uri(httpretty.GET, source_url, status=500)
+        push('download-cache-2')
+
+        # Once it's stale, it's only served if the server says it's the same
+        jobs.DOWNLOAD_CACHE.ttl = 0
+        httpretty.register_uri(httpretty.GET, source_url, status=304, body='')
+        push('download-cache-3')
+        download = [r for r in httpretty.latest_requests()
+                    if r.path == '/static/simple.csv'][-1]
+        assert download.headers['If-None-Match'] == '"abc"'
+
+    @httpretty.activate
+    def test_conditional_download_ignore_hash(self):
+        """No validators are sent when the hash has to be ignored."""
+        self.register_urls()
+        source_url = 'http://www.source.org/static/simple.csv'
+        httpretty.register_uri(httpretty.GET, source_url,
+                               body=get_static_file('simple.csv'),
+                               content_type="application/csv",
+                               adding_headers={'ETag': '"abc"'})
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': 'conditional-download-ignore-hash',
+                'ignore_hash': True
+            }
+        }
+
+        jobs.push_to_datastore('fake_id', data)
+        jobs.push_to_datastore('fake_id', data)
+
+        download = [r for r in httpretty.latest_requests()
+                    if r.path == '/static/simple.csv'][-1]
+        assert 'If-None-Match' not in download.headers
+        assert (httpretty.last_request().path ==
+                '/api/3/action/datastore_create')
+
+    @httpretty.activate
+    def test_stage_records(self, monkeypatch):
+        """The existing table is only deleted once the file has been read."""
+        monkeypatch.setattr(jobs, 'STAGE_RECORDS', True)
+        self.register_urls()
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': self.resource_id
+            }
+        }
+
+        jobs.push_to_datastore('fake_id', data)
+
+        paths = [r.path for r in httpretty.latest_requests()]
+        assert paths.index('/static/simple.csv') < \
+            paths.index('/api/3/action/datastore_delete') < \
+            paths.index('/api/3/action/datastore_create')
+        create = json.loads(httpretty.last_request().body)
+        assert len(create['records']) == 6
+
+    @httpretty.activate
+    def test_stage_records_unreadable_file(self, monkeypatch):
+        """A file that can't be read leaves the existing table alone."""
+        monkeypatch.setattr(jobs, 'STAGE_RECORDS', True)
+        self.register_urls()
+        body = 'a,b\n' + '1,2\n' * 1500 + '3,"' + 'x' * 300000 + '"\n'
+        httpretty.register_uri(httpretty.GET,
+                               'http://www.source.org/static/simple.csv',
+                               body=body, content_type="application/csv")
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': self.resource_id
+            }
+        }
+
+        with pytest.raises(messytables.ReadError):
+            jobs.push_to_datastore('fake_id', data)
+
+        paths = [r.path for r in httpretty.latest_requests()]
+        assert '/api/3/action/datastore_delete' not in paths
+        assert '/api/3/action/datastore_create' not in paths
+
+    @httpretty.activate
+    def test_content_fingerprint(self, monkeypatch):
+        """A file with the same content written differently isn't pushed."""
+        monkeypatch.setattr(jobs, 'CONTENT_FINGERPRINT', True)
+        self.register_urls()
+        source_url = 'http://www.source.org/static/simple.csv'
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': 'content-fingerprint'
+            }
+        }
+        jobs.push_to_datastore('fake_id', data)
+        requests_before = len(httpretty.latest_requests())
+
+        # Quoted, with other line endings, columns and number formats
+        body = ('"place","date","temperature"\r\n'
+                '"Galway","2011-01-01","1.0"\r\n'
+                '"Galway","2011-01-02","-1"\r\n'
+                '"Galway","2011-01-03","0.00"\r\n'
+                '"Berkeley","2011-01-01","6"\r\n'
+                '"Berkeley","2011-01-02","8"\r\n'
+                '"Berkeley","2011-01-03","5"\r\n')
+        httpretty.register_uri(httpretty.GET, source_url, body=body,
+                               content_type="application/csv")
+        jobs.push_to_datastore('fake_id', data)
+
+        paths = [r.path for r in
+                 httpretty.latest_requests()[requests_before:]]
+        assert '/api/3/action/datastore_delete' not in paths
+        assert '/api/3/action/datastore_create' not in paths
+
+        httpretty.register_uri(httpretty.GET, source_url,
+                               body=body.replace('Berkeley', 'Oakland'),
+                               content_type="application/csv")
+        jobs.push_to_datastore('fake_id', data)
+        assert (httpretty.last_request().path ==
+                '/api/3/action/datastore_create')
+
+    @httpretty.activate
+    def test_sync_rows_by_key(self):
+        """Only the rows that changed are sent for resources with a key."""
+        self.register_urls()
+        source_url = 'http://www.source.org/static/simple.csv'
+        httpretty.register_uri(httpretty.GET, source_url,
+                               body='id,name\n1,a\n2,b\n3,c\n',
+                               content_type="application/csv")
+        datastore_upsert_url = \
+            'http://www.ckan.org/api/3/action/datastore_upsert'
+        httpretty.register_uri(httpretty.POST, datastore_upsert_url,
+                               body='{"success": true}',
+                               content_type="application/json")
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': 'sync-rows-by-key',
+                'primary_key': 'id',
+            }
+        }
+        jobs.push_to_datastore('fake_id', data)
+        create = json.loads(httpretty.last_request().body)
+        assert create['primary_key'] == 'id'
+        assert len(create['records']) == 3
+        requests_before = len(httpretty.latest_requests())
+
+        httpretty.register_uri(httpretty.GET, source_url,
+                               body='id,name\n1,a\n2,B\n4,d\n',
+                               content_type="application/csv")
+        jobs.push_to_datastore('fake_id', data)
+
+        requests = httpretty.latest_requests()[requests_before:]
+        paths = [r.path for r in requests]
+        assert '/api/3/action/datastore_create' not in paths
+        deletes = [json.loads(r.body) for r in requests
+                   if r.path == '/api/3/action/datastore_delete']
+        assert [str(k) for k in deletes[0]['filters']['id']] == ['3']
+        upsert = json.loads(httpretty.last_request().body)
+        assert upsert['method'] == 'upsert'
+        assert ([(str(r['id']), r['name']) for r in upsert['records']] ==
+                [('2', 'B'), ('4', 'd')])
+
+    @httpretty.activate
+    def test_sync_rows_duplicated_keys(self):
+        """A file whose keys aren't unique is pushed without a key."""
+        self.register_urls()
+        httpretty.register_uri(httpretty.GET,
+                               'http://www.source.org/static/simple.csv',
+                               body='id,name\n1,a\n1,b\n',
+                               content_type="application/csv")
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': 'sync-rows-duplicated-keys',
+                'primary_key': 'id',
+            }
+        }
+        jobs.push_to_datastore('fake_id', data)
+        create = json.loads(httpretty.last_request().body)
+        assert 'primary_key' not in create
+        assert len(create['records']) == 2
+
+    @httpretty.activate
+    def test_incremental_push(self, monkeypatch):
+        """Only the rows appended to a file are pushed again."""
+        monkeypatch.setattr(jobs, 'INCREMENTAL_PUSH', True)
+        self.register_urls()
+        datastore_upsert_url = \
+            'http://www.ckan.org/api/3/action/datastore_upsert'
+        httpretty.register_uri(httpretty.POST, datastore_upsert_url,
+                               body='{"success": true}',
+                               content_type="application/json")
+        source_url = 'http://www.source.org/static/simple.csv'
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': 'incremental-push'
+            }
+        }
+
+        body = get_static_file('simple.csv') + '\n'
+        httpretty.register_uri(httpretty.GET, source_url, body=body,
+                               content_type="application/csv")
+        jobs.push_to_datastore('fake_id', data)
+        assert (httpretty.last_request().path ==
+                '/api/3/action/datastore_create')
+
+        body += '2011-01-04,3,Berkeley\n2011-01-05,4,Galway\n'
+        httpretty.register_uri(httpretty.GET, source_url, body=body,
+                               content_type="application/csv")
+        jobs.push_to_datastore('fake_id', data)
+
+        paths = [r.path for r in httpretty.latest_requests()]
+        assert '/api/3/action/datastore_delete' not in paths[-4:]
+        upsert = json.loads(httpretty.last_request().body)
+        assert httpretty.last_request().path == \
+            '/api/3/action/datastore_upsert'
+        assert upsert['method'] == 'insert'
+        assert upsert['records'] == [
+            {'date': '2011-01-04T00:00:00', 'temperature': 3,
+             'place': 'Berkeley'},
+            {'date': '2011-01-05T00:00:00', 'temperature': 4,
+             'place': 'Galway'}]
+
+        # The rows pushed so far are remembered
+        body += '2011-01-06,5,Berkeley\n'
+        httpretty.register_uri(httpretty.GET, source_url, body=body,
+                               content_type="application/csv")
+        jobs.push_to_datastore('fake_id', data)
+        upsert = json.loads(httpretty.last_request().body)
+        assert len(upsert['records']) == 1
+
+    @httpretty.activate
+    def test_incremental_push_changed_file(self, monkeypatch):
+        """A file that didn't only have rows appended is pushed again."""
+        monkeypatch.setattr(jobs, 'INCREMENTAL_PUSH', True)
+        self.register_urls()
+        source_url = 'http://www.source.org/static/simple.csv'
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': 'incremental-push-changed-file'
+            }
+        }
+
+        body = get_static_file('simple.csv') + '\n'
+        httpretty.register_uri(httpretty.GET, source_url, body=body,
+                               content_type="application/csv")
+        jobs.push_to_datastore('fake_id', data)
+
+        body = body.replace('Galway', 'Gaillimh') + '2011-01-04,3,Berkeley\n'
+        httpretty.register_uri(httpretty.GET, source_url, body=body,
+                               content_type="application/csv")
+        jobs.push_to_datastore('fake_id', data)
+
+        paths = [r.path for r in httpretty.latest_requests()]
+        assert '/api/3/action/datastore_delete' in paths[-4:]
+        create = json.loads(httpretty.last_request().body)
+        assert httpretty.last_request().path == \
+            '/api/3/action/datastore_create'
+        assert len(create['records']) == 7
+
+    @httpretty.activate
+    def test_resume_failed_push(self, monkeypatch):
+        """A push that failed is resumed after the rows it stored."""
+        monkeypatch.setattr(jobs, 'CHUNK_INSERT_ROWS', 100)
+        monkeypatch.setattr(jobs, 'CHUNK_INSERT_MAX_ROWS', 100)
+        self.register_urls()
+        source_url = 'http://www.source.org/static/simple.csv'
+        body = 'n\n' + '\n'.join(str(i) for i in range(1000)) + '\n'
+        httpretty.register_uri(httpretty.GET, source_url, body=body,
+                               content_type="application/csv")
+        datastore_url = 'http://www.ckan.org/api/3/action/datastore_create'
+        httpretty.register_uri(
+            httpretty.POST, datastore_url,
+            responses=[
+                httpretty.Response(body='{"success": true}', status=200),
+                httpretty.Response(body='{"success": true}', status=200),
+                httpretty.Response(body='{"success": false}', status=502),
+            ])
+        datastore_upsert_url = \
+            'http://www.ckan.org/api/3/action/datastore_upsert'
+        httpretty.register_uri(httpretty.POST, datastore_upsert_url,
+                               body='{"success": true}',
+                               content_type="application/json")
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': 'resume-failed-push'
+            }
+        }
+
+        with pytest.raises(util.JobError):
+            jobs.push_to_datastore('fake_id', data)
+        requests_before = len(httpretty.latest_requests())
+
+        httpretty.register_uri(httpretty.GET, source_url, body=body,
+                               content_type="application/csv")
+        jobs.push_to_datastore('fake_id', data)
+
+        requests = httpretty.latest_requests()[requests_before:]
+        paths = [r.path for r in requests]
+        assert '/api/3/action/datastore_delete' not in paths
+        assert '/api/3/action/datastore_create' not in paths
+        upserts = [json.loads(r.body) for r in requests
+                   if r.path == '/api/3/action/datastore_upsert']
+        assert upserts[0]['records'][0] == {'n': 200}
+        assert (set(r['n'] for u in upserts for r in u['records']) ==
+                set(range(200, 1000)))
+
+        # Once the push succeeded there is nothing to resume anymore
+        httpretty.register_uri(httpretty.GET, source_url, body=body,
+                               content_type="application/csv")
+        jobs.push_to_datastore('fake_id', data)
+        assert (httpretty.last_request().path ==
+                '/api/3/action/datastore_create')
+
+    @httpretty.activate
+    def test_do_not_resume_when_rows_are_missing(self, monkeypatch):
+        """A push isn't resumed if the DataStore doesn't have its rows."""
+        monkeypatch.setattr(jobs, 'CHUNK_INSERT_ROWS', 2)
+        monkeypatch.setattr(jobs, 'CHUNK_INSERT_MIN_ROWS', 2)
+        monkeypatch.setattr(jobs, 'CHUNK_INSERT_MAX_ROWS', 2)
+        self.register_urls()
+        datastore_url = 'http://www.ckan.org/api/3/action/datastore_create'
+        httpretty.register_uri(
+            httpretty.POST, datastore_url,
+            responses=[
+                httpretty.Response(body='{"success": true}', status=200),
+                httpretty.Response(body='{"success": false}', status=502),
+            ] + [httpretty.Response(body='{"success": true}', status=200)
+                 for i in range(3)])
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': 'do-not-resume'
+            }
+        }
+        with pytest.raises(util.JobError):
+            jobs.push_to_datastore('fake_id', data)
+
+        source_url = 'http://www.source.org/static/simple.csv'
+        httpretty.register_uri(httpretty.GET, source_url,
+                               body=get_static_file('simple.csv'),
+                               content_type="application/csv")
+        datastore_check_url = \
+            'http://www.ckan.org/api/3/action/datastore_search'
+        httpretty.register_uri(httpretty.POST, datastore_check_url,
+                               body=json.dumps({
+                                   'success': True,
+                                   'result': {'fields': [], 'total': 4}}),
+                               content_type='application/json')
+        jobs.push_to_datastore('fake_id', data)
+
+        paths = [r.path for r in httpretty.latest_requests()]
+        assert '/api/3/action/datastore_upsert' not in paths
+        assert paths[-1] == '/api/3/action/datastore_create'
+
+    @httpretty.activate
+    def test_push_sheets(self, monkeypatch):
+        """The other sheets of a workbook are pushed to their own tables."""
+        openpyxl = pytest.importorskip('openpyxl')
+        # httpretty mixes up the requests made by several threads at once
+        monkeypatch.setattr(jobs, 'SHEET_WORKERS', 1)
+        self.register_urls()
+        workbook = openpyxl.Workbook()
+        workbook.active.title = 'first'
+        workbook.active.append(['a', 'b'])
+        workbook.active.append([1, 2])
+        workbook.create_sheet('second').append(['c'])
+        main_sheet = workbook.create_sheet('main')
+        main_sheet.append(['d'])
+        main_sheet.append([3])
+        body = io.BytesIO()
+        workbook.save(body)
+        source_url = 'http://www.source.org/static/workbook.xlsx'
+        httpretty.register_uri(
+            httpretty.GET, source_url, body=body.getvalue(),
+            content_type='application/vnd.openxmlformats-officedocument.'
+                         'spreadsheetml.sheet')
+        # Instead of the responses registered by register_urls
+        httpretty.register_uri(
+            httpretty.POST, re.compile(
+                re.escape('http://www.ckan.org/api/3/action/resource_show')),
+            body=json.dumps({'success': True, 'result': {
+                'id': 'push-sheets', 'name': 'workbook',
+                'package_id': 'dataset', 'url': source_url,
+                'format': 'XLSX'}}),
+            content_type='application/json', priority=1)
+        httpretty.register_uri(
+            httpretty.POST, re.compile(
+                re.escape('http://www.ckan.org/api/3/action/datastore_create')),
+            body=json.dumps({'success': True,
+                             'result': {'resource_id': 'sheet-resource'}}),
+            content_type='application/json', priority=1)
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': 'push-sheets',
+                'sheets': ['first'],
+            }
+        }
+        jobs.push_to_datastore('fake_id', data)
+
+        creates = [json.loads(r.body) for r in httpretty.latest_requests()
+                   if r.path == '/api/3/action/datastore_create']
+        # httpretty may record a request more than once
+        assert set(c['fields'][0]['id'] for c in creates
+                   if c.get('resource_id') == 'push-sheets') == set(['d'])
+        assert (set((c['resource']['package_id'], c['resource']['name'])
+                    for c in creates if 'resource' in c) ==
+                set([('dataset', 'workbook - first')]))
+        records = [c['records'] for c in creates
+                   if c.get('resource_id') == 'sheet-resource']
+        assert records and records[0] == [{'a': 1, 'b': 2}]
+        requests_before = len(httpretty.latest_requests())
+
+        # The table of the sheet is replaced the next time
+        data['metadata']['sheets'] = True
+        data['metadata']['ignore_hash'] = True
+        jobs.push_to_datastore('fake_id', data)
+        requests = httpretty.latest_requests()[requests_before:]
+        creates = [json.loads(r.body) for r in requests
+                   if r.path == '/api/3/action/datastore_create']
+        assert (set(c['resource']['name'] for c in creates
+                    if 'resource' in c) == set(['workbook - second']))
+        deletes = [json.loads(r.body)['id'] for r in requests
+                   if r.path == '/api/3/action/datastore_delete']
+        assert 'sheet-resource' in deletes
+
+    def test_invalid_sheets(self):
+        data = {
+            'api_key': self.api_key,
+            'job_type': 'push_to_datastore',
+            'metadata': {
+                'ckan_url': 'http://%s/' % self.host,
+                'resource_id': self.resource_id,
+                'sheets': 'first',
+            }
+        }
+        with pytest.raises(util.JobError):
+            jobs.push_to_datastore('fake_id', data)
@@ -3,15 +3,42 @@
 Test individual functions
 '''
 
+import bz2
+import gzip
+import hashlib
 import json
+import os
+import datetime
+import decimal
+import logging
+import threading
 import requests
+import io
+import tempfile
+import zipfile
 import pytest
 import httpretty
+import messytables
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED
+from apscheduler.schedulers.background import BackgroundScheduler
 
+import datapusher.cache as cache
+import datapusher.compression as compression
+import datapusher.inference as inference
 import datapusher.jobs as jobs
+import datapusher.parsers as parsers
+import datapusher.scheduler as scheduler
 import ckanserviceprovider.util as util
 
 
+def gzipped(data):
+    # gzip.compress is Python 3 only
+    body = io.BytesIO()
+    with gzip.GzipFile(fileobj=body, mode='wb') as f:
+        f.write(data)
+    return body.getvalue()
+
+
 class TestChunky():
     def test_simple(self):
         chunks = jobs.chunky('abcdefg', 3)
@@ -38,6 +65,906 @@ class TestChunky():
             list(chunks) == [])
 
 
+class TestAdaptiveChunker():
+    def test_records_are_encoded(self):
+        chunker = jobs.AdaptiveChunker(3, 1, 10, 1000, 5)
+        assert (
+            list(chunker.chunks([{'a': 1}, {'b': 'c'}])) ==
+            [(['{"a":1}', '{"b":"c"}'], True)])
+
+    def test_simple(self):
+        chunker = jobs.AdaptiveChunker(3, 1, 10, 1000, 5)
+        assert (
+            list(chunker.chunks('abcdefg')) ==
+            [
+                (['"a"', '"b"', '"c"'], False),
+                (['"d"', '"e"', '"f"'], False),
+                (['"g"'], True)
+             ])
+
+    def test_empty(self):
+        chunker = jobs.AdaptiveChunker(3, 1, 10, 1000, 5)
+        assert list(chunker.chunks('')) == []
+
+    def test_byte_budget(self):
+        # every record takes 4 bytes: '"a"' plus a separator
+        chunker = jobs.AdaptiveChunker(100, 1, 100, 10, 5)
+        assert (
+            list(chunker.chunks('abcde')) ==
+            [
+                (['"a"', '"b"'], False),
+                (['"c"', '"d"'], False),
+                (['"e"'], True)
+             ])
+
+    def test_record_larger_than_the_budget(self):
+        chunker = jobs.AdaptiveChunker(100, 1, 100, 2, 5)
+        assert list(chunker.chunks('ab')) == [(['"a"'], False), (['"b"'], True)]
+
+    def test_grows_when_fast(self):
+        chunker = jobs.AdaptiveChunker(4, 1, 10, 1000, 5)
+        chunker.record(4, 1)
+        assert chunker.rows == 8
+        chunker.record(8, 1)
+        assert chunker.rows == 10
+
+    def test_shrinks_when_slow(self):
+        chunker = jobs.AdaptiveChunker(8, 3, 10, 1000, 5)
+        chunker.record(8, 10)
+        assert chunker.rows == 4
+        chunker.record(4, 10)
+        assert chunker.rows == 3
+
+    def test_short_chunks_do_not_grow(self):
+        chunker = jobs.AdaptiveChunker(8, 1, 100, 1000, 5)
+        chunker.record(2, 1)
+        assert chunker.rows == 8
+
+    def test_sizes_follow_feedback(self):
+        chunker = jobs.AdaptiveChunker(2, 1, 10, 1000, 5)
+        sizes = []
+        for records, _ in chunker.chunks(range(20)):
+            sizes.append(len(records))
+            chunker.record(len(records), 1)
+        assert sizes == [2, 4, 8, 6]
+
+
+class TestCheckpoints():
+    def test_rows_stored_in_order(self):
+        saved = []
+        checkpoints = jobs.Checkpoints(10, saved.append)
+        checkpoints.sent(0, 5)
+        checkpoints.sent(2, 5)
+        assert saved == [15]
+        checkpoints.sent(1, 5)
+        assert saved == [15, 25]
+        assert checkpoints.rows == 25
+
+    def test_push_chunks_reports_stored_chunks(self):
+        sent = []
+        chunks = [([1, 2], False), ([3], False), ([4], False), ([5], True)]
+        count = jobs.push_chunks(chunks, lambda records, last: None, 2,
+                                 logging.getLogger(__name__),
+                                 sent=lambda i, n: sent.append((i, n)))
+        assert count == 5
+        assert sorted(sent) == [(0, 2), (1, 1), (2, 1), (3, 1)]
+
+    def test_push_chunks_reports_chunks_stored_before_an_error(self):
+        sent = []
+
+        def send_chunk(records, is_it_the_last_chunk):
+            if records == [3]:
+                raise util.JobError('No')
+
+        chunks = [([1, 2], False), ([3], False), ([4], True)]
+        with pytest.raises(util.JobError):
+            jobs.push_chunks(chunks, send_chunk, 1,
+                             logging.getLogger(__name__),
+                             sent=lambda i, n: sent.append((i, n)))
+        assert sent == [(0, 2)]
+
+
+class TestRecordSpool():
+    def test_records_are_staged_encoded(self):
+        spool = jobs.RecordSpool(iter([{'a': 1}, {'a': u'\xe9\n'}]))
+        assert spool.count == 2
+        assert list(spool) == ['{"a":1}', '{"a":"\\u00e9\\n"}']
+        # It can be read again
+        assert len(list(spool)) == 2
+        spool.close()
+
+    def test_chunks_of_encoded_records(self):
+        spool = jobs.RecordSpool({'a': i} for i in range(5))
+        chunker = jobs.AdaptiveChunker(2, 1, 10, 1000, 5)
+        assert (list(chunker.chunks(spool, encoded=True)) ==
+                [(['{"a":0}', '{"a":1}'], False),
+                 (['{"a":2}', '{"a":3}'], False),
+                 (['{"a":4}'], True)])
+
+
+class TestFingerprint():
+    headers = [{'id': 'a', 'type': 'numeric'}, {'id': 'b', 'type': 'text'}]
+
+    def fingerprint(self, headers, records):
+        fingerprint = jobs.Fingerprint(headers)
+        assert list(fingerprint.records(iter(records))) == records
+        return fingerprint.hexdigest()
+
+    def test_same_content(self):
+        assert (self.fingerprint(self.headers, [
+            {'a': decimal.Decimal('1.50'), 'b': 'x'}]) ==
+            self.fingerprint(self.headers[::-1], [
+                {'b': 'x', 'a': decimal.Decimal('1.5')}]))
+
+    def test_different_content(self):
+        records = [{'a': decimal.Decimal('1'), 'b': 'x'},
+                   {'a': decimal.Decimal('2'), 'b': 'y'}]
+        fingerprint = self.fingerprint(self.headers, records)
+        assert fingerprint != self.fingerprint(self.headers, records[::-1])
+        assert fingerprint != self.fingerprint(
+            [{'id': 'a', 'type': 'text'}, {'id': 'b', 'type': 'text'}],
+            records)
+
+
+class TestRowIndex():
+    def test_records_are_staged_in_order(self):
+        index = jobs.RowIndex(iter([{'id': 2, 'a': u'\xe9'}, {'id': 1}]),
+                              'id')
+        assert index.count == 2
+        assert index.unique()
+        assert list(index) == ['{"id":2,"a":"\\u00e9"}', '{"id":1}']
+        index.close()
+
+    def test_keys_must_be_unique(self):
+        index = jobs.RowIndex(iter([{'id': 1}, {'id': 1}]), 'id')
+        assert not index.unique()
+        index.close()
+        index = jobs.RowIndex(iter([{'id': 1}, {'id': None}]), 'id')
+        assert not index.unique()
+        index.close()
+
+    def test_changes(self):
+        previous = jobs.RowIndex(iter([
+            {'id': decimal.Decimal('1'), 'a': 'x'},
+            {'id': decimal.Decimal('2'), 'a': 'y'},
+            {'id': decimal.Decimal('3'), 'a': 'z'}]), 'id')
+        index = jobs.RowIndex(iter([
+            {'id': decimal.Decimal('4'), 'a': 'w'},
+            {'id': decimal.Decimal('2.0'), 'a': 'y'},
+            {'id': decimal.Decimal('1'), 'a': 'changed'}]), 'id')
+        index.compare(previous.hashes())
+        previous.close()
+        assert list(index.changed()) == ['{"id":"4","a":"w"}',
+                                         '{"id":"1","a":"changed"}']
+        assert list(index.deleted()) == ['3']
+        index.close()
+
+
+class TestPushChunks():
+    logger = logging.getLogger(__name__)
+
+    def test_first_and_last_chunks_sent_on_their_own(self):
+        lock = threading.Lock()
+        in_flight = []
+        sent = []
+
+        def send_chunk(records, is_last):
+            with lock:
+                in_flight.append(records)
+                # the first and last chunks never overlap with others
+                if records in (['a'], ['g']):
+                    assert len(in_flight) == 1
+            sent.append((records, is_last))
+            with lock:
+                in_flight.remove(records)
+
+        count = jobs.push_chunks(jobs.chunky('abcdefg', 1), send_chunk, 3,
+                                 self.logger)
+        assert count == 7
+        assert sent[0] == (['a'], False)
+        assert sent[-1] == (['g'], True)
+        assert sorted(r[0] for r, _ in sent[1:-1]) == list('bcdef')
+        assert not any(is_last for _, is_last in sent[:-1])
+
+    def test_single_chunk(self):
+        sent = []
+        count = jobs.push_chunks(jobs.chunky('ab', 3),
+                                 lambda *chunk: sent.append(chunk), 2,
+                                 self.logger)
+        assert count == 2
+        assert sent == [(['a', 'b'], True)]
+
+    def test_error_stops_the_upload(self):
+        sent = []
+
+        def send_chunk(records, is_last):
+            if records == ['c']:
+                raise util.JobError('failed')
+            sent.append(records)
+
+        with pytest.raises(util.JobError):
+            jobs.push_chunks(jobs.chunky('abcdefg', 1), send_chunk, 1,
+                             self.logger)
+        assert ['g'] not in sent
+
+
+class TestSheetPushes():
+    def test_messages_are_logged_by_the_job_thread(self):
+        threads = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                threads.append((threading.current_thread(),
+                                record.getMessage()))
+
+        logger = logging.getLogger('test_sheet_pushes')
+        logger.addHandler(Handler())
+        logger.setLevel(logging.DEBUG)
+
+        class Sheet(object):
+            def __init__(self, name):
+                self.name = name
+
+        def push(sheet, sheet_logger):
+            sheet_logger.info('Pushing {0}'.format(sheet.name))
+            if sheet.name == 'bad':
+                raise util.JobError('No rows')
+            return sheet.name.upper()
+
+        pushes = jobs.SheetPushes(push, [Sheet('a'), Sheet('b')], 2, logger)
+        assert pushes.wait() == {'a': 'A', 'b': 'B'}
+        assert (sorted(message for _, message in threads) ==
+                ['Pushing a', 'Pushing b'])
+        assert all(thread is threading.current_thread()
+                   for thread, _ in threads)
+
+        del threads[:]
+        pushes = jobs.SheetPushes(push, [Sheet('bad')], 2, logger)
+        with pytest.raises(util.JobError):
+            pushes.wait()
+        assert [message for _, message in threads] == [
+            'Pushing bad', 'Pushing sheet "bad" failed: No rows']
+
+
+class TestDatastoreCreateBody():
+    def test_body(self):
+        records = [jobs.encode_record(r) for r in [
+            {'date': datetime.datetime(2011, 1, 1, 0, 0),
+             'temperature': decimal.Decimal('1.5'), 'place': 'Galway'},
+            {'date': None, 'temperature': 1, 'place': 'Berkeley'}]]
+        body = b''.join(jobs.datastore_create_body(
+            {'resource_id': 'an_id', 'force': True}, records))
+        assert json.loads(body.decode('utf-8')) == {
+            'resource_id': 'an_id',
+            'force': True,
+            'records': [
+                {'date': '2011-01-01T00:00:00', 'temperature': '1.5',
+                 'place': 'Galway'},
+                {'date': None, 'temperature': 1, 'place': 'Berkeley'}]}
+
+    def test_no_records(self):
+        body = b''.join(jobs.datastore_create_body({'resource_id': 'an_id'},
+                                                   []))
+        assert json.loads(body.decode('utf-8')) == {'resource_id': 'an_id',
+                                                    'records': []}
+
+    def test_body_is_streamed_in_pieces(self):
+        records = [jobs.encode_record({'a': 'x' * 100})] * 1000
+        pieces = list(jobs.datastore_create_body({'resource_id': 'an_id'},
+                                                 records))
+        assert len(pieces) > 1
+        assert max(len(p) for p in pieces) < 2 * jobs.CHUNK_SIZE
+        assert len(json.loads(b''.join(pieces).decode('utf-8'))['records']) \
+            == 1000
+
+
+class TestRowIterator():
+    def row_set(self, data):
+        table_set = messytables.CSVTableSet(io.BytesIO(data))
+        row_set = table_set.tables.pop()
+        offset, headers = messytables.headers_guess(row_set.sample)
+        row_set.register_processor(messytables.headers_processor(headers))
+        row_set.register_processor(messytables.offset_processor(offset + 1))
+        return row_set, offset, headers
+
+    def test_records(self):
+        row_set, offset, headers = self.row_set(
+            b'date,temperature, place \n2011-01-02,-1,Galway\n,,\n')
+        types = [messytables.DateUtilType(), messytables.IntegerType(),
+                 messytables.StringType()]
+        assert list(jobs.row_iterator(row_set, headers, types, offset)) == [
+            {'date': datetime.datetime(2011, 1, 2), 'temperature': -1,
+             'place': 'Galway'},
+            {'date': None, 'temperature': None, 'place': ''}]
+
+    def test_unnamed_columns_and_short_rows(self):
+        row_set, offset, headers = self.row_set(
+            b'a,,c\n1,2,3\n4,5,6\n7\n')
+        types = [messytables.IntegerType()] * 3
+        assert list(jobs.row_iterator(row_set, headers, types, offset)) == [
+            {'a': 1, 'c': 3}, {'a': 4, 'c': 6}, {'a': 7, 'c': None}]
+
+    def test_values_that_can_not_be_cast_are_kept(self):
+        convert = jobs.column_converter(messytables.IntegerType())
+        assert convert('42') == 42
+        assert convert('n/a') == 'n/a'
+
+    def test_mojibake_is_repaired(self):
+        convert = jobs.column_converter(messytables.StringType())
+        assert convert(u'G\xc3\xb6ttingen') == u'G\xf6ttingen'
+        assert convert(u'G\xf6ttingen') == u'G\xf6ttingen'
+        assert convert(None) is None
+
+
+class TestBatchConverter():
+    def test_decimal(self):
+        convert = jobs.batch_converter(messytables.DecimalType(),
+                                       text_only=True)
+        assert (convert(['1.5', '', None, '2']) ==
+                [decimal.Decimal('1.5'), None, None, decimal.Decimal('2')])
+
+    def test_decimal_with_values_that_can_not_be_cast(self):
+        convert = jobs.batch_converter(messytables.DecimalType(),
+                                       text_only=True)
+        assert convert(['1.5', 'n/a']) == [decimal.Decimal('1.5'), 'n/a']
+
+    def test_numbers_are_not_empty(self):
+        convert = jobs.batch_converter(messytables.DecimalType())
+        assert convert([0.0, 1.5]) == [decimal.Decimal(0), decimal.Decimal(1.5)]
+
+
+class TestTypeGuess():
+    types = [messytables.StringType, messytables.DecimalType,
+             messytables.IntegerType, messytables.DateUtilType]
+
+    def test_types(self):
+        rows = [['1', '1.5', '2011-01-01', 'a', ''],
+                ['-2', '3', '01/02/2011 10:00', '1', None]]
+        assert (inference.type_guess(rows, types=self.types) ==
+                [messytables.IntegerType(), messytables.DecimalType(),
+                 messytables.DateUtilType(), messytables.StringType(),
+                 messytables.StringType()])
+
+    def test_same_as_messytables(self):
+        rows = [['1,000', '1e3', '2011-02-30', ' 7 ', 'yes'],
+                ['12', '.5', '2011-02-28', '8', 'no']]
+        cells = [[messytables.Cell(value) for value in row] for row in rows]
+        assert (inference.type_guess(rows, types=messytables.types.TYPES) ==
+                messytables.type_guess(cells, types=messytables.types.TYPES,
+                                       strict=True))
+
+    def test_width(self):
+        assert (inference.type_guess([['1'], ['2', 'a']], 3,
+                                     types=self.types) ==
+                [messytables.IntegerType(), messytables.StringType(),
+                 messytables.StringType()])
+
+    def test_no_rows(self):
+        assert inference.type_guess([], 2, types=self.types) == []
+
+    def test_one_failure_is_enough(self):
+        rows = [[str(i)] for i in range(100)] + [['x']]
+        assert (inference.type_guess(rows, types=self.types) ==
+                [messytables.StringType()])
+
+    def test_non_string_values(self):
+        rows = [[1.5, datetime.datetime(2011, 1, 1)],
+                [2, datetime.datetime(2012, 1, 1)]]
+        assert (inference.type_guess(rows, types=self.types) ==
+                [messytables.DecimalType(), messytables.DateUtilType()])
+
+
+class TestTimestamps():
+    def test_format(self):
+        assert (inference.timestamp_format(
+            ['2011-01-01', '2011-01-02 10:00', '2011-01-03']) == '%Y-%m-%d')
+
+    def test_format_must_agree_with_dateutil(self):
+        # dateutil reads these month first
+        assert inference.timestamp_format(['01/02/2011', '03/04/2011']) == \
+            '%m/%d/%Y'
+        # and day first only when the month can't be first, which no
+        # format does
+        assert (inference.timestamp_format(['13/02/2011', '14/02/2011'])
+                is None)
+
+    def test_no_format(self):
+        assert inference.timestamp_format(['10 oclock', '', None]) is None
+
+    def test_cast(self):
+        type_ = inference.TimestampType('%Y-%m-%d')
+        assert type_.cast('2011-01-02') == datetime.datetime(2011, 1, 2)
+        # Values with another format are parsed by dateutil
+        assert (type_.cast('Jan 3 2011 10:00') ==
+                datetime.datetime(2011, 1, 3, 10))
+        assert type_.cast('') is None
+        with pytest.raises(ValueError):
+            type_.cast('not a date')
+
+    def test_cache(self):
+        type_ = inference.TimestampType('%Y-%m-%d', cache_size=10)
+        assert type_.cast('2011-01-02') is type_.cast('2011-01-02')
+
+    def test_type_mapping(self):
+        assert str(inference.TimestampType()) == 'DateUtil'
+
+    def test_compile_timestamps(self):
+        types = [messytables.StringType(), messytables.DateUtilType()]
+        rows = [['a', '2011-01-01T10:00:00'], ['b', '2011-01-02T11:00:00']]
+        compiled = inference.compile_timestamps(types, rows)
+        assert compiled[0] == messytables.StringType()
+        assert isinstance(compiled[1], inference.TimestampType)
+        assert compiled[1].format == '%Y-%m-%dT%H:%M:%S'
+
+
+# Tests of the csv engine, which needs Python 3
+csv_engine = pytest.mark.skipif(not parsers.CSV_ENGINE,
+                                reason='The csv engine needs Python 3')
+
+
+class TestParsers():
+    @csv_engine
+    def test_csv(self):
+        table_set = parsers.any_tableset(io.BytesIO(b'a,b\n1,2\n'),
+                                         mimetype='text/csv')
+        row_set = table_set.tables[0]
+        assert isinstance(row_set, parsers.CSVRowSet)
+        assert list(row_set.values()) == [['a', 'b'], ['1', '2']]
+
+    @csv_engine
+    def test_sample_has_cells(self):
+        table_set = parsers.any_tableset(io.BytesIO(b'a;b\n1;2\n'),
+                                         extension='csv')
+        row_set = table_set.tables[0]
+        assert ([[c.value for c in row] for row in row_set.sample] ==
+                [['a', 'b'], ['1', '2']])
+
+    @csv_engine
+    def test_tsv(self):
+        table_set = parsers.any_tableset(io.BytesIO(b'a,b\tc\n1,2\t3\n'),
+                                         mimetype='text/tab-separated-values')
+        assert (list(table_set.tables[0].values()) ==
+                [['a,b', 'c'], ['1,2', '3']])
+
+    @csv_engine
+    def test_encoding(self):
+        table_set = parsers.any_tableset(
+            io.BytesIO(u'a,b\n\xe9t\xe9,2\n'.encode('utf-16')),
+            mimetype='text/csv')
+        assert (list(table_set.tables[0].values()) ==
+                [['a', 'b'], [u'\xe9t\xe9', '2']])
+
+    def test_csv_engine_is_off_on_python2(self, monkeypatch):
+        monkeypatch.setattr(parsers, 'CSV_ENGINE', False)
+        table_set = parsers.any_tableset(io.BytesIO(b'a,b\n1,2\n'),
+                                         mimetype='text/csv')
+        assert isinstance(table_set, messytables.CSVTableSet)
+
+    def test_other_formats_are_left_to_messytables(self):
+        table_set = parsers.any_tableset(
+            io.BytesIO(b'<table><tr><td>a</td></tr></table>'),
+            mimetype='text/html')
+        assert isinstance(table_set, messytables.HTMLTableSet)
+
+    def test_xls_is_read_one_sheet_at_a_time(self):
+        with open(os.path.join(os.path.dirname(__file__), 'static',
+                               'simple.xls'), 'rb') as f:
+            table_set = parsers.messytables_tableset(
+                f, mimetype='application/vnd.ms-excel')
+            assert isinstance(table_set, parsers.XLSTableSet)
+            row_set = table_set.tables.pop()
+            assert not table_set.workbook.sheet_loaded(row_set.index)
+            assert ([c.value for c in next(row_set.sample)] ==
+                    ['date', 'temperature', 'place'])
+            rows = list(row_set.values())
+            assert rows[1] == [datetime.datetime(2011, 1, 1), 1.0, 'Galway']
+            assert len(rows) == 7
+            assert not table_set.workbook.sheet_loaded(row_set.index)
+
+    def test_xlsx(self):
+        openpyxl = pytest.importorskip('openpyxl')
+        workbook = openpyxl.Workbook()
+        workbook.active.append(['a', 'b'])
+        workbook.active.append([1, datetime.datetime(2011, 1, 1)])
+        workbook.create_sheet('other').append(['c'])
+        f = io.BytesIO()
+        workbook.save(f)
+        f.seek(0)
+        # messytables gives XLSX files the mimetypes of XLS ones
+        table_set = parsers.any_tableset(f, mimetype='application/vnd.ms-excel')
+        assert isinstance(table_set, parsers.XLSXTableSet)
+        assert [t.name for t in table_set.tables] == ['Sheet', 'other']
+        row_set = table_set.tables[0]
+        assert ([[c.value for c in row] for row in row_set.sample] ==
+                [['a', 'b'], [1, datetime.datetime(2011, 1, 1)]])
+        assert (list(row_set.values()) ==
+                [['a', 'b'], [1, datetime.datetime(2011, 1, 1)]])
+
+    def test_not_a_spreadsheet(self):
+        f = io.BytesIO(b'a,b\n1,2\n')
+        assert parsers.spreadsheet_tableset(f) is None
+        assert f.tell() == 0
+
+    @csv_engine
+    def test_row_iterator(self):
+        table_set = parsers.any_tableset(
+            io.BytesIO(b'a,b\n1,x\n2\n'), mimetype='text/csv')
+        row_set = table_set.tables[0]
+        types = [messytables.IntegerType(), messytables.StringType()]
+        assert (list(jobs.row_iterator(row_set, ['a', 'b'], types, 0)) ==
+                [{'a': 1, 'b': 'x'}, {'a': 2, 'b': None}])
+
+    @csv_engine
+    def test_pieces_end_with_rows(self):
+        data = b'a,b\n1,"x\ny"\n2,"""z""\n"\n3,w\n'
+        row_set = parsers.any_tableset(io.BytesIO(data),
+                                       mimetype='text/csv').tables[0]
+        pieces = list(row_set.pieces(row_set.split(6)))
+        assert len(pieces) > 2
+        assert b''.join(pieces) == data
+        rows = []
+        for piece in pieces:
+            rows.extend(parsers.read_values(piece, row_set.encoding,
+                                            row_set.options()))
+        assert rows == [['a', 'b'], ['1', 'x\ny'], ['2', '"z"\n'],
+                        ['3', 'w']]
+
+    @csv_engine
+    def test_quotes_in_unquoted_values(self):
+        # They don't start quoted values, whatever the number of them
+        data = (b'a,b\nx,5\'11"\n' + b'1,2\n' * 10 + b'"p\nq",r\n' +
+                b'3,4\n' * 10)
+        row_set = parsers.any_tableset(io.BytesIO(data),
+                                       mimetype='text/csv').tables[0]
+        expected = list(row_set.values())
+        assert ['p\nq', 'r'] in expected
+        for size in range(1, len(data) + 1):
+            rows = []
+            for piece in row_set.pieces(row_set.split(size)):
+                rows.extend(parsers.read_values(piece, row_set.encoding,
+                                                row_set.options()))
+            assert rows == expected
+
+    @csv_engine
+    def test_files_that_can_not_be_split(self):
+        row_set = parsers.any_tableset(
+            io.BytesIO(u'a,b\n1,2\n'.encode('utf-16')),
+            mimetype='text/csv').tables[0]
+        assert row_set.split(2) is None
+        # Only carriage returns at the end of the rows
+        row_set = parsers.any_tableset(io.BytesIO(b'a,b\r1,2\r3,4\r'),
+                                       mimetype='text/csv').tables[0]
+        assert row_set.split(2) is None
+        assert list(row_set.values()) == [['a', 'b'], ['1', '2'], ['3', '4']]
+
+    @csv_engine
+    def test_parallel_row_iterator(self, monkeypatch):
+        monkeypatch.setattr(jobs, 'PARSE_WORKERS', 2)
+        monkeypatch.setattr(jobs, 'PARSE_RANGE_SIZE', 100)
+        f = tempfile.TemporaryFile()
+        f.write(b'title\na,b,c\n' + b''.join(
+            '{0},"x\n{0}",2011-01-{1:02d}\n'.format(i, i % 28 + 1).encode(
+                'ascii') for i in range(100)))
+        f.seek(0)
+        row_set = parsers.any_tableset(f, mimetype='text/csv').tables[0]
+        offset, headers = messytables.headers_guess(row_set.sample)
+        types = inference.compile_timestamps(
+            [messytables.IntegerType(), messytables.StringType(),
+             messytables.DateUtilType()],
+            [[c.value for c in row] for row in row_set.sample])
+        ends = jobs.parallel_pieces(f, row_set)
+        assert len(ends) > 2
+        expected = list(jobs.row_iterator(row_set, headers, types, offset))
+        assert len(expected) == 100
+        assert expected[99] == {'a': 99, 'b': 'x\n99',
+                                'c': datetime.datetime(2011, 1, 16)}
+        assert list(jobs.parallel_row_iterator(row_set, ends, headers, types,
+                                               offset)) == expected
+        jobs.close_parse_pool()
+        assert jobs._PARSE_POOL is None
+
+
+class TestDetectMojibake():
+    def rows(self, *rows):
+        return [[messytables.Cell(value) for value in row] for row in rows]
+
+    def test_columns(self):
+        rows = self.rows([u'G\xc3\xb6ttingen', u'G\xf6ttingen', u'a', 1],
+                         [u'M\xc3\xbcnchen', u'M\xc3\xbcnchen', u'b', 2])
+        assert jobs.detect_mojibake(rows, 4) == [True, False, True, True]
+
+    def test_no_mojibake(self):
+        rows = self.rows([u'G\xf6ttingen', u'a'], [None, u'b'])
+        assert jobs.detect_mojibake(rows, 2) == [False, False]
+
+    def test_short_rows(self):
+        rows = self.rows([u'a'], [u'M\xc3\xbcnchen', u'b', u'extra'])
+        assert jobs.detect_mojibake(rows, 2) == [True, True]
+
+    def test_repair_only_detected_columns(self):
+        row_set = messytables.CSVTableSet(io.BytesIO(
+            u'a,b\nG\xc3\xb6ttingen,G\xc3\xb6ttingen\n'.encode('utf-8'))
+        ).tables.pop()
+        types = [messytables.StringType()] * 2
+        records = jobs.row_iterator(row_set, ['a', 'b'], types, 0,
+                                    [True, False])
+        assert list(records) == [
+            {'a': u'G\xf6ttingen', 'b': u'G\xc3\xb6ttingen'}]
+
+
+class TestDownloadSpool():
+    def test_reads_block_until_the_bytes_arrive(self):
+        arrived = threading.Event()
+
+        def chunks():
+            yield b'a,b\n1,'
+            arrived.wait()
+            yield b'2\n'
+
+        spool = jobs.DownloadSpool(chunks(), 100)
+        assert spool.read(4) == b'a,b\n'
+        threading.Timer(0.05, arrived.set).start()
+        assert spool.read(10) == b'1,2\n'
+        assert spool.read(10) == b''
+        assert spool.wait() == 'e5ebd4c02cefbe7955977c67ada242b7'
+
+    def test_seek(self):
+        spool = jobs.DownloadSpool(iter([b'abc', b'def']), 100)
+        assert spool.read() == b'abcdef'
+        spool.seek(2)
+        assert spool.read(2) == b'cd'
+        assert spool.tell() == 4
+
+    def test_too_large(self):
+        spool = jobs.DownloadSpool(iter([b'abc', b'def']), 5)
+        with pytest.raises(util.JobError):
+            spool.read()
+        with pytest.raises(util.JobError):
+            spool.wait()
+
+    def test_failed_push_stops_the_download(self, monkeypatch):
+        spools = []
+        closed = threading.Event()
+        consumed = []
+
+        class Spool(jobs.DownloadSpool):
+            def __init__(self, *args, **kwargs):
+                spools.append(self)
+                super(Spool, self).__init__(*args, **kwargs)
+
+            def close(self):
+                super(Spool, self).close()
+                closed.set()
+
+        def chunks():
+            yield b'a,b\n' + b'1,2\n' * 2000
+            # The rest only arrives once the push has failed
+            closed.wait(5)
+            for i in range(100):
+                consumed.append(i)
+                yield b'3,4\n'
+
+        class Response(object):
+            url = 'http://www.source.org/static/file.csv'
+            status_code = 200
+            headers = requests.structures.CaseInsensitiveDict(
+                {'content-type': 'text/csv'})
+
+            def raise_for_status(self):
+                pass
+
+            def iter_content(self, chunk_size):
+                return chunks()
+
+        def send(*args, **kwargs):
+            raise util.JobError('The DataStore failed')
+
+        monkeypatch.setattr(jobs, 'DownloadSpool', Spool)
+        monkeypatch.setattr(jobs, 'STREAM_PARSE', True)
+        monkeypatch.setattr(jobs, 'STAGE_RECORDS', False)
+        monkeypatch.setattr(jobs, 'CONTENT_FINGERPRINT', False)
+        monkeypatch.setattr(jobs, 'DOWNLOAD_CACHE', None)
+        monkeypatch.setattr(jobs, 'get_data_response',
+                            lambda url, **kwargs: Response())
+        monkeypatch.setattr(jobs, 'datastore_resource_exists',
+                            lambda *args: None)
+        monkeypatch.setattr(jobs, 'send_resource_to_datastore', send)
+
+        resource = {'id': 'resource', 'url': Response.url, 'format': 'csv'}
+        data = {'ckan_url': 'http://www.ckan.org', 'resource_id': 'resource',
+                'ignore_hash': True}
+        with pytest.raises(util.JobError):
+            jobs.push_resource(resource, data, 'key',
+                               logging.getLogger('test'))
+        assert spools and spools[0].closed
+        spools[0]._thread.join(5)
+        assert not spools[0]._thread.is_alive()
+        # Only the chunk the download was waiting for has been read
+        assert len(consumed) <= 1
+
+    def test_parsed_by_messytables(self):
+        spool = jobs.DownloadSpool(iter([b'a,b\n1,', b'2\n3,4\n']), 100)
+        row_set = messytables.CSVTableSet(spool).tables[0]
+        assert ([[c.value for c in row] for row in row_set] ==
+                [['a', 'b'], ['1', '2'], ['3', '4']])
+
+
+class TestRangeDownload():
+    url = 'http://www.source.org/static/large.csv'
+    content = b''.join(b'%d,%d\n' % (i, i * i) for i in range(10000))
+
+    def register(self, ranges=True):
+        content = self.content
+
+        def body(request, uri, headers):
+            requested = request.headers.get('Range')
+            if ranges and requested:
+                start, end = [int(i) for i in
+                              requested.split('=')[1].split('-')]
+                headers['content-range'] = 'bytes {0}-{1}/{2}'.format(
+                    start, end, len(content))
+                return 206, headers, content[start:end + 1]
+            return 200, headers, content
+        httpretty.register_uri(httpretty.GET, self.url, body=body,
+                               adding_headers={'Accept-Ranges': 'bytes'})
+
+    def download(self, monkeypatch):
+        monkeypatch.setattr(jobs, 'DOWNLOAD_WORKERS', 4)
+        monkeypatch.setattr(jobs, 'DOWNLOAD_RANGE_SIZE', 10000)
+        kwargs = {'headers': {}, 'stream': True}
+        response = jobs.get_data_response(self.url, **kwargs)
+        tmp, file_hash, length = jobs.download_file(response, 'csv',
+                                                    self.url, kwargs)
+        assert tmp.read() == self.content
+        assert file_hash == hashlib.md5(self.content).hexdigest()
+        assert length == len(self.content)
+        return [r.headers.get('Range') for r in httpretty.latest_requests()]
+
+    @httpretty.activate
+    def test_ranges(self, monkeypatch):
+        self.register()
+        requested = self.download(monkeypatch)
+        size = -(-len(self.content) // 4)
+        assert 'bytes={0}-{1}'.format(size, 2 * size - 1) in requested
+        assert 'bytes=0-{0}'.format(size - 1) not in requested
+
+    @httpretty.activate
+    def test_ranges_not_supported(self, monkeypatch):
+        self.register(ranges=False)
+        self.download(monkeypatch)
+        assert len(httpretty.latest_requests()) > 1
+
+
+class TestAppendedTo():
+    def test_appended(self):
+        md5 = 'e5ebd4c02cefbe7955977c67ada242b7'
+        f = io.BytesIO(b'a,b\n1,2\n3,4\n')
+        f.seek(2)
+        assert jobs.appended_to(f, 8, md5)
+        # The position is kept
+        assert f.tell() == 2
+
+    def test_changed(self):
+        f = io.BytesIO(b'a,b\n1,3\n3,4\n')
+        assert not jobs.appended_to(f, 8, 'e5ebd4c02cefbe7955977c67ada242b7')
+
+    def test_same_length(self):
+        f = io.BytesIO(b'a,b\n1,2\n')
+        assert not jobs.appended_to(f, 8, 'e5ebd4c02cefbe7955977c67ada242b7')
+
+    def test_last_line_was_incomplete(self):
+        md5 = '749b1843d4c4be33afc4ba7f1158fc33'
+        f = io.BytesIO(b'a,b\n1,23\n')
+        assert not jobs.appended_to(f, 7, md5)
+
+
+class TestDownloadCache():
+    def add(self, download_cache, url, content):
+        fileobj = io.BytesIO(content)
+        download_cache.add(url, fileobj, hashlib.md5(content).hexdigest(),
+                           len(content), {'etag': '"abc"'})
+        assert fileobj.tell() == 0
+
+    def test_add_and_open(self, tmpdir):
+        download_cache = cache.DownloadCache(str(tmpdir), 1000, 3600)
+        assert download_cache.lookup('http://a') is None
+        self.add(download_cache, 'http://a', b'abc')
+        entry = download_cache.lookup('http://a')
+        assert entry['fresh']
+        assert entry['etag'] == '"abc"'
+        assert entry['length'] == 3
+        with download_cache.open(entry) as f:
+            assert f.read() == b'abc'
+
+    def test_stale_entry(self, tmpdir):
+        download_cache = cache.DownloadCache(str(tmpdir), 1000, 0)
+        self.add(download_cache, 'http://a', b'abc')
+        assert not download_cache.lookup('http://a')['fresh']
+
+    def test_least_recently_used_files_are_removed(self, tmpdir):
+        download_cache = cache.DownloadCache(str(tmpdir), 10, 3600)
+        self.add(download_cache, 'http://a', b'a' * 4)
+        self.add(download_cache, 'http://b', b'b' * 4)
+        entry = download_cache.lookup('http://a')
+        os.utime(str(tmpdir.join(entry['md5'] + '.data')), (1, 1))
+        os.utime(str(tmpdir.join(download_cache.lookup('http://b')['md5'] +
+                                 '.data')), (2, 2))
+        download_cache.open(entry).close()
+        self.add(download_cache, 'http://c', b'c' * 4)
+        assert download_cache.lookup('http://a') is not None
+        assert download_cache.lookup('http://b') is None
+        assert download_cache.lookup('http://c') is not None
+
+    def test_records(self, tmpdir):
+        download_cache = cache.DownloadCache(str(tmpdir), 1000, 3600)
+        assert download_cache.records('key') is None
+        records = download_cache.store_records('key', iter(['{"a":1}']))
+        assert list(records) == ['{"a":1}']
+        assert list(download_cache.records('key')) == ['{"a":1}']
+
+    def test_records_read_partly_are_not_cached(self, tmpdir):
+        download_cache = cache.DownloadCache(str(tmpdir), 1000, 3600)
+        records = download_cache.store_records('key', iter(['1', '2']))
+        next(records)
+        records.close()
+        assert download_cache.records('key') is None
+        assert tmpdir.listdir() == [tmpdir.join('urls')]
+
+
+class TestCompression():
+    data = b'a,b\n' + b'1,2\n' * 10000
+
+    def decompress(self, content, name='data.csv.gz', max_length=10 ** 6):
+        fileobj = io.BytesIO(content)
+        compressed = compression.detect(fileobj)
+        assert fileobj.tell() == 0
+        tmp, name = compression.decompress(fileobj, compressed, name,
+                                           max_length, 1024)
+        return compressed, tmp.read(), name
+
+    def test_gzip(self):
+        content = gzipped(self.data) + gzipped(b'3,4\n')
+        assert (self.decompress(content, '/files/data.csv.gz') ==
+                ('gzip', self.data + b'3,4\n', 'data.csv'))
+
+    def test_bzip2(self):
+        content = bz2.compress(self.data)
+        assert (self.decompress(content, 'data.tsv.bz2') ==
+                ('bzip2', self.data, 'data.tsv'))
+
+    def test_zip(self):
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, 'w') as archive:
+            archive.writestr('README', 'a')
+            archive.writestr('files/data.csv', self.data)
+        assert (self.decompress(content.getvalue(), 'data.zip') ==
+                ('zip', self.data, 'files/data.csv'))
+
+    def test_not_compressed(self):
+        assert compression.detect(io.BytesIO(self.data)) is None
+        with open(os.path.join(os.path.dirname(__file__), 'static',
+                               'simple.xlsx'), 'rb') as f:
+            assert compression.detect(f) is None
+
+    def test_decompressed_size_is_limited(self):
+        with pytest.raises(compression.DecompressionError):
+            self.decompress(gzipped(b'0' * 10 ** 6), max_length=1000)
+
+    def test_truncated_file(self, monkeypatch):
+        files = []
+        TemporaryFile = tempfile.TemporaryFile
+
+        def temporary_file():
+            files.append(TemporaryFile())
+            return files[-1]
+        monkeypatch.setattr(compression.tempfile, 'TemporaryFile',
+                            temporary_file)
+        with pytest.raises(compression.DecompressionError):
+            self.decompress(gzipped(os.urandom(10000))[:-100])
+        # The temporary file is removed
+        assert files and files[0].closed
+
+
 class TestGetUrl():
     def test_get_action_url(self):
         assert (
@@ -60,6 +987,19 @@ class TestGetUrl():
             'http://www.ckan.org/api/3/action/datastore_create')
 
 
+class TestGetSession():
+    def test_session_is_shared_by_site(self):
+        session = jobs.get_session('http://www.ckan.org')
+        assert jobs.get_session('www.ckan.org/') is session
+        assert jobs.get_session('http://demo.ckan.org') is not session
+
+    def test_session_is_pooled(self):
+        session = jobs.get_session('https://www.ckan.org')
+        adapter = session.get_adapter('https://www.ckan.org/api/3/action')
+        assert adapter._pool_maxsize == jobs.CKAN_POOL_SIZE
+        assert adapter.max_retries.total == jobs.CKAN_MAX_RETRIES
+
+
 class TestValidation():
     def test_validate_input(self):
         jobs.validate_input({
@@ -164,6 +1104,20 @@ class TestCkanActionCalls():
                                content_type="application/json")
         jobs.send_resource_to_datastore({'id': 'an_id'}, [], [], False, 'my_key', 'http://www.ckan.org/')
 
+    @httpretty.activate
+    def test_send_encoded_resource_to_datastore(self):
+        url = 'http://www.ckan.org/api/3/action/datastore_create'
+        httpretty.register_uri(httpretty.POST, url,
+                               body='{"success": true}',
+                               content_type="application/json")
+        records = [jobs.encode_record({'foo': decimal.Decimal('4.2')})]
+        jobs.send_resource_to_datastore({'id': 'an_id'}, [], records, True,
+                                        'my_key', 'http://www.ckan.org/',
+                                        encoded=True)
+        request = json.loads(httpretty.last_request().body)
+        assert request['records'] == [{'foo': '4.2'}]
+        assert request['calculate_record_count']
+
 
 class TestCheckResponse():
     """Unit tests for the check_response() function."""
@@ -229,3 +1183,252 @@ class TestCheckResponse():
                                status=404)
         r = requests.get('http://www.ckan.org/')
         jobs.check_response(r, 'http://www.ckan.org/', 'Me', good_status=(200, 201, 404))
+
+
+class TestJobScheduler():
+    def start(self, job_scheduler, started, host, lane=scheduler.MEDIUM):
+        done = threading.Event()
+
+        def run():
+            started.append(host + str(lane))
+            done.wait()
+
+        return job_scheduler.submit(host, lane, run), done
+
+    def wait_for(self, job_scheduler, active, queued):
+        for _ in range(500):
+            stats = job_scheduler.stats()
+            if (stats['active'], stats['queued']) == (active, queued):
+                return
+            threading.Event().wait(0.01)
+        raise AssertionError('jobs not queued')
+
+    def test_host_limit(self):
+        job_scheduler = scheduler.JobScheduler(3, 1)
+        started = []
+        first, first_done = self.start(job_scheduler, started, 'a')
+        self.wait_for(job_scheduler, 1, 0)
+        second, second_done = self.start(job_scheduler, started, 'a')
+        self.wait_for(job_scheduler, 1, 1)
+        other, other_done = self.start(job_scheduler, started, 'b')
+        other_done.set()
+        other.result(5)
+        # The second job of 'a' waits for the first one, not the job of 'b'
+        assert started == ['a1', 'b1']
+        stats = job_scheduler.stats()
+        assert stats['active'] == 1
+        assert stats['hosts'] == {'a': {'active': 1, 'queued': 1}}
+        first_done.set()
+        second_done.set()
+        second.result(5)
+        assert started == ['a1', 'b1', 'a1']
+        assert job_scheduler.stats()['hosts'] == {}
+
+    def test_small_files_first(self):
+        job_scheduler = scheduler.JobScheduler(1)
+        started = []
+        first, first_done = self.start(job_scheduler, started, 'a')
+        self.wait_for(job_scheduler, 1, 0)
+        jobs_ = [self.start(job_scheduler, started, 'a', scheduler.LARGE)]
+        self.wait_for(job_scheduler, 1, 1)
+        jobs_.append(self.start(job_scheduler, started, 'b',
+                                scheduler.SMALL))
+        self.wait_for(job_scheduler, 1, 2)
+        assert job_scheduler.stats()['lanes']['small']['queued'] == 1
+        assert job_scheduler.stats()['lanes']['large']['queued'] == 1
+        first_done.set()
+        for future, done in jobs_:
+            done.set()
+        for future, done in jobs_:
+            future.result(5)
+        assert started == ['a1', 'b0', 'a2']
+
+    def test_lane_limit(self):
+        job_scheduler = scheduler.JobScheduler(3, lane_workers={
+            scheduler.LARGE: 1})
+        started = []
+        first, first_done = self.start(job_scheduler, started, 'a',
+                                       scheduler.LARGE)
+        self.wait_for(job_scheduler, 1, 0)
+        second, second_done = self.start(job_scheduler, started, 'b',
+                                         scheduler.LARGE)
+        self.wait_for(job_scheduler, 1, 1)
+        # The other lanes still have workers
+        small, small_done = self.start(job_scheduler, started, 'c',
+                                       scheduler.SMALL)
+        small_done.set()
+        small.result(5)
+        assert started == ['a2', 'c0']
+        first_done.set()
+        second_done.set()
+        second.result(5)
+        assert started == ['a2', 'c0', 'b2']
+
+    def test_requeued_job(self):
+        job_scheduler = scheduler.JobScheduler(1)
+
+        def requeue():
+            return job_scheduler.submit('a', scheduler.LARGE, lambda: 42)
+
+        assert job_scheduler.submit('a', scheduler.SMALL,
+                                    requeue).result(5) == 42
+        with pytest.raises(ZeroDivisionError):
+            job_scheduler.submit('a', scheduler.SMALL, lambda: 1 / 0).result(5)
+
+    def test_waiting_jobs_dont_hold_a_thread(self):
+        # Far more jobs of a site than the executor has threads don't hold
+        # up the job of another site
+        job_scheduler = scheduler.JobScheduler(2, 1)
+        release = threading.Event()
+        ended = {}
+
+        def run(host):
+            if host == 'a':
+                release.wait()
+            elif host == 'c':
+                raise util.JobError('Push failed')
+            return host
+
+        def push(host):
+            return scheduler.wait(job_scheduler.submit(
+                host, scheduler.MEDIUM, run, host))
+
+        def listener(event):
+            ended[event.job_id] = event
+
+        aps_scheduler = BackgroundScheduler()
+        scheduler.init_executor(aps_scheduler, 2)
+        aps_scheduler.add_listener(listener,
+                                   EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+        aps_scheduler.start()
+        try:
+            for _ in range(150):
+                aps_scheduler.add_job(push, args=['a'])
+            self.wait_for(job_scheduler, 1, 149)
+            other = aps_scheduler.add_job(push, args=['b'])
+            failed = aps_scheduler.add_job(push, args=['c'])
+            for _ in range(500):
+                if other.id in ended and failed.id in ended:
+                    break
+                threading.Event().wait(0.01)
+            # The jobs end once their push has, not when they're queued
+            assert ended[other.id].retval == 'b'
+            assert ended[failed.id].code == EVENT_JOB_ERROR
+            assert str(ended[failed.id].exception) == 'Push failed'
+            assert len(ended) == 2
+            assert job_scheduler.stats()['hosts'] == {
+                'a': {'active': 1, 'queued': 149}}
+        finally:
+            release.set()
+            aps_scheduler.shutdown(wait=False)
+
+    def test_job_lane(self, monkeypatch):
+        monkeypatch.setattr(jobs, 'SMALL_FILE_SIZE', 100)
+        monkeypatch.setattr(jobs, 'LARGE_FILE_SIZE', 1000)
+        assert jobs.job_lane(100) == scheduler.SMALL
+        assert jobs.job_lane(101) == scheduler.MEDIUM
+        assert jobs.job_lane(1000) == scheduler.LARGE
+        assert jobs.job_lane(None) == scheduler.MEDIUM
+
+    @httpretty.activate
+    def test_resource_size(self):
+        url = 'http://www.source.org/static/file.csv'
+        ckan_url = 'http://www.ckan.org'
+        assert jobs.resource_size({'size': '10', 'url': url}, ckan_url,
+                                  'key') == 10
+        httpretty.register_uri(httpretty.HEAD, url, body='x' * 1234)
+        assert jobs.resource_size({'size': None, 'url': url}, ckan_url,
+                                  'key') == 1234
+        assert 'Authorization' not in httpretty.last_request().headers
+        httpretty.register_uri(httpretty.HEAD, url, status=405)
+        assert jobs.resource_size({'url': url}, ckan_url, 'key') is None
+
+    def test_resource_size_timeout(self, monkeypatch):
+        requests_ = []
+
+        def head(url, **kwargs):
+            requests_.append(kwargs)
+            raise requests.Timeout()
+
+        monkeypatch.setattr(jobs, 'SIZE_HEAD_TIMEOUT', 2)
+        monkeypatch.setattr(jobs.requests, 'head', head)
+        assert jobs.resource_size({'url': 'http://www.source.org/file.csv'},
+                                  'http://www.ckan.org', 'key') is None
+        assert requests_[0]['timeout'] == 2
+
+    @httpretty.activate
+    def test_resource_size_of_upload(self):
+        # The file is fetched from the internal URL of CKAN, with the key
+        url = 'http://internal.ckan.org/dataset/x/resource/y/file.csv'
+        httpretty.register_uri(httpretty.HEAD, url, body='x' * 1234)
+        resource = {'url': 'http://www.ckan.org/dataset/x/resource/y/'
+                           'file.csv', 'url_type': 'upload'}
+        assert jobs.resource_size(resource, 'http://internal.ckan.org/',
+                                  'key') == 1234
+        assert httpretty.last_request().headers['Authorization'] == 'key'
+
+
+class TestJobCoalescer():
+    def test_burst_of_jobs(self):
+        coalescer = scheduler.JobCoalescer(jobs.merge_metadata)
+        job_scheduler = scheduler.JobScheduler(2)
+        key = ('http://ckan', 'resource')
+        ran = []
+        release = threading.Event()
+
+        def run(metadata):
+            ran.append(metadata)
+            release.wait()
+            return metadata['n']
+
+        def start(metadata):
+            return job_scheduler.submit('http://ckan', scheduler.MEDIUM,
+                                        run, metadata)
+
+        first = coalescer.submit(key, {'n': 1}, start)
+        second = coalescer.submit(key, {'n': 2}, start)
+        # Merged into the second one, which hasn't started yet
+        merged = [coalescer.submit(key, metadata, start, lambda: 'merged')
+                  for metadata in ({'n': 3, 'ignore_hash': True}, {'n': 4})]
+        assert coalescer.stats() == {'running': 1, 'waiting': 1}
+        # They end with the job they were merged into
+        assert not any(future.done() for future in [second] + merged)
+
+        release.set()
+        assert first.result(5) == 1
+        assert second.result(5) == 4
+        assert [future.result(5) for future in merged] == ['merged'] * 2
+        assert ran == [{'n': 1}, {'n': 4, 'ignore_hash': True}]
+        assert coalescer.stats() == {'running': 0, 'waiting': 0}
+
+    def test_merged_job_fails_with_the_job_it_was_merged_into(self):
+        coalescer = scheduler.JobCoalescer(jobs.merge_metadata)
+        job_scheduler = scheduler.JobScheduler(2)
+        key = ('http://ckan', 'resource')
+        release = threading.Event()
+
+        def run(metadata):
+            if metadata['n'] == 1:
+                release.wait()
+            else:
+                raise util.JobError('Push failed')
+
+        def start(metadata):
+            return job_scheduler.submit('http://ckan', scheduler.MEDIUM,
+                                        run, metadata)
+
+        futures_ = [coalescer.submit(key, {'n': n}, start)
+                    for n in (1, 2, 3)]
+        release.set()
+        futures_[0].result(5)
+        for future in futures_[1:]:
+            with pytest.raises(util.JobError) as e:
+                future.result(5)
+            assert str(e.value) == 'Push failed'
+        assert coalescer.stats() == {'running': 0, 'waiting': 0}
+
+    def test_merge_metadata(self):
+        assert jobs.merge_metadata(
+            {'resource_id': 'a', 'set_url_type': True, 'original_url': 'x'},
+            {'resource_id': 'a', 'set_url_type': False, 'original_url': 'y'},
+        ) == {'resource_id': 'a', 'set_url_type': True, 'original_url': 'y'}
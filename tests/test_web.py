@@ -22,3 +22,9 @@ class TestWeb():
         result_dict = json.loads(rv.data)
         assert result_dict['job_types'] == ['push_to_datastore']
         assert result_dict['name'] == 'datapusher'
+
+    def test_scheduler_status(self):
+        rv = app.get('/scheduler')
+        result_dict = json.loads(rv.data)
+        assert result_dict['active'] == 0
+        assert result_dict['queued'] == 0